@@ -3,6 +3,12 @@ ASGI config for api project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+HTTP requests go to Django. WebSocket connections to /ws/scan/<test_id>/ are
+handled by exam.omr_scan (real-time camera scanning); other WebSocket paths
+are closed. Run with an ASGI server, e.g. ``uvicorn api.asgi:application``.
+The grading status event streams (exam.omr_events) also need this app to
+stream; under WSGI they fall back to one poll per connection.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -12,4 +18,19 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Import sau khi Django đã setup (models)
+from exam.omr_scan import SCAN_PATH, scan_websocket  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        match = SCAN_PATH.match(scope["path"])
+        if match:
+            return await scan_websocket(scope, receive, send, int(match["test_id"]))
+        # Từ chối handshake với các đường dẫn khác
+        await receive()
+        await send({"type": "websocket.close"})
+        return
+    return await django_application(scope, receive, send)
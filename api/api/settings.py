@@ -234,4 +234,21 @@ cloudinary.config(
     secure = True
 )
 
-DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
\ No newline at end of file
+DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
+
+# OMR grading worker pool
+OMR_WORKERS = int(os.getenv("OMR_WORKERS", os.cpu_count() or 1))  # số process chấm bài
+OMR_QUEUE_SIZE = int(os.getenv("OMR_QUEUE_SIZE", 200))  # số tờ tối đa được xếp hàng chờ
+OMR_BATCH_MAX_FILES = int(os.getenv("OMR_BATCH_MAX_FILES", 500))  # số tờ tối đa trong một batch
+OMR_BATCH_MAX_FILE_SIZE = int(os.getenv("OMR_BATCH_MAX_FILE_SIZE", 20 * 1024 * 1024))  # bytes mỗi ảnh
+OMR_MAX_PIXELS = int(os.getenv("OMR_MAX_PIXELS", 40_000_000))  # từ chối ảnh lớn hơn số pixel này
+OMR_TARGET_LONG_SIDE = int(os.getenv("OMR_TARGET_LONG_SIDE", 3200))  # cạnh dài (px) sau khi giải mã
+OMR_RENDER_CACHE_BYTES = int(os.getenv("OMR_RENDER_CACHE_BYTES", 64 * 1024 * 1024))  # cache ảnh đã chấm (mỗi process)
+OMR_MIN_SHARPNESS = float(os.getenv("OMR_MIN_SHARPNESS", 25))  # phương sai Laplacian tối thiểu trên ảnh thu nhỏ
+OMR_MIN_PAGE_COVERAGE = float(os.getenv("OMR_MIN_PAGE_COVERAGE", 0.08))  # tỷ lệ khung hình tối thiểu trang giấy chiếm
+OMR_SHM_MAX_BYTES = int(os.getenv("OMR_SHM_MAX_BYTES", 512 * 1024 * 1024))  # tổng shared memory cho ảnh đã giải mã đang chờ chấm
+OMR_SCAN_LONG_SIDE = int(os.getenv("OMR_SCAN_LONG_SIDE", 1280))  # cạnh dài (px) khung hình khi quét qua camera
+OMR_SCAN_STABLE_FRAMES = int(os.getenv("OMR_SCAN_STABLE_FRAMES", 3))  # số khung liên tiếp giống nhau để gửi kết quả
+OMR_EVENTS_POLL_SECONDS = float(os.getenv("OMR_EVENTS_POLL_SECONDS", 1))  # chu kỳ query của luồng SSE trạng thái chấm
+OMR_EVENTS_MAX_SECONDS = int(os.getenv("OMR_EVENTS_MAX_SECONDS", 300))  # thời gian tối đa một kết nối SSE trước khi client kết nối lại
+OMR_INFLIGHT_TIMEOUT_SECONDS = int(os.getenv("OMR_INFLIGHT_TIMEOUT_SECONDS", 600))  # bài QUEUED/PROCESSING lâu hơn coi như kẹt, cho phép upload lại
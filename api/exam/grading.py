@@ -0,0 +1,305 @@
+"""
+Chấm điểm: đáp án biên dịch sẵn và chấm lại từ ma trận độ tô đã lưu.
+
+Đáp án của mỗi bài được biên dịch thành mảng NumPy một lần và cache lại, nên
+vòng chấm không cần query từng câu hỏi. Câu trả lời và đáp án đều là bitmask
+(bit j bật nếu lựa chọn j được tô, 0 là bỏ trống), nên chấm cả bài là một
+phép so sánh số nguyên trên mảng, kể cả bài cho phép chọn nhiều đáp án. Mỗi PaperSubmission lưu ma trận độ tô (câu hỏi x lựa chọn, uint8 0-255) đọc
+được từ ảnh. Khi đáp án thay đổi, có thể chấm lại cả bài kiểm tra bằng NumPy
+mà không cần tải ảnh và chạy lại OpenCV.
+
+Bài có mã đề (exam.omr_variants) được biên dịch thành một dict mã đề ->
+đáp án (get_answer_keys), mỗi đáp án theo thứ tự in của đề đó; mã 0 là đề gốc.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from exam.models import PaperTest, PaperSubmission, PaperAnswerDetected
+from exam.omr_variants import choice_permutations, to_sheet_masks, variant_question_order
+
+ANSWER_KEY_CACHE_TIMEOUT = 60 * 60
+
+MASK_DTYPE = np.uint32  # Đủ cho 26 lựa chọn (A-Z)
+# Ngưỡng tô (0-255) được hiệu chỉnh theo từng tờ bằng Otsu và kẹp trong khoảng này
+FILL_THRESHOLD_RANGE = (60, 160)
+# Ô được tính là tô nếu đậm ít nhất chừng này so với ô đậm nhất cùng hàng
+ROW_RELATIVE_FILL = 0.6
+
+FLAG_BLANK = 'blank'
+FLAG_MULTIPLE = 'multiple'
+
+
+def fill_to_uint8(fill):
+    return np.rint(np.clip(fill, 0, 1) * 255).astype(np.uint8)
+
+
+def encode_fill_matrix(fill):
+    return np.ascontiguousarray(fill, dtype=np.uint8).tobytes()
+
+
+def decode_fill_matrix(data, num_choices):
+    return np.frombuffer(bytes(data), dtype=np.uint8).reshape(-1, num_choices)
+
+
+def fill_threshold(fill):
+    """Ngưỡng tô của một tờ: Otsu trên histogram độ tô, kẹp trong FILL_THRESHOLD_RANGE"""
+    hist = np.bincount(np.asarray(fill, dtype=np.uint8).ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    low, high = FILL_THRESHOLD_RANGE
+    if total == 0:
+        return (low + high) // 2
+    w0 = np.cumsum(hist)
+    w1 = total - w0
+    m0 = np.cumsum(hist * np.arange(256))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (m0[-1] * w0 - m0 * total) ** 2 / (w0 * w1)
+    between[~np.isfinite(between)] = 0
+    return int(np.clip(between.argmax() + 1, low, high))
+
+
+def answer_masks(fill):
+    """
+    Bitmask các lựa chọn được tô của mỗi câu từ ma trận độ tô (câu hỏi x lựa chọn).
+    Ô được tính là tô nếu vượt ngưỡng của tờ và đủ đậm so với ô đậm nhất cùng hàng.
+    """
+    fill = np.asarray(fill)
+    if fill.size == 0:
+        return np.zeros(fill.shape[:1], dtype=MASK_DTYPE)
+    marked = (fill >= fill_threshold(fill)) & (fill >= fill.max(axis=1, keepdims=True) * ROW_RELATIVE_FILL)
+    bits = MASK_DTYPE(1) << np.arange(fill.shape[1], dtype=MASK_DTYPE)
+    return (marked * bits).sum(axis=1, dtype=MASK_DTYPE)
+
+
+def popcount(masks):
+    """Số lựa chọn được tô trong mỗi bitmask"""
+    masks = np.asarray(masks, dtype=MASK_DTYPE)
+    return np.unpackbits(masks.astype('<u4').view(np.uint8).reshape(masks.shape + (4,)), axis=-1).sum(axis=-1)
+
+
+def answer_flags(masks, allow_multiple):
+    """'' nếu câu đọc bình thường, FLAG_BLANK nếu bỏ trống, FLAG_MULTIPLE nếu tô nhiều ô ở bài một đáp án"""
+    counts = popcount(masks)
+    flags = np.full(counts.shape, '', dtype=object)
+    flags[counts == 0] = FLAG_BLANK
+    if not allow_multiple:
+        flags[counts > 1] = FLAG_MULTIPLE
+    return flags
+
+
+def letters_to_mask(letters, num_choices=26):
+    """'AC' -> 0b101; chữ cái ngoài num_choices lựa chọn bị bỏ qua"""
+    mask = 0
+    for letter in letters or '':
+        j = ord(letter.upper()) - 65
+        if 0 <= j < num_choices:
+            mask |= 1 << j
+    return mask
+
+
+def mask_to_letters(mask):
+    """0b101 -> 'AC', 0 -> ''"""
+    mask = int(mask)
+    return ''.join(chr(65 + j) for j in range(mask.bit_length()) if mask >> j & 1)
+
+
+def indices_to_masks(indices):
+    """Chỉ số lựa chọn (-1 là bỏ trống) -> bitmask"""
+    indices = np.asarray(indices)
+    return np.where(indices >= 0, MASK_DTYPE(1) << np.maximum(indices, 0).astype(MASK_DTYPE), 0).astype(MASK_DTYPE)
+
+
+# choice_order: None với đề gốc, với mã đề là mảng (câu, vị trí) lựa chọn gốc in ở từng vị trí
+CompiledAnswerKey = namedtuple('CompiledAnswerKey', ['question_ids', 'correct', 'scores', 'choice_order'],
+                               defaults=(None,))
+
+# Cache trong process: (test_id, answer_key_version) -> {mã đề: CompiledAnswerKey}
+_KEY_CACHE_SIZE = 256
+_key_cache = OrderedDict()
+_key_cache_lock = threading.Lock()
+
+
+def compile_answer_key(test):
+    """
+    Đáp án của bài dạng mảng theo thứ tự id câu hỏi:
+    question_ids, correct (bitmask, 0 nếu chưa có đáp án), scores.
+    Bài một đáp án chỉ dùng chữ cái đầu của correct_answer.
+    """
+    rows = list(test.questions.order_by('id').values_list('id', 'correct_answer', 'score'))
+    question_ids = np.array([qid for qid, _, _ in rows], dtype=np.int64)
+    correct = np.array([
+        letters_to_mask(answer if test.allow_multiple_answers else answer[:1], test.num_choices)
+        for _, answer, _ in rows
+    ], dtype=MASK_DTYPE)
+    scores = np.array([score for _, _, score in rows], dtype=np.float64)
+    return CompiledAnswerKey(question_ids, correct, scores)
+
+
+def compile_variant_key(key, variant, num_choices):
+    """Đáp án của một mã đề, theo thứ tự câu hỏi và vị trí lựa chọn in trên đề đó"""
+    order = np.array(variant_question_order(variant, key.question_ids), dtype=np.int64)
+    positions = np.searchsorted(key.question_ids, order)
+    choice_order = choice_permutations(variant.seed, len(order), num_choices, variant.shuffle_choices)
+    return CompiledAnswerKey(order, to_sheet_masks(key.correct[positions], choice_order),
+                             key.scores[positions], choice_order)
+
+
+def compile_answer_keys(test):
+    """{mã đề: CompiledAnswerKey}, 0 là đề gốc"""
+    key = compile_answer_key(test)
+    keys = {0: key}
+    if test.num_variants:
+        for variant in test.variants.filter(code__lte=test.num_variants):
+            keys[variant.code] = compile_variant_key(key, variant, test.num_choices)
+    return keys
+
+
+def _answer_key_cache_key(test):
+    return f"exam:answer_key:v3:{test.id}:{test.answer_key_version}"
+
+
+def _key_to_bytes(key):
+    return tuple(None if a is None else a.tobytes() for a in key)
+
+
+def _key_from_bytes(data, num_choices):
+    question_ids, correct, scores, choice_order = data
+    return CompiledAnswerKey(
+        np.frombuffer(question_ids, dtype=np.int64),
+        np.frombuffer(correct, dtype=MASK_DTYPE),
+        np.frombuffer(scores, dtype=np.float64),
+        None if choice_order is None else np.frombuffer(choice_order, dtype=np.uint8).reshape(-1, num_choices),
+    )
+
+
+def get_answer_keys(test):
+    """
+    Đáp án đã biên dịch của đề gốc và mọi mã đề: dict mã đề -> CompiledAnswerKey.
+    Lấy từ cache trong process, rồi Django cache, rồi DB. Cache gắn với
+    PaperTest.answer_key_version nên không bao giờ trả về đáp án cũ.
+    """
+    local_key = (test.id, test.answer_key_version)
+    with _key_cache_lock:
+        keys = _key_cache.get(local_key)
+        if keys is not None:
+            _key_cache.move_to_end(local_key)
+            return keys
+
+    cached = cache.get(_answer_key_cache_key(test))
+    if cached is not None:
+        keys = {code: _key_from_bytes(data, test.num_choices) for code, data in cached.items()}
+    else:
+        keys = compile_answer_keys(test)
+        cache.set(_answer_key_cache_key(test), {code: _key_to_bytes(key) for code, key in keys.items()},
+                  ANSWER_KEY_CACHE_TIMEOUT)
+
+    with _key_cache_lock:
+        _key_cache[local_key] = keys
+        while len(_key_cache) > _KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return keys
+
+
+def get_answer_key(test, variant_code=0):
+    """Đáp án đã biên dịch của đề gốc (hoặc của mã đề `variant_code`), None nếu không có mã đề đó"""
+    return get_answer_keys(test).get(variant_code)
+
+
+def invalidate_answer_key(test):
+    """Gọi sau mỗi lần thay đổi đáp án / câu hỏi của bài kiểm tra"""
+    cache.delete(_answer_key_cache_key(test))
+    PaperTest.objects.filter(id=test.id).update(answer_key_version=F('answer_key_version') + 1)
+    test.refresh_from_db(fields=['answer_key_version'])
+
+
+def pad_answers(selected, num_questions):
+    """Cắt / thêm 0 (bỏ trống) để số câu trả lời khớp với số câu hỏi của đáp án"""
+    padded = np.zeros(selected.shape[:-1] + (num_questions,), dtype=MASK_DTYPE)
+    n = min(selected.shape[-1], num_questions)
+    padded[..., :n] = selected[..., :n]
+    return padded
+
+
+def score_answers(selected, key):
+    """
+    Chấm mảng bitmask câu trả lời (... x câu hỏi) theo đáp án: đúng khi tô
+    đúng tập lựa chọn của đáp án (tô thêm hoặc thiếu ô đều là sai).
+    Trả về (is_correct, điểm từng câu, tổng điểm thang 10).
+    """
+    is_correct = (selected == key.correct) & (key.correct != 0)
+    question_scores = np.where(is_correct, key.scores, 0.0)
+    max_score = key.scores.sum()
+    totals = question_scores.sum(axis=-1) / max_score * 10 if max_score > 0 else np.zeros(selected.shape[:-1])
+    return is_correct, question_scores, np.round(totals, 2)
+
+
+def regrade_test(test, changed_question_ids=None):
+    """
+    Chấm lại mọi bài nộp của `test` từ ma trận độ tô đã lưu.
+    Chỉ cập nhật PaperAnswerDetected của các câu trong `changed_question_ids`
+    (mặc định: tất cả các câu).
+    """
+    keys = get_answer_keys(test)
+    num_questions = len(keys[0].question_ids)
+
+    submissions = list(
+        PaperSubmission.objects.filter(test=test, fill_matrix__isnull=False)
+        .only('id', 'total_score', 'fill_matrix', 'variant_code')
+    )
+    if not submissions or num_questions == 0:
+        return {'regraded': 0, 'changed_questions': 0}
+
+    if changed_question_ids is None:
+        changed_ids = set(int(qid) for qid in keys[0].question_ids)
+    else:
+        changed_ids = set(int(qid) for qid in changed_question_ids) & set(int(qid) for qid in keys[0].question_ids)
+
+    # Chấm theo từng mã đề, gom kết quả theo id câu gốc: id câu -> (bài đúng, mọi bài, điểm)
+    by_question = {qid: ([], [], 0.0) for qid in changed_ids}
+    totals = {}
+    for code in sorted(set(s.variant_code for s in submissions)):
+        key = keys.get(code)
+        group = [s for s in submissions if s.variant_code == code]
+        if key is None:
+            # Mã đề đã bị xóa / sinh lại: không đoán đáp án, giữ kết quả cũ
+            continue
+
+        # Ma trận bitmask câu trả lời (bài nộp x câu hỏi), 0 là không đọc được
+        selected = np.stack([
+            pad_answers(answer_masks(decode_fill_matrix(s.fill_matrix, test.num_choices)), num_questions)
+            for s in group
+        ])
+        is_correct, _, group_totals = score_answers(selected, key)
+        totals.update(zip((s.id for s in group), group_totals))
+
+        group_ids = np.array([s.id for s in group], dtype=np.int64)
+        for column, qid in enumerate(key.question_ids.tolist()):
+            if qid in by_question:
+                right, everyone, _ = by_question[qid]
+                right.extend(group_ids[is_correct[:, column]].tolist())
+                everyone.extend(group_ids.tolist())
+                by_question[qid] = (right, everyone, float(key.scores[column]))
+
+    with transaction.atomic():
+        for qid, (right, everyone, score) in by_question.items():
+            answers = PaperAnswerDetected.objects.filter(question_id=qid, submission_id__in=everyone)
+            answers.filter(submission_id__in=right).update(is_correct=True, score=score)
+            answers.exclude(submission_id__in=right).update(is_correct=False, score=0)
+
+        # Chỉ bài đổi điểm mới được ghi (và phát sự kiện "graded" qua exam.omr_events)
+        now = timezone.now()
+        changed = []
+        for submission in submissions:
+            total = totals.get(submission.id)
+            if total is not None and submission.total_score != float(total):
+                submission.total_score = float(total)
+                submission.updated_at = now
+                changed.append(submission)
+        PaperSubmission.objects.bulk_update(changed, ['total_score', 'updated_at'], batch_size=500)
+
+    return {'regraded': len(totals), 'changed_questions': len(changed_ids)}
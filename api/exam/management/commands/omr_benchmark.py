@@ -0,0 +1,193 @@
+"""
+Đo tốc độ và độ chính xác của OMR trên phiếu giả lập (exam.omr_synthetic).
+
+    python manage.py omr_benchmark --sheets 1000 --severity 1.0
+    python manage.py omr_benchmark --sheets 1000 --workers 4
+
+Chạy offline, không cần DB: đáp án được biên dịch sẵn trong bộ nhớ. Với
+--workers, ảnh được giải mã (xám) ở process chính và chuyển sang OMRWorkerPool
+qua shared memory (submit_page), throughput tính theo thời gian thực.
+"""
+import json
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from exam.grading import CompiledAnswerKey, indices_to_masks, score_answers
+from exam.omr_image import load_image
+from exam.omr_layout import build_sheet_layout, MAX_QUESTIONS
+from exam.omr_pool import OMRWorkerPool
+from exam.omr_synthetic import generate_sheet
+from exam.omr_timing import timed, stage_percentiles
+from exam.views.omr_processing import grade_sheet
+
+
+def _grade_page(image, test, key):
+    # Chạy trong worker: `image` là view read-only trong shared memory
+    timings = {}
+    start = time.perf_counter()
+    result = grade_sheet(image, test, timings=timings, key=key)
+    timings['total'] = round((time.perf_counter() - start) * 1000, 3)
+    return timings, result.selected, result.total_score
+
+
+class Command(BaseCommand):
+    help = "Benchmark OMR throughput and accuracy on synthetic answer sheets"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sheets', type=int, default=200, help="Number of sheets to grade")
+        parser.add_argument('--questions', type=int, default=MAX_QUESTIONS)
+        parser.add_argument('--choices', type=int, default=4)
+        parser.add_argument('--severity', type=float, default=1.0,
+                            help="Perturbation strength, 0 (clean scan) to 1 (hand-held photo)")
+        parser.add_argument('--blank-rate', type=float, default=0.0, help="Fraction of questions left blank")
+        parser.add_argument('--multi-rate', type=float, default=0.0,
+                            help="Fraction of questions with a second bubble marked")
+        parser.add_argument('--allow-multiple', action='store_true',
+                            help="Grade as a multiple-answer test (double marks are read, not penalised as blank)")
+        parser.add_argument('--dpi', type=int, default=200, help="Resolution the sheet is rendered at")
+        parser.add_argument('--long-side', type=int, default=3000, help="Long side of the simulated photo (px)")
+        parser.add_argument('--workers', type=int, default=0,
+                            help="Grade in N worker processes with shared-memory hand-off (0: in this process)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--save-samples', metavar='DIR', help="Write the first 5 generated photos to DIR")
+        parser.add_argument('--json', metavar='PATH', help="Also write the report as JSON")
+
+    def handle(self, *args, **options):
+        num_questions, num_choices = options['questions'], options['choices']
+        if not 1 <= num_questions <= MAX_QUESTIONS:
+            raise CommandError(f"--questions must be between 1 and {MAX_QUESTIONS}")
+        if not 2 <= num_choices <= 4:
+            raise CommandError("--choices must be between 2 and 4")
+
+        rng = np.random.default_rng(options['seed'])
+        layout = build_sheet_layout(num_questions, num_choices)
+        test = SimpleNamespace(id=0, title='Benchmark', layout=layout, num_questions=num_questions,
+                               num_choices=num_choices, allow_multiple_answers=options['allow_multiple'])
+        key = CompiledAnswerKey(
+            np.arange(1, num_questions + 1, dtype=np.int64),
+            indices_to_masks(rng.integers(0, num_choices, num_questions)),
+            np.ones(num_questions, dtype=np.float64),
+        )
+
+        sheets, generate_ms = [], []
+        for i in range(options['sheets']):
+            start = time.perf_counter()
+            sheet = generate_sheet(layout, rng, options['severity'], options['dpi'],
+                                   options['long_side'], options['blank_rate'], options['multi_rate'])
+            generate_ms.append((time.perf_counter() - start) * 1000)
+            if options['save_samples'] and i < 5:
+                with open(f"{options['save_samples']}/sheet_{i}.jpg", 'wb') as f:
+                    f.write(sheet.image_bytes)
+            sheets.append(sheet)
+
+        if options['workers']:
+            outcomes, grading_seconds = self.grade_in_pool(sheets, test, key, options['workers'])
+        else:
+            outcomes = [self.grade_here(sheet, test, key) for sheet in sheets]
+            grading_seconds = None
+
+        rows = []
+        failures = 0
+        correct_answers = exact_sheets = correct_scores = 0
+        for i, (sheet, outcome) in enumerate(zip(sheets, outcomes)):
+            if isinstance(outcome, Exception):
+                failures += 1
+                self.stderr.write(f"sheet {i}: {outcome}")
+                continue
+            timings, selected, total_score = outcome
+            rows.append(timings)
+
+            matches = selected == sheet.answers
+            correct_answers += int(matches.sum())
+            exact_sheets += int(matches.all())
+            expected_score = float(score_answers(sheet.answers, key)[2])
+            correct_scores += int(abs(total_score - expected_score) < 1e-6)
+
+        graded = len(rows)
+        if grading_seconds is None:
+            grading_seconds = sum(row['total'] for row in rows) / 1000
+        report = {
+            'sheets': options['sheets'],
+            'workers': options['workers'],
+            'failed': failures,
+            'questions': num_questions,
+            'choices': num_choices,
+            'severity': options['severity'],
+            'sheets_per_second': round(graded / grading_seconds, 2) if grading_seconds else 0.0,
+            'generate_ms_per_sheet': round(float(np.mean(generate_ms)), 2) if generate_ms else 0.0,
+            # Tờ chấm lỗi tính là sai toàn bộ
+            'answer_accuracy': round(correct_answers / (options['sheets'] * num_questions), 5),
+            'sheet_accuracy': round(exact_sheets / options['sheets'], 5),
+            'score_accuracy': round(correct_scores / options['sheets'], 5),
+            'stages': stage_percentiles(rows),
+        }
+        self.print_report(report)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def grade_here(self, sheet, test, key):
+        timings = {}
+        start = time.perf_counter()
+        try:
+            with timed(timings, 'decode'):
+                image = load_image(sheet.image_bytes)
+            result = grade_sheet(image, test, timings=timings, key=key)
+        except Exception as e:
+            return e
+        timings['total'] = round((time.perf_counter() - start) * 1000, 3)
+        return timings, result.selected, result.total_score
+
+    def grade_in_pool(self, sheets, test, key, workers):
+        """Giải mã ở đây, chấm trong `workers` process. Trả về (kết quả, số giây thực)."""
+        pool = OMRWorkerPool(max_workers=workers, max_queue=len(sheets))
+        # Chờ các worker khởi động xong (spawn + django.setup) trước khi bấm giờ
+        for future in [pool.submit(time.sleep, 0.1) for _ in range(workers)]:
+            future.result()
+
+        start = time.perf_counter()
+        futures = []
+        for sheet in sheets:
+            timings = {}
+            with timed(timings, 'decode'):
+                image = load_image(sheet.image_bytes, gray=True)
+            with timed(timings, 'handoff'):
+                future = pool.submit_page(_grade_page, image, test, key, block=True)
+            futures.append((timings, future))
+
+        outcomes = []
+        for parent_timings, future in futures:
+            try:
+                timings, selected, total_score = future.result()
+            except Exception as e:
+                outcomes.append(e)
+                continue
+            timings.update(parent_timings)
+            timings['total'] = round(timings['total'] + parent_timings['decode'] + parent_timings['handoff'], 3)
+            outcomes.append((timings, selected, total_score))
+        seconds = time.perf_counter() - start
+        pool.shutdown()
+        return outcomes, seconds
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['sheets']} sheets ({report['failed']} failed), "
+            f"{report['questions']} questions x {report['choices']} choices, severity {report['severity']}"
+        )
+        if report['workers']:
+            self.stdout.write(f"Throughput:      {report['sheets_per_second']} sheets/s "
+                              f"({report['workers']} worker processes, wall clock)")
+        else:
+            self.stdout.write(f"Throughput:      {report['sheets_per_second']} sheets/s (1 process, grading only)")
+        self.stdout.write(f"Generation:      {report['generate_ms_per_sheet']} ms/sheet (not counted)")
+        self.stdout.write(f"Answer accuracy: {report['answer_accuracy']:.3%}")
+        self.stdout.write(f"Sheet accuracy:  {report['sheet_accuracy']:.3%}")
+        self.stdout.write(f"Score accuracy:  {report['score_accuracy']:.3%}")
+        self.stdout.write(f"{'stage':<10}{'p50 ms':>10}{'p95 ms':>10}")
+        for stage, stats in report['stages'].items():
+            self.stdout.write(f"{stage:<10}{stats['p50']:>10.2f}{stats['p95']:>10.2f}")
@@ -0,0 +1,93 @@
+"""
+Xuất ảnh bài nộp đã chấm và kết quả đã lưu thành corpus cho omr_replay.
+
+    python manage.py omr_export_corpus --out corpus/ --test 12 --test 15 --limit 500
+
+Chạy lại được nhiều lần: ảnh đã tải sẽ không tải lại.
+"""
+import json
+import os
+
+import cloudinary
+import requests
+from django.core.management.base import BaseCommand
+
+from exam.grading import compile_answer_key
+from exam.models import PaperSubmission, PaperTest
+from exam.omr_replay import test_to_json
+
+
+def original_image_urls(submission):
+    """
+    URL ảnh gốc trước, rồi submission_image. Ảnh gốc được upload với public_id
+    submission_<id> (xem _store_images), submission_image có thể là ảnh đã chấm.
+    """
+    public_id = f"testgen/submissions/test_{submission.test_id}/submission_{submission.id}"
+    urls = [cloudinary.CloudinaryImage(public_id).build_url(secure=True)]
+    if submission.submission_image:
+        urls.append(submission.submission_image.url)
+    return urls
+
+
+class Command(BaseCommand):
+    help = "Export graded submissions (original image + stored answers) as an OMR replay corpus"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--out', required=True, help="Corpus directory")
+        parser.add_argument('--test', type=int, action='append', dest='tests', help="Test id (repeatable)")
+        parser.add_argument('--limit', type=int, default=500, help="Maximum number of sheets")
+
+    def handle(self, *args, **options):
+        out = options['out']
+        os.makedirs(os.path.join(out, 'images'), exist_ok=True)
+        os.makedirs(os.path.join(out, 'tests'), exist_ok=True)
+
+        submissions = PaperSubmission.objects.filter(
+            # Tờ theo mã đề có thứ tự in khác đáp án gốc: không đưa vào bộ dữ liệu
+            status=PaperSubmission.Status.GRADED, variant_code=0
+        ).order_by('-id').prefetch_related('user_answers')
+        if options['tests']:
+            submissions = submissions.filter(test_id__in=options['tests'])
+
+        keys = {}
+        exported = skipped = 0
+        with open(os.path.join(out, 'manifest.jsonl'), 'w') as manifest:
+            for submission in submissions[:options['limit']]:
+                if submission.test_id not in keys:
+                    test = PaperTest.objects.get(id=submission.test_id)
+                    keys[test.id] = compile_answer_key(test)
+                    with open(os.path.join(out, 'tests', f'{test.id}.json'), 'w') as f:
+                        json.dump(test_to_json(test, keys[test.id]), f)
+                key = keys[submission.test_id]
+
+                image = os.path.join('images', f'{submission.id}.jpg')
+                path = os.path.join(out, image)
+                if not os.path.exists(path) and not self.download(submission, path):
+                    skipped += 1
+                    continue
+
+                selected = {a.question_id: a.selected_option for a in submission.user_answers.all()}
+                manifest.write(json.dumps({
+                    'submission_id': submission.id,
+                    'test_id': submission.test_id,
+                    'image': image,
+                    'source_name': submission.source_name,
+                    'total_score': submission.total_score,
+                    'answers': [selected.get(int(qid), "") for qid in key.question_ids],
+                }) + "\n")
+                exported += 1
+
+        self.stdout.write(f"Exported {exported} sheets from {len(keys)} tests to {out} ({skipped} without an image)")
+
+    def download(self, submission, path):
+        for url in original_image_urls(submission):
+            try:
+                response = requests.get(url, timeout=30)
+                response.raise_for_status()
+            except requests.RequestException:
+                continue
+            with open(path, 'wb') as f:
+                f.write(response.content)
+            return True
+        self.stderr.write(f"submission {submission.id}: image not found")
+        return False
@@ -0,0 +1,144 @@
+"""
+So sánh engine OMR ứng viên với engine hiện tại trên corpus ảnh thật.
+
+    python manage.py omr_replay corpus/ --candidate mypkg.omr.grade --workers 4
+
+Xem exam.omr_replay về định dạng corpus và chữ ký của engine.
+"""
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from exam.omr_pool import _init_worker
+from exam.omr_replay import CURRENT_ENGINE, load_corpus, replay_sheet, letters_to_masks, masks_to_letters
+
+
+def _summary(runs, stored):
+    ok = [(run, expected) for run, expected in zip(runs, stored) if run['selected'] is not None]
+    # Tờ chấm lỗi tính là sai toàn bộ
+    questions = sum(len(expected) for expected in stored) or 1
+    agree = sum(int((np.array(run['selected'][:len(expected)]) == expected).sum()) for run, expected in ok)
+    ms = np.array([run['ms'] for run, _ in ok]) if ok else np.zeros(1)
+    peak = np.array([run['peak_bytes'] for run, _ in ok]) / (1024 * 1024) if ok else np.zeros(1)
+    return {
+        'errors': len(runs) - len(ok),
+        'agreement': round(agree / questions, 5),
+        'ms_p50': round(float(np.percentile(ms, 50)), 2),
+        'ms_p95': round(float(np.percentile(ms, 95)), 2),
+        'peak_mb_p50': round(float(np.percentile(peak, 50)), 2),
+        'peak_mb_max': round(float(peak.max()), 2),
+    }
+
+
+class Command(BaseCommand):
+    help = "Replay an exported scan corpus through the current and a candidate OMR engine"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus', help="Directory written by omr_export_corpus")
+        parser.add_argument('--candidate', required=True, help="Dotted path of the candidate engine")
+        parser.add_argument('--baseline', default=CURRENT_ENGINE, help="Dotted path of the baseline engine")
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--limit', type=int, help="Only replay the first N sheets")
+        parser.add_argument('--show', type=int, default=20, help="Number of differing sheets to print")
+        parser.add_argument('--json', metavar='PATH', help="Also write the per-sheet results as JSON")
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help="Exit with an error if the candidate agrees less with stored answers")
+
+    def handle(self, *args, **options):
+        try:
+            sheets, tests = load_corpus(options['corpus'])
+        except FileNotFoundError as e:
+            raise CommandError(f"Not a replay corpus: {e}")
+        if options['limit']:
+            sheets = sheets[:options['limit']]
+        engines = [options['baseline'], options['candidate']]
+
+        # Hai engine chạy song song trên cùng một pool, mỗi tờ một job cho mỗi engine
+        executor = ProcessPoolExecutor(
+            max_workers=options['workers'],
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+        )
+        with executor:
+            futures = [
+                [executor.submit(replay_sheet, engine, options['corpus'], sheet, tests[sheet['test_id']])
+                 for engine in engines]
+                for sheet in sheets
+            ]
+            results = [[f.result() for f in pair] for pair in futures]
+
+        stored = [letters_to_masks(sheet['answers']) for sheet in sheets]
+        baseline = _summary([r[0] for r in results], stored)
+        candidate = _summary([r[1] for r in results], stored)
+
+        diffs = []
+        for sheet, expected, (base, cand) in zip(sheets, stored, results):
+            if base['selected'] == cand['selected']:
+                continue
+            questions = []
+            for q in range(len(expected) if not (base['error'] or cand['error']) else 0):
+                b = base['selected'][q] if base['selected'] and q < len(base['selected']) else 0
+                c = cand['selected'][q] if cand['selected'] and q < len(cand['selected']) else 0
+                if b != c:
+                    questions.append({
+                        'question': q + 1,
+                        'stored': masks_to_letters([expected[q]])[0],
+                        'baseline': masks_to_letters([b])[0],
+                        'candidate': masks_to_letters([c])[0],
+                    })
+            diffs.append({
+                'submission_id': sheet['submission_id'],
+                'source_name': sheet.get('source_name', ''),
+                'baseline_error': base['error'],
+                'candidate_error': cand['error'],
+                'questions': questions,
+            })
+
+        self.print_report(len(sheets), engines, baseline, candidate, diffs, options['show'])
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({
+                    'engines': engines,
+                    'baseline': baseline,
+                    'candidate': candidate,
+                    'diffs': diffs,
+                    'sheets': [
+                        {'submission_id': sheet['submission_id'], 'baseline': base, 'candidate': cand}
+                        for sheet, (base, cand) in zip(sheets, results)
+                    ],
+                }, f, indent=2)
+
+        if options['fail_on_regression'] and candidate['agreement'] < baseline['agreement']:
+            raise CommandError(
+                f"Candidate agrees with stored answers on {candidate['agreement']:.3%} of questions, "
+                f"baseline on {baseline['agreement']:.3%}"
+            )
+
+    def print_report(self, num_sheets, engines, baseline, candidate, diffs, show):
+        self.stdout.write(f"{num_sheets} sheets, {len(diffs)} with different answers")
+        self.stdout.write(f"{'':<22}{'baseline':>12}{'candidate':>12}{'delta':>10}")
+        for label, field in (
+            ('agreement w/ stored', 'agreement'), ('errors', 'errors'),
+            ('ms p50', 'ms_p50'), ('ms p95', 'ms_p95'),
+            ('peak MB p50', 'peak_mb_p50'), ('peak MB max', 'peak_mb_max'),
+        ):
+            b, c = baseline[field], candidate[field]
+            self.stdout.write(f"{label:<22}{b:>12}{c:>12}{round(c - b, 5):>10}")
+        self.stdout.write(f"baseline:  {engines[0]}\ncandidate: {engines[1]}")
+
+        for diff in diffs[:show]:
+            name = f" ({diff['source_name']})" if diff['source_name'] else ""
+            self.stdout.write(f"submission {diff['submission_id']}{name}:")
+            for error in ('baseline_error', 'candidate_error'):
+                if diff[error]:
+                    self.stdout.write(f"  {error.split('_')[0]} failed: {diff[error]}")
+            for q in diff['questions']:
+                self.stdout.write(
+                    f"  Q{q['question']}: stored={q['stored'] or '-'} "
+                    f"baseline={q['baseline'] or '-'} candidate={q['candidate'] or '-'}"
+                )
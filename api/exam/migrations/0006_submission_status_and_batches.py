@@ -0,0 +1,86 @@
+# Generated by Django 4.2 on 2026-10-18 18:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+def mark_existing_graded(apps, schema_editor):
+    # Các bài nộp trước khi có status đều đã được chấm xong
+    PaperSubmission = apps.get_model("exam", "PaperSubmission")
+    PaperSubmission.objects.update(status="graded")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("exam", "0005_rename_answerdetected_paperanswerdetected_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="source_name",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="papersubmission",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("processing", "Processing"),
+                    ("graded", "Graded"),
+                    ("failed", "Failed"),
+                ],
+                default="queued",
+                max_length=20,
+            ),
+        ),
+        migrations.CreateModel(
+            name="PaperSubmissionBatch",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4,
+                        editable=False,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("total_sheets", models.IntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "test",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="batches",
+                        to="exam.papertest",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="submission_batches",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="papersubmission",
+            name="batch",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="submissions",
+                to="exam.papersubmissionbatch",
+            ),
+        ),
+        migrations.RunPython(mark_existing_graded, migrations.RunPython.noop),
+    ]
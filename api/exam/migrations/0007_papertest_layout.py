@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0006_submission_status_and_batches"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papertest",
+            name="layout",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0007_papertest_layout"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="fill_matrix",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
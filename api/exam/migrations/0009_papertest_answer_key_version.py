@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0008_papersubmission_fill_matrix"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papertest",
+            name="answer_key_version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-18 18:32
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicate_answers(apps, schema_editor):
+    # Giữ bản ghi mới nhất cho mỗi (submission, question) trước khi thêm ràng buộc
+    for model_name in ("PaperAnswerDetected", "PaperUserAnswer"):
+        model = apps.get_model("exam", model_name)
+        keep_ids = (
+            model.objects.values("submission", "question")
+            .annotate(keep_id=Max("id"))
+            .values_list("keep_id", flat=True)
+        )
+        model.objects.exclude(id__in=list(keep_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0009_papertest_answer_key_version"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_answers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="paperanswerdetected",
+            constraint=models.UniqueConstraint(
+                fields=("submission", "question"),
+                name="unique_detected_answer_per_question",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="paperuseranswer",
+            constraint=models.UniqueConstraint(
+                fields=("submission", "question"),
+                name="unique_user_answer_per_question",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0010_unique_answer_per_question"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="debug_artifacts",
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="papertest",
+            name="omr_debug",
+            field=models.BooleanField(default=False),
+        ),
+    ]
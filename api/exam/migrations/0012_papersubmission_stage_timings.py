@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0011_omr_debug_artifacts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="stage_timings",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 18:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0012_papersubmission_stage_timings"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="detection",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-18 18:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0013_papersubmission_detection"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="idempotency_key",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="papersubmission",
+            name="image_sha256",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name="papersubmission",
+            index=models.Index(
+                fields=["test", "image_sha256"], name="submission_test_sha256_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="papersubmission",
+            index=models.Index(
+                fields=["user", "idempotency_key"], name="submission_idempotency_idx"
+            ),
+        ),
+    ]
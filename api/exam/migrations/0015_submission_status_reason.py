@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 18:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0014_submission_dedup"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="status_reason",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name="papersubmission",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "Queued"),
+                    ("processing", "Processing"),
+                    ("graded", "Graded"),
+                    ("failed", "Failed"),
+                    ("rejected", "Rejected"),
+                ],
+                default="queued",
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 19:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0016_student_id_grid"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="paperuseranswer",
+            name="flag",
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AlterField(
+            model_name="paperuseranswer",
+            name="selected_option",
+            field=models.CharField(max_length=26),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0017_user_answer_flag"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name="papersubmission",
+            index=models.Index(
+                fields=["test", "updated_at"], name="submission_test_updated_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="papersubmission",
+            index=models.Index(
+                fields=["batch", "updated_at"], name="submission_batch_updated_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2 on 2026-10-18 19:22
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("exam", "0018_submission_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="papersubmission",
+            name="variant_code",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="papertest",
+            name="num_variants",
+            field=models.PositiveSmallIntegerField(
+                default=0, validators=[django.core.validators.MaxValueValidator(8)]
+            ),
+        ),
+        migrations.CreateModel(
+            name="PaperTestVariant",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("code", models.PositiveSmallIntegerField()),
+                ("seed", models.PositiveIntegerField()),
+                ("question_order", models.JSONField()),
+                ("shuffle_choices", models.BooleanField(default=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "test",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="variants",
+                        to="exam.papertest",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="papertestvariant",
+            constraint=models.UniqueConstraint(
+                fields=("test", "code"), name="unique_variant_code_per_test"
+            ),
+        ),
+    ]
@@ -1,7 +1,10 @@
+import uuid
+from django.core.validators import MaxValueValidator
 from django.db import models
 from users.models import User  
 from classrooms.models import Classroom, Student 
 from cloudinary.models import CloudinaryField 
+from exam.omr_layout import MAX_STUDENT_ID_DIGITS, MAX_VARIANTS
 class PaperTest(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True)
@@ -11,6 +14,11 @@ class PaperTest(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_tests')
     classroom = models.ForeignKey(Classroom, on_delete=models.SET_NULL, null=True, blank=True, related_name='tests')
     created_at = models.DateTimeField(auto_now_add=True)
+    layout = models.JSONField(null=True, blank=True)  # Tọa độ các ô trên phiếu đã in (exam.omr_layout)
+    omr_debug = models.BooleanField(default=False)  # Lưu ảnh trung gian của OMR cho mọi bài nộp
+    answer_key_version = models.PositiveIntegerField(default=0)  # Tăng mỗi khi đáp án thay đổi (exam.grading)
+    student_id_digits = models.PositiveSmallIntegerField(default=0, validators=[MaxValueValidator(MAX_STUDENT_ID_DIGITS)])  # Số chữ số của lưới tô mã học sinh trên phiếu, 0 = không có
+    num_variants = models.PositiveSmallIntegerField(default=0, validators=[MaxValueValidator(MAX_VARIANTS)])  # Số mã đề (PaperTestVariant), 0 = một đề duy nhất
 
     def __str__(self):
         return self.title
@@ -24,7 +32,45 @@ class PaperTestQuestion(models.Model):
     def __str__(self):
         return f"Question {self.id} for {self.test.title}"
 
+class PaperTestVariant(models.Model):
+    """
+    Một mã đề: thứ tự câu hỏi đã xáo và seed sinh hoán vị lựa chọn của từng câu
+    (exam.omr_variants). Câu hỏi không bị sao chép, đáp án của mã đề được suy ra
+    từ đáp án gốc khi biên dịch.
+    """
+    test = models.ForeignKey(PaperTest, on_delete=models.CASCADE, related_name='variants')
+    code = models.PositiveSmallIntegerField()  # 1..num_variants, số được tô trên phiếu
+    seed = models.PositiveIntegerField()
+    question_order = models.JSONField()  # id câu hỏi theo thứ tự in trên đề này
+    shuffle_choices = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['test', 'code'], name='unique_variant_code_per_test'),
+        ]
+
+    def __str__(self):
+        return f"Variant {self.code} of {self.test.title}"
+
+class PaperSubmissionBatch(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    test = models.ForeignKey(PaperTest, on_delete=models.CASCADE, related_name='batches')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='submission_batches')
+    total_sheets = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Batch {self.id} for {self.test.title}"
+
 class PaperSubmission(models.Model):
+    class Status(models.TextChoices):
+        QUEUED = 'queued', 'Queued'
+        PROCESSING = 'processing', 'Processing'
+        GRADED = 'graded', 'Graded'
+        FAILED = 'failed', 'Failed'
+        REJECTED = 'rejected', 'Rejected'
+
     test = models.ForeignKey(PaperTest, on_delete=models.CASCADE, related_name='submissions')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='submissions')
     student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='submissions', null=True, blank=True)
@@ -37,6 +83,27 @@ class PaperSubmission(models.Model):
     )
     submitted_at = models.DateTimeField(auto_now_add=True)
     total_score = models.FloatField(default=0.0)
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.QUEUED)
+    status_reason = models.CharField(max_length=255, blank=True)  # Lý do khi bị từ chối / chấm lỗi, để giáo viên chụp lại
+    batch = models.ForeignKey(PaperSubmissionBatch, on_delete=models.SET_NULL, null=True, blank=True, related_name='submissions')
+    source_name = models.CharField(max_length=255, blank=True)  # Tên file gốc trong batch
+    fill_matrix = models.BinaryField(null=True, blank=True, editable=False)  # Độ tô uint8 (câu hỏi x lựa chọn), xem exam.grading
+    debug_artifacts = models.JSONField(null=True, blank=True)  # URL ảnh debug OMR khi bật chế độ debug
+    stage_timings = models.JSONField(null=True, blank=True)  # Thời gian (ms) từng bước chấm, xem exam.omr_timing
+    detection = models.JSONField(null=True, blank=True)  # Hình học lần đọc OMR để vẽ ảnh đã chấm, xem exam.omr_render
+    student_code = models.CharField(max_length=20, blank=True)  # Mã học sinh đọc được từ phiếu, xem exam.omr_roster
+    image_sha256 = models.CharField(max_length=64, blank=True)  # Hash nội dung ảnh, để bỏ qua ảnh upload trùng
+    idempotency_key = models.CharField(max_length=255, blank=True)  # Header Idempotency-Key của client khi upload
+    updated_at = models.DateTimeField(auto_now=True)  # Lần đổi trạng thái / điểm gần nhất, con trỏ của exam.omr_events
+    variant_code = models.PositiveSmallIntegerField(default=0)  # Mã đề đọc được từ phiếu, 0 = đề gốc (ma trận độ tô theo thứ tự của mã đề)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['test', 'image_sha256'], name='submission_test_sha256_idx'),
+            models.Index(fields=['user', 'idempotency_key'], name='submission_idempotency_idx'),
+            models.Index(fields=['test', 'updated_at'], name='submission_test_updated_idx'),
+            models.Index(fields=['batch', 'updated_at'], name='submission_batch_updated_idx'),
+        ]
 
     def __str__(self):
         return f"Submission by {self.user.username} for {self.test.title}"
@@ -48,13 +115,24 @@ class PaperAnswerDetected(models.Model):
     score = models.FloatField(default=0.0)
     confidence = models.FloatField(default=0.0)  # Confidence score from CV
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['submission', 'question'], name='unique_detected_answer_per_question'),
+        ]
+
     def __str__(self):
         return f"Answer for question {self.question.id} in submission {self.submission.id}"
 
 class PaperUserAnswer(models.Model):
     submission = models.ForeignKey(PaperSubmission, on_delete=models.CASCADE, related_name='user_answers')
     question = models.ForeignKey(PaperTestQuestion, on_delete=models.CASCADE, related_name='user_answers')
-    selected_option = models.CharField(max_length=10)  # Lưu một lựa chọn duy nhất
+    selected_option = models.CharField(max_length=26)  # Các lựa chọn đã tô, ví dụ "A" hoặc "AC"
+    flag = models.CharField(max_length=10, blank=True)  # '', 'blank' hoặc 'multiple' (tô nhiều ô ở bài một đáp án)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['submission', 'question'], name='unique_user_answer_per_question'),
+        ]
      
     def __str__(self):
         return f"User's answer to question {self.question.id} in submission {self.submission.id}"
\ No newline at end of file
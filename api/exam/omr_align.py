@@ -0,0 +1,145 @@
+"""
+Căn chỉnh ảnh chụp phiếu trả lời về tọa độ của layout.
+
+Tìm 4 marker đen ở góc trên ảnh đã thu nhỏ, rồi tính homography để warp
+ảnh gốc về đúng trang giấy trong một bước. Dùng adaptive threshold nên ít
+bị ảnh hưởng bởi ánh sáng không đều.
+"""
+import cv2
+import numpy as np
+
+DETECT_LONG_SIDE = 800  # Cạnh dài của ảnh dùng để dò marker
+MIN_WARP_SCALE = 1.0  # pixel / point của ảnh sau khi warp
+MAX_WARP_SCALE = 3.0
+
+
+def _odd(n):
+    return n + 1 if n % 2 == 0 else n
+
+
+def downscale(image, long_side=DETECT_LONG_SIDE):
+    """
+    Thu nhỏ `image` để cạnh dài không quá `long_side`.
+    Trả về (ảnh nhỏ, tỷ lệ); tọa độ trên ảnh nhỏ chia cho tỷ lệ là tọa độ ảnh gốc.
+    """
+    scale = min(1.0, long_side / max(image.shape[:2]))
+    if scale >= 1:
+        return image, 1.0
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+
+def find_fiducials(gray):
+    """
+    Tâm 4 marker (trên trái, trên phải, dưới phải, dưới trái) theo pixel của
+    ảnh gốc, hoặc None nếu không tìm thấy.
+    """
+    small, scale = downscale(gray)
+
+    block = _odd(max(small.shape[:2]) // 15)
+    binary = cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                   cv2.THRESH_BINARY_INV, block, 10)
+    cnts, _ = cv2.findContours(binary, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+
+    min_side = min(small.shape[:2])
+    min_area, max_area = (min_side / 100) ** 2, (min_side / 8) ** 2
+    candidates = []
+    for c in cnts:
+        area = cv2.contourArea(c)
+        if not min_area <= area <= max_area:
+            continue
+        peri = cv2.arcLength(c, True)
+        approx = cv2.approxPolyDP(c, 0.05 * peri, True)
+        if len(approx) != 4 or not cv2.isContourConvex(approx):
+            continue
+        x, y, w, h = cv2.boundingRect(approx)
+        if not 0.7 <= w / float(h) <= 1.3:
+            continue
+        # Marker là ô đặc, khác với ô trả lời rỗng chỉ có viền
+        if cv2.countNonZero(binary[y:y + h, x:x + w]) < 0.75 * w * h:
+            continue
+        # và nằm trên nền giấy trắng: vùng xung quanh gần như không có pixel tối
+        x0, y0 = max(x - w // 2, 0), max(y - h // 2, 0)
+        x1, y1 = min(x + w + w // 2, binary.shape[1]), min(y + h + h // 2, binary.shape[0])
+        ring = cv2.countNonZero(binary[y0:y1, x0:x1]) - cv2.countNonZero(binary[y:y + h, x:x + w])
+        if ring > 0.15 * ((x1 - x0) * (y1 - y0) - w * h):
+            continue
+        m = cv2.moments(c)
+        if m['m00'] == 0:
+            continue
+        candidates.append((area, m['m10'] / m['m00'], m['m01'] / m['m00']))
+
+    if len(candidates) < 4:
+        return None
+
+    # Marker to hơn các ô trả lời đã tô, chỉ giữ các ứng viên lớn nhất
+    candidates.sort(reverse=True)
+    top_area = candidates[3][0]
+    points = np.array([(cx, cy) for area, cx, cy in candidates if area >= 0.5 * top_area])
+    if len(points) < 4:
+        return None
+
+    s, d = points.sum(axis=1), points[:, 0] - points[:, 1]
+    corners = np.array([
+        points[np.argmin(s)],  # trên trái
+        points[np.argmax(d)],  # trên phải
+        points[np.argmax(s)],  # dưới phải
+        points[np.argmin(d)],  # dưới trái
+    ], dtype=np.float32)
+    if len({tuple(p) for p in corners}) != 4:
+        return None
+    if cv2.contourArea(corners) < 0.1 * small.shape[0] * small.shape[1]:
+        return None
+
+    return corners / scale
+
+
+def marker_centers(layout):
+    return np.array([[x + w / 2, y + h / 2] for x, y, w, h in layout['markers']], dtype=np.float32)
+
+
+def layout_transform(corners, layout):
+    """
+    Homography (3x3) và kích thước (w, h) của ảnh warp để 4 marker `corners`
+    trùng với vị trí trong layout. Ảnh kết quả là cả trang giấy, độ phân giải
+    xấp xỉ độ phân giải của trang trong ảnh chụp.
+    """
+    page_w, page_h = layout['page_size']
+    template = marker_centers(layout)
+
+    # Giữ độ phân giải gần với ảnh gốc để đọc ô ở full resolution
+    detected_width = np.linalg.norm(corners[1] - corners[0])
+    template_width = np.linalg.norm(template[1] - template[0])
+    scale = float(np.clip(detected_width / template_width, MIN_WARP_SCALE, MAX_WARP_SCALE))
+
+    matrix = cv2.getPerspectiveTransform(corners.astype(np.float32), template * scale)
+    return matrix, (int(round(page_w * scale)), int(round(page_h * scale)))
+
+
+def order_corners(points):
+    """Sắp 4 điểm theo thứ tự trên trái, trên phải, dưới phải, dưới trái"""
+    points = np.asarray(points, dtype=np.float32).reshape(4, 2)
+    s, d = points.sum(axis=1), points[:, 0] - points[:, 1]
+    return np.array([points[np.argmin(s)], points[np.argmax(d)], points[np.argmax(s)], points[np.argmin(d)]])
+
+
+def page_transform(corners):
+    """
+    Homography và kích thước ảnh warp 4 góc tờ giấy `corners` thành hình chữ
+    nhật (cho phiếu không có marker), kích thước theo cạnh dài nhất của tờ giấy.
+    """
+    tl, tr, br, bl = order_corners(corners)
+    width = int(max(np.linalg.norm(br - bl), np.linalg.norm(tr - tl)))
+    height = int(max(np.linalg.norm(tr - br), np.linalg.norm(tl - bl)))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(np.array([tl, tr, br, bl]), target)
+    return matrix, (width, height)
+
+
+def warp_page(image, matrix, size):
+    return cv2.warpPerspective(image, matrix, size, flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+
+
+def warp_to_layout(image, corners, layout):
+    """Warp `image` để 4 marker trùng với vị trí trong layout"""
+    return warp_page(image, *layout_transform(corners, layout))
@@ -0,0 +1,147 @@
+"""
+Luồng server-sent events báo trạng thái chấm bài, thay cho polling.
+
+Mỗi lần một PaperSubmission đổi trạng thái hoặc điểm, updated_at (auto_now, có
+index cùng test / batch) thay đổi. Luồng SSE giữ một con trỏ thời gian và cứ
+OMR_EVENTS_POLL_SECONDS lại chạy một query theo index lấy các bài mới đổi,
+thay vì client query lại toàn bộ kết quả:
+
+    event: graded
+    id: 2026-10-18T08:30:12.123456+00:00
+    data: {"submission_id": 12, "status": "graded", "score": 8.5, ...}
+
+Tên event là trạng thái của bài (processing, graded, rejected, failed, queued).
+`id` là con trỏ: EventSource tự gửi lại qua header Last-Event-ID khi kết nối
+lại, luồng tiếp tục từ đó. Mỗi kết nối kéo dài tối đa OMR_EVENTS_MAX_SECONDS
+rồi đóng (kèm dòng `id:` cuối cùng), client kết nối lại.
+
+Luồng là async generator (asyncio.sleep, ORM async) nên phải chạy bằng ASGI
+app (uvicorn api.asgi:application): StreamingHttpResponse gửi từng sự kiện
+mà không giữ thread nào giữa các lần quét. Dưới WSGI, Django phải đọc hết
+iterator async trước khi trả response, nên mỗi kết nối chỉ quét một lần rồi
+đóng (streams_live) và EventSource kết nối lại sau RETRY_MS như polling,
+không giữ gunicorn worker.
+
+Transaction ghi updated_at có thể commit chậm hơn một bài đã gửi, nên mỗi lần
+quét lùi lại EVENT_OVERLAP và bỏ các sự kiện đã gửi. Sau khi kết nối lại, một
+vài sự kiện cuối có thể bị gửi lại; client nên coi sự kiện là trạng thái mới
+nhất của bài chứ không phải một lần thay đổi.
+"""
+import asyncio
+import json
+import time
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.renderers import BaseRenderer
+
+from exam.models import PaperSubmission
+
+EVENT_OVERLAP = timedelta(seconds=5)
+# Dòng comment giữ kết nối qua proxy khi không có sự kiện
+HEARTBEAT_SECONDS = 15
+# Client kết nối lại sau bao lâu (ms) khi luồng đóng
+RETRY_MS = 1000
+
+DONE_STATUSES = (PaperSubmission.Status.GRADED, PaperSubmission.Status.FAILED, PaperSubmission.Status.REJECTED)
+
+_EVENT_FIELDS = ('id', 'status', 'status_reason', 'total_score', 'student_id', 'student_code',
+                 'source_name', 'batch_id', 'updated_at')
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Cho DRF chấp nhận Accept: text/event-stream; lỗi được trả về dạng JSON"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode() if data is not None else b''
+
+
+def streams_live(request):
+    """True nếu request được phục vụ bởi ASGI app, luồng SSE giữ kết nối được"""
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+def parse_cursor(value):
+    """Con trỏ từ Last-Event-ID / ?last_event_id=, None nếu không hợp lệ"""
+    if not value:
+        return None
+    try:
+        cursor = parse_datetime(value)
+    except ValueError:
+        return None
+    if cursor is not None and timezone.is_naive(cursor):
+        cursor = timezone.make_aware(cursor, dt_timezone.utc)
+    return cursor
+
+
+def _format_event(row):
+    status_value = row['status']
+    data = {
+        'submission_id': row['id'],
+        'status': status_value,
+        'score': row['total_score'] if status_value == PaperSubmission.Status.GRADED else None,
+        'reason': row['status_reason'],
+        'student': row['student_id'],
+        'student_code': row['student_code'],
+        'filename': row['source_name'],
+        'batch_id': str(row['batch_id']) if row['batch_id'] else None,
+    }
+    return f"event: {status_value}\nid: {row['updated_at'].isoformat()}\ndata: {json.dumps(data)}\n\n"
+
+
+async def submission_events(submissions, cursor=None, batch=None, live=True):
+    """
+    Async generator các sự kiện SSE của queryset `submissions`, bắt đầu sau
+    `cursor` (None: từ đầu). Với `batch`, luồng kết thúc bằng sự kiện "done"
+    khi mọi tờ trong batch đã chấm xong. live=False: chỉ quét một lần rồi đóng.
+    """
+    deadline = time.monotonic() + (settings.OMR_EVENTS_MAX_SECONDS if live else 0)
+    sent = {}
+    last_write = time.monotonic()
+    yield f"retry: {RETRY_MS}\n\n"
+
+    while True:
+        rows = submissions
+        if cursor is not None:
+            rows = rows.filter(updated_at__gte=cursor - EVENT_OVERLAP)
+        async for row in rows.order_by('updated_at', 'id').values(*_EVENT_FIELDS):
+            if sent.get(row['id']) == row['updated_at']:
+                continue
+            sent[row['id']] = row['updated_at']
+            cursor = row['updated_at'] if cursor is None else max(cursor, row['updated_at'])
+            last_write = time.monotonic()
+            yield _format_event(row)
+        if cursor is not None:
+            # Chỉ cần nhớ các sự kiện còn nằm trong cửa sổ quét lại
+            sent = {pk: at for pk, at in sent.items() if at >= cursor - EVENT_OVERLAP}
+
+        if batch is not None:
+            done = await submissions.filter(status__in=DONE_STATUSES).acount()
+            if done >= batch.total_sheets:
+                yield f"event: done\ndata: {json.dumps({'batch_id': str(batch.id), 'completed': done})}\n\n"
+                return
+
+        if time.monotonic() >= deadline:
+            # Con trỏ cho lần kết nối lại, kể cả khi kết nối này không có sự kiện nào
+            if cursor is not None:
+                yield f"id: {cursor.isoformat()}\n\n"
+            return
+        if time.monotonic() - last_write >= HEARTBEAT_SECONDS:
+            last_write = time.monotonic()
+            yield ": keep-alive\n\n"
+        await asyncio.sleep(settings.OMR_EVENTS_POLL_SECONDS)
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Không để nginx gom buffer các sự kiện
+    response['X-Accel-Buffering'] = 'no'
+    return response
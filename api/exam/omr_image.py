@@ -0,0 +1,128 @@
+"""
+Giải mã ảnh bài nộp với bộ nhớ có giới hạn.
+
+Kích thước ảnh được đọc từ header (PIL, chưa giải mã pixel) trước. Ảnh vượt
+OMR_MAX_PIXELS bị từ chối ngay. Ảnh lớn hơn OMR_TARGET_LONG_SIDE được giải mã
+thẳng ở độ phân giải giảm (IMREAD_REDUCED_*: với JPEG libjpeg scale ngay khi
+giải mã nên không tạo bản full-size), phần còn lại được resize. Ảnh trả về đã
+xoay theo EXIF orientation.
+
+Sau bước này mọi ảnh trong một job chấm có cạnh dài <= OMR_TARGET_LONG_SIDE,
+nên bộ nhớ đỉnh của một job có thể ước lượng trước (estimate_job_memory).
+"""
+import warnings
+from io import BytesIO
+
+import cv2
+import numpy as np
+from django.conf import settings
+from PIL import Image, UnidentifiedImageError
+
+EXIF_ORIENTATION = 0x0112
+
+# Ảnh trang đã warp + ảnh xám, nhị phân và integral image (int32) khi đọc ô
+PAGE_BYTES_PER_PIXEL = 10
+
+_REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+_REDUCED_GRAY_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+class ImageRejected(ValueError):
+    """Ảnh không đọc được hoặc vượt giới hạn kích thước."""
+
+
+def read_image_header(image_bytes):
+    """(width, height, EXIF orientation) đọc từ header, không giải mã pixel"""
+    try:
+        with warnings.catch_warnings():
+            # Giới hạn là OMR_MAX_PIXELS (check_image_size), không phải cảnh báo của PIL
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(BytesIO(image_bytes)) as img:
+                width, height = img.size
+                orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    except Image.DecompressionBombError:
+        # Header trên ~179 MP: PIL từ chối trước cả khi trả về kích thước
+        raise ImageRejected(f"Image is too large, the limit is {settings.OMR_MAX_PIXELS / 1e6:.1f} MP")
+    except (UnidentifiedImageError, OSError) as e:
+        raise ImageRejected(f"Không thể đọc ảnh bài nộp: {e}")
+    return width, height, orientation
+
+
+def check_image_size(image_bytes):
+    """Raise ImageRejected nếu ảnh vượt OMR_MAX_PIXELS. Trả về header."""
+    width, height, orientation = read_image_header(image_bytes)
+    if width * height > settings.OMR_MAX_PIXELS:
+        raise ImageRejected(
+            f"Image is {width}x{height} ({width * height / 1e6:.1f} MP), "
+            f"the limit is {settings.OMR_MAX_PIXELS / 1e6:.1f} MP"
+        )
+    return width, height, orientation
+
+
+def reduction_factor(width, height, long_side):
+    """Hệ số giảm lớn nhất (1, 2, 4, 8) mà cạnh dài vẫn >= long_side"""
+    for factor in (8, 4, 2):
+        if max(width, height) / factor >= long_side:
+            return factor
+    return 1
+
+
+def apply_orientation(image, orientation):
+    """Xoay / lật ảnh theo EXIF orientation (1-8) để ảnh đứng đúng chiều"""
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return image
+
+
+def load_image(image_bytes, long_side=None, gray=False):
+    """
+    Giải mã ảnh BGR (ảnh xám nếu gray=True) từ bytes, cạnh dài không quá
+    `long_side` (mặc định OMR_TARGET_LONG_SIDE), đã xoay theo EXIF.
+    """
+    long_side = long_side or settings.OMR_TARGET_LONG_SIDE
+    width, height, orientation = check_image_size(image_bytes)
+
+    # Tự xoay theo EXIF bên dưới, để OpenCV và PIL không xoay hai lần
+    flags = (_REDUCED_GRAY_FLAGS if gray else _REDUCED_FLAGS)[reduction_factor(width, height, long_side)]
+    flags |= cv2.IMREAD_IGNORE_ORIENTATION
+    data = np.frombuffer(memoryview(image_bytes), dtype=np.uint8)
+    image = cv2.imdecode(data, flags)
+    if image is None:
+        raise ImageRejected("Không thể giải mã ảnh bài nộp")
+
+    scale = long_side / max(image.shape[:2])
+    if scale < 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return apply_orientation(image, orientation)
+
+
+def estimate_job_memory(long_side=None):
+    """
+    Bộ nhớ đỉnh (bytes) ước lượng của một job chấm: ảnh BGR đã giải mã và
+    trang đã warp cùng các ảnh trung gian, cả hai không lớn hơn long_side².
+    """
+    long_side = long_side or settings.OMR_TARGET_LONG_SIDE
+    pixels = long_side * long_side
+    return pixels * 3 + pixels * PAGE_BYTES_PER_PIXEL
@@ -0,0 +1,298 @@
+"""
+Bố cục phiếu trả lời (layout template).
+
+Cùng một layout được dùng để vẽ PDF trong preview_test_pdf và để chấm bài:
+process_omr_sheet đọc độ tô tại đúng tọa độ các ô đã vẽ, không cần dò
+contour từng ô nữa.
+
+Tọa độ trong layout tính bằng point (1/72 inch), gốc ở góc trên bên trái
+trang giấy, mỗi ô là [x, y, w, h]. Câu hỏi được xếp theo cột (column), mỗi cột
+chia thành các khối (block) BLOCK_ROWS dòng (row); khoảng cách giữa các ô được
+thu nhỏ dần cho tới khi đủ chỗ cho MAX_QUESTIONS câu trên một trang. Bốn ô vuông đen ở góc trang (markers) dùng
+để căn chỉnh ảnh chụp về đúng tọa độ layout (xem exam.omr_align).
+
+Phiếu có thể kèm lưới tô mã học sinh (student_id_digits cột x 10 chữ số) ở
+góc trên bên phải, được đọc cùng lượt với các câu hỏi (xem exam.omr_roster).
+Bài có nhiều mã đề (exam.omr_variants) có thêm một hàng ô tô mã đề 1..N ở
+phần đầu phiếu, dưới dòng họ tên.
+"""
+import numpy as np
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+
+LAYOUT_VERSION = 4
+
+MARGIN = 2 * cm
+BUBBLE_SIZE = 0.35 * cm
+CHOICE_SPACING = 0.9 * cm
+LINE_SPACING = 0.9 * cm
+NUMBER_WIDTH = 0.6 * cm
+HEADER_HEIGHT = 3 * cm  # Tiêu đề + dòng họ tên, lớp
+COLUMN_GAP = 0.6 * cm  # Khoảng cách giữa các cột câu hỏi
+COLUMN_HEADER_HEIGHT = 0.5 * cm  # Dòng chữ A B C D phía trên mỗi cột
+BLOCK_ROWS = 5  # Số câu mỗi khối
+BLOCK_GAP = 0.5  # Khoảng trống giữa hai khối, tính theo khoảng cách dòng
+SPACING_SCALES = (1.0, 0.9, 0.8, 0.7, 0.6)  # Hệ số thu nhỏ khoảng cách ô khi không đủ chỗ
+MARKER_SIZE = 0.6 * cm
+MARKER_OFFSET = 1 * cm  # Khoảng cách từ mép giấy tới marker
+
+STUDENT_ID_SPACING = 0.55 * cm  # Khoảng cách giữa các ô của lưới mã học sinh
+STUDENT_ID_LABEL_HEIGHT = 1.2 * cm  # Dòng "Mã học sinh" + ô viết tay phía trên lưới
+
+VARIANT_CODE_Y = 2.05 * cm  # Tâm hàng ô mã đề, tính từ lề trên (giữa dòng họ tên và câu 1)
+VARIANT_CODE_LABEL_WIDTH = 1.6 * cm  # Chữ "Mã đề:" bên trái hàng ô
+VARIANT_CODE_SPACING = 0.9 * cm  # Khoảng cách giữa các ô mã đề (chừa chỗ cho số bên trái mỗi ô)
+
+MAX_QUESTIONS = 120
+MAX_STUDENT_ID_DIGITS = 10
+MAX_VARIANTS = 8
+
+
+def _column_rows(width, height, num_choices, scale, id_grid):
+    """
+    Vị trí các dòng câu hỏi có thể đặt với khoảng cách ô nhân `scale`:
+    danh sách cột, mỗi cột là [(x, y tâm dòng, block trong cột, row trong block), ...].
+    Cột nằm dưới lưới mã học sinh bắt đầu từ dưới lưới.
+    """
+    line = LINE_SPACING * scale
+    column_width = NUMBER_WIDTH + num_choices * CHOICE_SPACING * scale
+    top = MARGIN + HEADER_HEIGHT - COLUMN_HEADER_HEIGHT
+    bottom = height - MARGIN
+
+    columns = []
+    x = MARGIN
+    while x + column_width <= width - MARGIN:
+        column_top = top
+        if id_grid and x + column_width > id_grid['x'] - COLUMN_GAP:
+            column_top = id_grid['columns'][0][-1][1] + BUBBLE_SIZE + COLUMN_GAP
+        rows = []
+        k = 0
+        while True:
+            y = column_top + COLUMN_HEADER_HEIGHT + k * line + (k // BLOCK_ROWS) * BLOCK_GAP * line
+            if y + BUBBLE_SIZE / 2 > bottom:
+                break
+            rows.append((x, y, k // BLOCK_ROWS, k % BLOCK_ROWS))
+            k += 1
+        # Chỉ dùng các khối đủ BLOCK_ROWS dòng
+        columns.append(rows[:len(rows) - len(rows) % BLOCK_ROWS])
+        x += column_width + COLUMN_GAP
+    return columns
+
+
+def build_sheet_layout(num_questions, num_choices, multiple_choice=True, student_id_digits=0, num_variants=0):
+    width, height = A4
+    id_grid = build_student_id_grid(width, student_id_digits) if student_id_digits else None
+
+    # Khoảng cách ô lớn nhất mà vẫn đủ chỗ cho mọi câu hỏi
+    for scale in SPACING_SCALES:
+        columns = _column_rows(width, height, num_choices, scale, id_grid)
+        if sum(len(rows) for rows in columns) >= num_questions:
+            break
+    else:
+        raise ValueError(f"{num_questions} câu hỏi x {num_choices} lựa chọn không vừa một trang phiếu")
+
+    # Đánh số theo cột: hết cột trái mới sang cột kế tiếp
+    slots = [(c, row) for c, rows in enumerate(columns) for row in rows]
+    questions = []
+    block_offset, last_column = 0, 0
+    for q_num, (column, (x, y, block, row)) in zip(range(1, num_questions + 1), slots):
+        if column != last_column:
+            block_offset = questions[-1]['block'] + 1
+            last_column = column
+        x_choices = x + NUMBER_WIDTH
+        choices = []
+        for _ in range(num_choices):
+            choices.append([x_choices, y - BUBBLE_SIZE / 2, BUBBLE_SIZE, BUBBLE_SIZE])
+            x_choices += CHOICE_SPACING * scale
+        questions.append({
+            'number': q_num, 'column': column, 'block': block_offset + block, 'row': row,
+            'x': x, 'y': y, 'choices': choices,
+        })
+
+    # Marker theo thứ tự: trên trái, trên phải, dưới phải, dưới trái
+    near, far_x, far_y = MARKER_OFFSET, width - MARKER_OFFSET - MARKER_SIZE, height - MARKER_OFFSET - MARKER_SIZE
+    markers = [
+        [near, near, MARKER_SIZE, MARKER_SIZE],
+        [far_x, near, MARKER_SIZE, MARKER_SIZE],
+        [far_x, far_y, MARKER_SIZE, MARKER_SIZE],
+        [near, far_y, MARKER_SIZE, MARKER_SIZE],
+    ]
+
+    layout = {
+        'version': LAYOUT_VERSION,
+        'page_size': [width, height],
+        'margin': MARGIN,
+        'markers': markers,
+        'bubble_size': BUBBLE_SIZE,
+        'shape': 'square' if multiple_choice else 'circle',
+        'num_choices': num_choices,
+        'spacing_scale': scale,
+        'questions': questions,
+    }
+    if id_grid:
+        layout['student_id'] = id_grid
+    if num_variants:
+        layout['variant_code'] = build_variant_code_row(num_variants)
+    return layout
+
+
+def build_student_id_grid(page_width, digits):
+    """
+    Lưới tô mã học sinh ở góc trên bên phải, ngang với câu 1:
+    `columns[c][d]` là ô của chữ số d ở vị trí thứ c (từ trái sang).
+    """
+    x0 = page_width - MARGIN - digits * STUDENT_ID_SPACING
+    y0 = MARGIN + HEADER_HEIGHT - BUBBLE_SIZE / 2
+    first_row = y0 + STUDENT_ID_LABEL_HEIGHT
+    columns = [
+        [[x0 + c * STUDENT_ID_SPACING, first_row + d * STUDENT_ID_SPACING, BUBBLE_SIZE, BUBBLE_SIZE]
+         for d in range(10)]
+        for c in range(digits)
+    ]
+    return {'x': x0, 'y': y0, 'digits': digits, 'columns': columns}
+
+
+def build_variant_code_row(count):
+    """Hàng ô tô mã đề: `choices[i]` là ô của mã đề i + 1"""
+    x0 = MARGIN + VARIANT_CODE_LABEL_WIDTH
+    y = MARGIN + VARIANT_CODE_Y
+    choices = [[x0 + i * VARIANT_CODE_SPACING, y - BUBBLE_SIZE / 2, BUBBLE_SIZE, BUBBLE_SIZE] for i in range(count)]
+    return {'x': MARGIN, 'y': y, 'count': count, 'choices': choices}
+
+
+def layout_for_test(test):
+    return build_sheet_layout(test.num_questions, test.num_choices, test.allow_multiple_answers,
+                              getattr(test, 'student_id_digits', 0), getattr(test, 'num_variants', 0))
+
+
+def draw_sheet(p, layout, test_name, font_name):
+    """Vẽ phiếu trả lời lên canvas reportlab `p` theo layout"""
+    width, height = layout['page_size']
+    bubble_size = layout['bubble_size']
+
+    # --- 4 marker ở góc để căn chỉnh ảnh ---
+    p.setFillColorRGB(0, 0, 0)
+    for x, y, w, h in layout.get('markers', []):
+        p.rect(x, height - y - h, w, h, stroke=0, fill=1)
+
+    # --- Tiêu đề ---
+    current_y = height - MARGIN
+    p.setFont(font_name, 12)
+    p.drawCentredString(width / 2, current_y, test_name.upper())
+    current_y -= 1.5 * cm
+
+    # --- Họ tên và lớp ---
+    p.setFont(font_name, 10)
+    p.drawString(MARGIN, current_y, "Họ và tên: ___________________________")
+    p.drawString(width / 2 + 3 * cm, current_y, "Lớp: ________________")
+
+    if layout.get('student_id'):
+        draw_student_id_grid(p, layout, font_name)
+    if layout.get('variant_code'):
+        draw_variant_code_row(p, layout, font_name)
+
+    # --- Câu hỏi ---
+    p.setFillColorRGB(0, 0, 0)
+    column = None
+    for question in layout['questions']:
+        y = height - question['y']
+        if question.get('column', 0) != column:
+            # Chữ cái lựa chọn in một lần ở đầu mỗi cột
+            column = question.get('column', 0)
+            p.setFont(font_name, 8)
+            for i, (x, _, _, _) in enumerate(question['choices']):
+                p.drawCentredString(x + bubble_size / 2, y + bubble_size / 2 + 0.15 * cm, chr(65 + i))
+        p.setFont("Helvetica-Bold", 9)
+        p.drawString(question['x'], y - 0.1 * cm, f"{question['number']}")
+        for x, _, _, _ in question['choices']:
+            p.setLineWidth(1.5)
+            if layout['shape'] == 'square':
+                p.rect(x, y - bubble_size / 2, bubble_size, bubble_size, fill=0)
+            else:
+                p.circle(x + bubble_size / 2, y, bubble_size / 2, fill=0)
+
+
+def draw_student_id_grid(p, layout, font_name):
+    """Lưới mã học sinh: ô viết tay mỗi chữ số, bên dưới là cột ô tô 0-9"""
+    height = layout['page_size'][1]
+    grid = layout['student_id']
+    bubble_size = layout['bubble_size']
+
+    p.setFillColorRGB(0, 0, 0)
+    p.setFont(font_name, 9)
+    p.drawString(grid['x'], height - grid['y'], "Mã học sinh:")
+    for column in grid['columns']:
+        x = column[0][0] - (STUDENT_ID_SPACING - bubble_size) / 2
+        p.setLineWidth(1)
+        p.rect(x, height - grid['y'] - 0.25 * cm - STUDENT_ID_SPACING, STUDENT_ID_SPACING, STUDENT_ID_SPACING, fill=0)
+        for x, y, w, h in column:
+            p.setLineWidth(1.5)
+            p.circle(x + w / 2, height - y - h / 2, w / 2, fill=0)
+
+    # Nhãn chữ số ở bên trái lưới, không in vào trong ô để không bị tính là tô
+    p.setFont(font_name, 7)
+    for d, (x, y, w, h) in enumerate(grid['columns'][0]):
+        p.drawRightString(x - 0.15 * cm, height - y - h / 2 - 0.1 * cm, str(d))
+
+
+def draw_variant_code_row(p, layout, font_name):
+    """Hàng ô mã đề, số của mỗi mã in bên trái ô"""
+    height = layout['page_size'][1]
+    row = layout['variant_code']
+    bubble_size = layout['bubble_size']
+
+    p.setFillColorRGB(0, 0, 0)
+    p.setFont(font_name, 9)
+    p.drawString(row['x'], height - row['y'] - 0.1 * cm, "Mã đề:")
+    p.setFont(font_name, 8)
+    for code, (x, y, w, h) in enumerate(row['choices'], start=1):
+        p.drawRightString(x - 0.12 * cm, height - y - h / 2 - 0.1 * cm, str(code))
+        p.setLineWidth(1.5)
+        p.circle(x + w / 2, height - y - h / 2, bubble_size / 2, fill=0)
+
+
+def _page_rects(boxes, layout, image_shape, inset):
+    """Đổi các ô [x, y, w, h] (point, mảng (..., 4)) sang pixel của ảnh trang đã warp"""
+    page_w, page_h = layout['page_size']
+    img_h, img_w = image_shape[:2]
+
+    x, y, w, h = np.moveaxis(boxes, -1, 0)
+    x, y = x + w * inset, y + h * inset
+    w, h = w * (1 - 2 * inset), h * (1 - 2 * inset)
+    sx, sy = img_w / page_w, img_h / page_h
+
+    rects = np.stack([x * sx, y * sy, np.maximum(w * sx, 1), np.maximum(h * sy, 1)], axis=-1)
+    rects = np.rint(rects).astype(np.int64)
+    # Giữ các ô nằm trong ảnh
+    rects[..., 0] = np.clip(rects[..., 0], 0, img_w - 1)
+    rects[..., 1] = np.clip(rects[..., 1], 0, img_h - 1)
+    rects[..., 2] = np.minimum(rects[..., 2], img_w - rects[..., 0])
+    rects[..., 3] = np.minimum(rects[..., 3], img_h - rects[..., 1])
+    return rects
+
+
+def bubble_rects(layout, image_shape, inset=0.0):
+    """
+    Tọa độ pixel các ô trên ảnh trang giấy đã warp, mảng (câu hỏi, lựa chọn, 4).
+    `inset` thu nhỏ mỗi ô theo tỷ lệ để bỏ qua viền in sẵn.
+    """
+    boxes = np.array([q['choices'] for q in layout['questions']], dtype=np.float64)
+    if boxes.size == 0:
+        return np.zeros((0, layout['num_choices'], 4), dtype=np.int64)
+    return _page_rects(boxes, layout, image_shape, inset)
+
+
+def student_id_rects(layout, image_shape, inset=0.0):
+    """Tọa độ pixel lưới mã học sinh, mảng (chữ số, 10, 4); rỗng nếu phiếu không có lưới"""
+    grid = layout.get('student_id')
+    if not grid:
+        return np.zeros((0, 10, 4), dtype=np.int64)
+    return _page_rects(np.array(grid['columns'], dtype=np.float64), layout, image_shape, inset)
+
+
+def variant_code_rects(layout, image_shape, inset=0.0):
+    """Tọa độ pixel hàng ô mã đề, mảng (số mã đề, 4); rỗng nếu phiếu không có"""
+    row = layout.get('variant_code')
+    if not row:
+        return np.zeros((0, 4), dtype=np.int64)
+    return _page_rects(np.array(row['choices'], dtype=np.float64), layout, image_shape, inset)
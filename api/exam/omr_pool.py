@@ -0,0 +1,197 @@
+"""
+Process pool chạy chấm OMR ngoài web worker.
+
+OpenCV trong process_omr_sheet là việc nặng CPU, chạy bằng thread trong web
+worker sẽ bị GIL chặn và không giới hạn số lượng. Pool này dùng số process cố
+định (mặc định mỗi core một process) và một hàng đợi có giới hạn.
+
+Mỗi web process có một pool riêng, nên khi chạy nhiều gunicorn worker hãy
+chỉnh OMR_WORKERS cho phù hợp với tổng số core.
+
+Ảnh đã giải mã được gửi bằng submit_page qua shared memory (exam.omr_shm),
+tổng dung lượng các segment đang chờ bị giới hạn bởi OMR_SHM_MAX_BYTES.
+
+Một worker chết (hết bộ nhớ với ảnh lớn, OpenCV segfault) làm hỏng cả
+ProcessPoolExecutor: mọi job đang chạy / đang chờ lỗi BrokenProcessPool. Pool
+dựng lại executor ở lần submit sau; người gửi job nên đánh dấu bài lỗi trong
+done callback (xem queue_submission_upload).
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+from exam.omr_shm import attach_image, release, share_image
+
+
+class OMRQueueFull(Exception):
+    """Hàng đợi chấm bài đã đầy, client nên thử lại sau."""
+
+
+def _init_worker():
+    # Process được tạo bằng spawn nên phải tự setup Django
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
+    import django
+    django.setup()
+
+
+def _run_job(func, args):
+    from django.db import connections
+    try:
+        return func(*args)
+    finally:
+        # Không giữ connection DB giữa các job
+        connections.close_all()
+
+
+def _run_page_job(func, descriptor, args):
+    # Ảnh được đọc thẳng trong shared memory, process gửi sẽ unlink segment
+    with attach_image(descriptor) as image:
+        return func(image, *args)
+
+
+class OMRWorkerPool:
+    def __init__(self, max_workers=None, max_queue=None):
+        self.max_workers = max_workers or getattr(settings, 'OMR_WORKERS', None) or os.cpu_count() or 1
+        self.max_queue = max_queue or getattr(settings, 'OMR_QUEUE_SIZE', 200)
+        self._executor = self._new_executor()
+        # Tổng số job đang chạy + đang chờ không vượt quá max_workers + max_queue
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._shutdown = False
+        # Dung lượng shared memory của các ảnh đang chờ / đang chấm
+        self.max_shared_bytes = getattr(settings, 'OMR_SHM_MAX_BYTES', 512 * 1024 * 1024)
+        self._shared_bytes = 0
+        self._shared_cond = threading.Condition()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+        )
+
+    def submit(self, func, *args, block=False, timeout=None):
+        """
+        Đưa một job vào pool. `func` phải là hàm top-level (pickle được).
+        Nếu hàng đợi đầy: raise OMRQueueFull, hoặc chờ khi block=True.
+        Executor hỏng được dựng lại và thử một lần, nếu vẫn hỏng: OMRQueueFull.
+        """
+        if self._shutdown:
+            raise OMRQueueFull("OMR worker pool is shutting down")
+        if not self._slots.acquire(blocking=block, timeout=timeout if block else None):
+            raise OMRQueueFull(f"OMR queue is full ({self.max_queue} sheets waiting)")
+
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._submit_job(func, args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda f: self._release())
+        return future
+
+    def _submit_job(self, func, args):
+        executor = self._executor
+        try:
+            return executor.submit(_run_job, func, args)
+        except BrokenProcessPool:
+            print("OMR worker pool is broken (a worker died), restarting it")
+            self._replace_executor(executor)
+        try:
+            return self._executor.submit(_run_job, func, args)
+        except BrokenProcessPool as e:
+            raise OMRQueueFull(f"OMR worker pool is unavailable: {e}")
+
+    def _replace_executor(self, broken):
+        with self._lock:
+            # Nhiều thread cùng gặp executor hỏng: chỉ dựng lại một lần
+            if self._executor is broken:
+                self._executor = self._new_executor()
+        broken.shutdown(wait=False)
+
+    def submit_page(self, func, image, *args, block=False, timeout=None):
+        """
+        Như submit, nhưng ảnh đã giải mã `image` được chuyển qua shared memory:
+        worker gọi func(image, *args) với view read-only, không pickle pixel.
+        Segment được unlink khi future kết thúc (xong, lỗi hoặc bị hủy).
+        """
+        nbytes = image.nbytes
+        self._reserve_shared(nbytes, block, timeout)
+        try:
+            shm, descriptor = share_image(image)
+        except BaseException:
+            self._release_shared(nbytes)
+            raise
+
+        def cleanup(_future=None):
+            release(shm)
+            self._release_shared(nbytes)
+
+        try:
+            future = self.submit(_run_page_job, func, descriptor, args, block=block, timeout=timeout)
+        except BaseException:
+            cleanup()
+            raise
+        future.add_done_callback(cleanup)
+        return future
+
+    def _reserve_shared(self, nbytes, block, timeout):
+        with self._shared_cond:
+            # Một ảnh lớn hơn cả giới hạn vẫn được nhận khi không còn ảnh nào khác
+            fits = lambda: self._shared_bytes == 0 or self._shared_bytes + nbytes <= self.max_shared_bytes
+            if not (fits() or (block and self._shared_cond.wait_for(fits, timeout))):
+                raise OMRQueueFull(f"OMR shared memory is full ({self._shared_bytes} bytes of images waiting)")
+            self._shared_bytes += nbytes
+
+    def _release_shared(self, nbytes):
+        with self._shared_cond:
+            self._shared_bytes -= nbytes
+            self._shared_cond.notify_all()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    @property
+    def queue_depth(self):
+        """Số job đang chờ (chưa được process nào nhận)."""
+        with self._lock:
+            return max(self._pending - self.max_workers, 0)
+
+    def stats(self):
+        with self._lock:
+            pending = self._pending
+        return {
+            'workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'in_flight': min(pending, self.max_workers),
+            'queue_depth': max(pending - self.max_workers, 0),
+            'shared_bytes': self._shared_bytes,
+        }
+
+    def shutdown(self, wait=True):
+        # Chờ các tờ đang chấm dở hoàn thành trước khi thoát
+        self._shutdown = True
+        self._executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_omr_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = OMRWorkerPool()
+                atexit.register(_pool.shutdown)
+    return _pool
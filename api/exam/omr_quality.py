@@ -0,0 +1,96 @@
+"""
+Kiểm tra nhanh chất lượng ảnh chụp trước khi đưa vào hàng đợi chấm.
+
+Ảnh được giải mã thẳng thành ảnh xám thu nhỏ (IMREAD_REDUCED_GRAYSCALE_*,
+với JPEG libjpeg scale ngay khi giải mã) cỡ ảnh dùng để dò trang trong
+pipeline, rồi đo:
+
+- độ phơi sáng: ảnh quá tối hoặc cháy sáng (mất nét mực) theo histogram,
+- độ phủ: tìm được trang giấy (marker hoặc mép giấy) và trang chiếm đủ khung hình,
+- độ nét: phương sai Laplacian trong vùng trang giấy.
+
+Toàn bộ chạy trong request (vài chục ms), ảnh không đạt bị từ chối với lý do
+để giáo viên chụp lại, không chiếm slot của worker chấm.
+"""
+import cv2
+import numpy as np
+from django.conf import settings
+
+from exam.omr_align import DETECT_LONG_SIDE, downscale, find_fiducials
+from exam.omr_image import _REDUCED_GRAY_FLAGS, ImageRejected, read_image_header, reduction_factor
+
+# Ngưỡng độ sáng (0-255) dùng cho kiểm tra phơi sáng
+DARK_LEVEL = 60  # 99% pixel tối hơn mức này: ảnh quá tối
+WASHED_OUT_LEVEL = 150  # 1% pixel tối nhất vẫn sáng hơn mức này: mực bị cháy sáng
+
+
+def load_thumbnail(image_bytes, long_side=DETECT_LONG_SIDE):
+    """Ảnh xám, cạnh dài không quá `long_side`, giải mã ở độ phân giải giảm"""
+    width, height, _ = read_image_header(image_bytes)
+    flags = _REDUCED_GRAY_FLAGS[reduction_factor(width, height, long_side)] | cv2.IMREAD_IGNORE_ORIENTATION
+    gray = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags)
+    if gray is None:
+        raise ImageRejected("Không thể đọc ảnh bài nộp")
+    return downscale(gray, long_side)[0]
+
+
+def _page_corners(gray, layout):
+    # Cùng cách dò như pipeline chấm: marker nếu phiếu có, không thì mép giấy
+    if layout and layout.get('markers'):
+        corners = find_fiducials(gray)
+        if corners is not None:
+            return corners
+    from exam.views.omr_processing import find_paper
+    try:
+        return find_paper(gray)
+    except ImageRejected:
+        return None
+
+
+def measure_quality(gray, layout=None):
+    """
+    Các chỉ số chất lượng của ảnh xám thu nhỏ:
+    {'dark_level', 'ink_level', 'coverage', 'sharpness'}.
+    coverage và sharpness là None nếu không tìm thấy trang giấy.
+    """
+    cumulative = np.cumsum(cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel())
+    cumulative /= cumulative[-1]
+    metrics = {
+        # Mức sáng mà 99% pixel tối hơn, và mức của 1% pixel tối nhất (nét mực)
+        'dark_level': int(np.searchsorted(cumulative, 0.99)),
+        'ink_level': int(np.searchsorted(cumulative, 0.01)),
+        'coverage': None,
+        'sharpness': None,
+    }
+
+    corners = _page_corners(gray, layout)
+    if corners is None:
+        return metrics
+    quad = corners.astype(np.float32)
+    metrics['coverage'] = round(float(cv2.contourArea(quad)) / (gray.shape[0] * gray.shape[1]), 3)
+
+    # Độ nét chỉ đo trong trang giấy, nền bàn mờ không làm hạ điểm
+    x, y, w, h = cv2.boundingRect(quad)
+    page = gray[max(y, 0):y + h, max(x, 0):x + w]
+    if page.size:
+        metrics['sharpness'] = round(float(cv2.Laplacian(page, cv2.CV_32F).var()), 1)
+    return metrics
+
+
+def check_image_quality(image_bytes, layout=None):
+    """
+    Raise ImageRejected (kèm lý do, để chụp lại) nếu ảnh quá tối, cháy sáng,
+    không thấy trọn trang giấy hoặc bị mờ. Trả về các chỉ số đã đo.
+    """
+    metrics = measure_quality(load_thumbnail(image_bytes), layout)
+    if metrics['dark_level'] < DARK_LEVEL:
+        raise ImageRejected("The photo is too dark, please retake it with more light")
+    if metrics['ink_level'] > WASHED_OUT_LEVEL:
+        raise ImageRejected("The photo is overexposed, please retake it without glare")
+    if metrics['coverage'] is None:
+        raise ImageRejected("The answer sheet was not found, please retake the photo with the whole page visible")
+    if metrics['coverage'] < settings.OMR_MIN_PAGE_COVERAGE:
+        raise ImageRejected("The answer sheet is too small in the photo, please retake it closer")
+    if metrics['sharpness'] is None or metrics['sharpness'] < settings.OMR_MIN_SHARPNESS:
+        raise ImageRejected("The photo is blurry, please retake it and hold the camera still")
+    return metrics
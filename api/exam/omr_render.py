@@ -0,0 +1,121 @@
+"""
+Vẽ ảnh đã chấm khi có người xem, thay vì vẽ và upload lúc chấm.
+
+Lúc chấm chỉ lưu hình học của lần đọc (PaperSubmission.detection): ma trận
+warp, kích thước trang, 4 góc và tọa độ các ô. Đúng/sai của từng câu được
+tính lại từ ma trận độ tô và đáp án hiện tại, nên ảnh luôn khớp với điểm kể cả
+sau khi chấm lại. Ảnh đã vẽ được giữ trong cache LRU giới hạn theo dung lượng.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.urls import reverse
+
+from exam.grading import answer_masks, decode_fill_matrix, get_answer_key, pad_answers, score_answers
+from exam.omr_align import warp_page
+from exam.omr_image import load_image
+
+_render_cache = OrderedDict()
+_render_cache_bytes = 0
+_render_cache_lock = threading.Lock()
+
+
+def can_render(submission):
+    """Bài nộp đã có đủ ảnh gốc và lần đọc để vẽ ảnh đã chấm"""
+    return bool(submission.detection) and submission.fill_matrix is not None and bool(submission.submission_image)
+
+
+def annotated_url(submission, request=None):
+    """URL của SubmissionViewSet.annotated (tuyệt đối nếu có request), None nếu chưa vẽ được"""
+    if not can_render(submission):
+        return None
+    url = reverse('submission-annotated', args=[submission.id])
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def render_annotated(image, detection, selected, key, long_side=None):
+    """
+    Ảnh trang giấy đã warp với các ô đáp án đúng được tô viền: xanh nếu học
+    sinh tô đúng cả câu, đỏ nếu sai. `selected` là bitmask câu trả lời,
+    `image` là ảnh gốc đã giải mã bằng load_image.
+    """
+    # Ảnh gốc được giải mã ở kích thước khác lúc chấm: đổi tọa độ trước khi warp
+    image_w, image_h = detection['image_size']
+    sx, sy = image.shape[1] / image_w, image.shape[0] / image_h
+    matrix = np.array(detection['matrix'], dtype=np.float64) @ np.diag([1 / sx, 1 / sy, 1.0])
+    paper = warp_page(image, matrix, tuple(detection['page_size']))
+
+    thickness = max(int(round(paper.shape[1] / 400)), 2)
+    for q, row in enumerate(detection['bubbles'][:len(key.correct)]):
+        correct = int(key.correct[q])
+        color = (0, 255, 0) if selected[q] == correct else (0, 0, 255)
+        for k, (x, y, w, h) in enumerate(row):
+            if correct >> k & 1:
+                cv2.rectangle(paper, (x, y), (x + w, y + h), color, thickness)
+
+    total_score = float(score_answers(selected, key)[2])
+    font_scale = paper.shape[1] / 1000
+    cv2.putText(paper, f"TOTAL SCORE: {total_score}/10", (10, int(40 * font_scale)),
+                cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 255), max(int(round(2 * font_scale)), 1))
+
+    if long_side and max(paper.shape[:2]) > long_side:
+        scale = long_side / max(paper.shape[:2])
+        paper = cv2.resize(paper, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return paper
+
+
+def _fetch_original(submission):
+    import requests
+
+    response = requests.get(submission.submission_image.url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
+
+class MissingAnswerKey(LookupError):
+    """Mã đề của bài nộp không còn (đã sinh lại mã đề), không có đáp án để vẽ."""
+
+
+def render_submission(submission, long_side):
+    """
+    JPEG ảnh đã chấm của `submission`, cạnh dài không quá `long_side`.
+    Kết quả được cache theo bài nộp, kích thước, phiên bản đáp án và lần đọc.
+    Raise MissingAnswerKey nếu mã đề của bài nộp đã bị thay.
+    """
+    global _render_cache_bytes
+
+    test = submission.test
+    cache_key = (
+        submission.id, long_side, test.answer_key_version,
+        hash(json.dumps(submission.detection['matrix'])),
+    )
+    with _render_cache_lock:
+        jpeg = _render_cache.get(cache_key)
+        if jpeg is not None:
+            _render_cache.move_to_end(cache_key)
+            return jpeg
+
+    # Ma trận độ tô được lưu theo thứ tự in của mã đề, vẽ theo đáp án của mã đề đó
+    key = get_answer_key(test, submission.variant_code)
+    if key is None:
+        # Không vẽ theo đáp án đề gốc: đúng / sai sẽ sai lệch (regrade_test cũng bỏ qua các bài này)
+        raise MissingAnswerKey(f"Version {submission.variant_code} of this test no longer exists")
+    selected = pad_answers(
+        answer_masks(decode_fill_matrix(submission.fill_matrix, test.num_choices)), len(key.question_ids)
+    )
+    image = load_image(_fetch_original(submission))
+    paper = render_annotated(image, submission.detection, selected, key, long_side)
+    jpeg = cv2.imencode('.jpg', paper, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+
+    with _render_cache_lock:
+        if cache_key not in _render_cache:
+            _render_cache[cache_key] = jpeg
+            _render_cache_bytes += len(jpeg)
+        while _render_cache_bytes > settings.OMR_RENDER_CACHE_BYTES and _render_cache:
+            _, evicted = _render_cache.popitem(last=False)
+            _render_cache_bytes -= len(evicted)
+    return jpeg
@@ -0,0 +1,129 @@
+"""
+Chạy lại ảnh bài nộp thật qua hai phiên bản OMR để so sánh.
+
+Corpus là một thư mục do `manage.py omr_export_corpus` tạo:
+
+    manifest.jsonl        mỗi dòng một tờ: submission_id, test_id, image, answers
+    tests/<test_id>.json  layout và đáp án đã biên dịch của bài kiểm tra
+    images/<id>.jpg       ảnh gốc
+
+`answers` là các lựa chọn đã lưu trong PaperUserAnswer (theo thứ tự id câu
+hỏi, ví dụ "A" hoặc "AC", "" là không đọc được), tức kết quả mà production đã chấm.
+
+Một engine là hàm `engine(image_bytes, test, key, timings)` trả về mảng
+bitmask lựa chọn (exam.grading, 0 là bỏ trống) theo thứ tự key.question_ids,
+giống current_engine. `manage.py omr_replay` chạy engine hiện tại và engine ứng
+viên (dotted path) song song trên cùng corpus.
+"""
+import json
+import os
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+from django.utils.module_loading import import_string
+
+from exam.grading import CompiledAnswerKey, MASK_DTYPE, indices_to_masks, letters_to_mask, mask_to_letters
+
+CURRENT_ENGINE = 'exam.omr_replay.current_engine'
+
+
+def current_engine(image_bytes, test, key, timings=None):
+    """Engine đang chạy trên production: load_image + grade_sheet"""
+    from exam.omr_image import load_image
+    from exam.omr_timing import timed
+    from exam.views.omr_processing import grade_sheet
+
+    with timed(timings, 'decode'):
+        image = load_image(image_bytes)
+    return grade_sheet(image, test, timings=timings, key=key).selected
+
+
+def letters_to_masks(letters):
+    return np.array([letters_to_mask(a) for a in letters], dtype=MASK_DTYPE)
+
+
+def masks_to_letters(selected):
+    return [mask_to_letters(mask) for mask in selected]
+
+
+def test_to_json(test, key):
+    return {
+        'id': test.id,
+        'num_questions': test.num_questions,
+        'num_choices': test.num_choices,
+        'allow_multiple_answers': test.allow_multiple_answers,
+        'layout': test.layout,
+        'key': {
+            'format': 'mask',
+            'question_ids': key.question_ids.tolist(),
+            'correct': key.correct.tolist(),
+            'scores': key.scores.tolist(),
+        },
+    }
+
+
+def test_from_json(data):
+    """(test, key) dựng lại từ tests/<id>.json, không cần DB"""
+    correct = np.array(data['key']['correct'])
+    if data['key'].get('format') != 'mask':
+        # Corpus cũ lưu chỉ số lựa chọn (-1 là chưa có đáp án)
+        correct = indices_to_masks(correct)
+    key = CompiledAnswerKey(
+        np.array(data['key']['question_ids'], dtype=np.int64),
+        correct.astype(MASK_DTYPE),
+        np.array(data['key']['scores'], dtype=np.float64),
+    )
+    test = SimpleNamespace(
+        id=data['id'], title=f"Test {data['id']}", layout=data['layout'],
+        num_questions=data['num_questions'], num_choices=data['num_choices'],
+        allow_multiple_answers=data['allow_multiple_answers'],
+    )
+    return test, key
+
+
+def load_corpus(corpus_dir):
+    """(danh sách tờ trong manifest, {test_id: dữ liệu json của bài})"""
+    with open(os.path.join(corpus_dir, 'manifest.jsonl')) as f:
+        sheets = [json.loads(line) for line in f if line.strip()]
+    tests = {}
+    for test_id in {sheet['test_id'] for sheet in sheets}:
+        with open(os.path.join(corpus_dir, 'tests', f'{test_id}.json')) as f:
+            tests[test_id] = json.load(f)
+    return sheets, tests
+
+
+# Engine và bài kiểm tra được cache trong mỗi worker process
+_engines = {}
+_tests = {}
+
+
+def replay_sheet(engine_path, corpus_dir, sheet, test_data):
+    """
+    Chạy một tờ qua engine (trong worker process).
+    Trả về dict: selected, error, ms, peak_bytes (đỉnh tracemalloc), timings.
+    """
+    engine = _engines.get(engine_path)
+    if engine is None:
+        engine = _engines[engine_path] = import_string(engine_path)
+    if sheet['test_id'] not in _tests:
+        _tests[sheet['test_id']] = test_from_json(test_data)
+    test, key = _tests[sheet['test_id']]
+
+    with open(os.path.join(corpus_dir, sheet['image']), 'rb') as f:
+        image_bytes = f.read()
+
+    timings = {}
+    selected, error = None, None
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        selected = np.asarray(engine(image_bytes, test, key, timings), dtype=MASK_DTYPE).tolist()
+    except Exception as e:
+        error = str(e)
+    ms = (time.perf_counter() - start) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'selected': selected, 'error': error, 'ms': round(ms, 3), 'peak_bytes': peak, 'timings': timings}
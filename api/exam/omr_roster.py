@@ -0,0 +1,90 @@
+"""
+Nhận diện học sinh từ lưới tô mã học sinh trên phiếu (exam.omr_layout).
+
+Mã đọc được (Student.student_id) được so với danh sách lớp qua một dict
+student_id -> Student.pk cache trong process, nên chấm cả chồng phiếu không
+phải query học sinh cho từng tờ. Dict được nạp lại khi hết hạn hoặc khi gặp
+mã chưa có (học sinh vừa được thêm vào lớp).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from classrooms.models import Student
+
+# Ô được coi là tô nếu độ tô (0-255) từ mức này trở lên
+STUDENT_ID_FILL_THRESHOLD = 100
+# Cột có ô đậm thứ hai gần bằng ô đậm nhất là tô nhầm hai chữ số
+STUDENT_ID_AMBIGUOUS_RATIO = 0.7
+
+ROSTER_CACHE_SECONDS = 60
+_ROSTER_CACHE_SIZE = 64
+_roster_cache = OrderedDict()
+_roster_cache_lock = threading.Lock()
+
+
+def decode_student_id(fill):
+    """
+    Mã học sinh từ độ tô của lưới (chữ số x 10, uint8). Các cột trống ở cuối
+    được bỏ qua (mã ngắn hơn lưới). Trả về '' nếu không đọc được: cột trống
+    xen giữa, hoặc một cột tô hai chữ số.
+    """
+    if fill.size == 0:
+        return ''
+    order = np.sort(fill, axis=1)
+    best, second = order[:, -1].astype(np.int32), order[:, -2].astype(np.int32)
+    marked = best >= STUDENT_ID_FILL_THRESHOLD
+    if not marked.any():
+        return ''
+
+    length = int(np.flatnonzero(marked)[-1]) + 1
+    if not marked[:length].all():
+        return ''
+    if (second[:length] >= best[:length] * STUDENT_ID_AMBIGUOUS_RATIO).any():
+        return ''
+    return ''.join(str(d) for d in fill[:length].argmax(axis=1))
+
+
+def _roster_scope(test):
+    # Bài gắn với lớp: chỉ học sinh của lớp đó; không thì mọi lớp của giáo viên
+    if test.classroom_id:
+        return ('classroom', test.classroom_id)
+    return ('teacher', test.created_by_id)
+
+
+def _load_roster(scope):
+    kind, scope_id = scope
+    students = Student.objects.filter(**{'classroom_id' if kind == 'classroom' else 'classroom__teacher_id': scope_id})
+    return dict(students.values_list('student_id', 'id'))
+
+
+def roster_index(test, refresh=False):
+    """Dict Student.student_id -> Student.pk của danh sách lớp của `test`"""
+    scope = _roster_scope(test)
+    now = time.monotonic()
+    with _roster_cache_lock:
+        entry = _roster_cache.get(scope)
+        if entry is not None and not refresh and now - entry[0] < ROSTER_CACHE_SECONDS:
+            _roster_cache.move_to_end(scope)
+            return entry[1]
+
+    index = _load_roster(scope)
+    with _roster_cache_lock:
+        _roster_cache[scope] = (now, index)
+        _roster_cache.move_to_end(scope)
+        while len(_roster_cache) > _ROSTER_CACHE_SIZE:
+            _roster_cache.popitem(last=False)
+    return index
+
+
+def match_student(test, student_code):
+    """Student.pk có mã `student_code` trong danh sách lớp của `test`, hoặc None"""
+    if not student_code:
+        return None
+    student_pk = roster_index(test).get(student_code)
+    if student_pk is None:
+        # Có thể học sinh vừa được thêm vào lớp sau lần nạp trước
+        student_pk = roster_index(test, refresh=True).get(student_code)
+    return student_pk
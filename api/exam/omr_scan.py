@@ -0,0 +1,304 @@
+"""
+Quét phiếu liên tục từ camera qua WebSocket (ASGI, xem api/asgi.py).
+
+    ws(s)://<host>/ws/scan/<test_id>/?token=<access token>
+
+Client gửi các khung hình đã thu nhỏ (JPEG, binary message). Mỗi khung được
+giải mã xám ở OMR_SCAN_LONG_SIDE và đọc bằng đúng pipeline chấm (grade_sheet
+với đáp án đã biên dịch của mã đề tô trên tờ), chạy trong thread để không chặn event loop. Bài
+kiểm tra được tải lại cùng mỗi khung, nên sửa đáp án khi đang quét có hiệu lực ngay. Khi
+đang đọc một khung, các khung đến sau chỉ giữ lại khung mới nhất: camera nhanh
+hơn server thì bỏ khung, không xếp hàng.
+
+Server gửi lại JSON:
+
+- {"type": "frame", "found", "stable", "ms"} cho mỗi khung đã đọc,
+- {"type": "result", "answers", "flags", "correct", "score", "student_code",
+  "student", "variant_code", "ms"} (answers theo thứ tự in trên tờ) khi OMR_SCAN_STABLE_FRAMES khung liên tiếp đọc ra cùng một
+  kết quả. Cùng một tờ chỉ được gửi một lần, tờ tiếp theo (kết quả khác, hoặc
+  trang rời khỏi khung hình) được gửi tiếp, như quét mã vạch ở quầy.
+
+Client gửi {"type": "save"} để lưu tờ vừa gửi kết quả thành PaperSubmission
+(ảnh khung hình được chấm lại trong OMR worker pool như upload_submission),
+server trả {"type": "saved", "submission_id", "duplicate"}.
+
+Xác thực bằng access token JWT trong query string `token` hoặc cookie
+`access_token` (như CookieJWTAuthentication). Mã đóng kết nối: 4401 chưa đăng
+nhập, 4404 không có bài kiểm tra (hoặc bài bị xoá khi đang quét). Khung hình
+không đọc được chỉ nhận lại {"type": "error"}, kết nối vẫn mở.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import re
+import time
+from collections import deque
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+
+from exam.grading import get_answer_keys, mask_to_letters
+from exam.models import PaperTest, PaperSubmission, Student
+from exam.omr_image import load_image, ImageRejected
+from exam.omr_pool import OMRQueueFull
+from exam.omr_roster import match_student
+from exam.omr_timing import timed
+
+SCAN_PATH = re.compile(r'^/ws/scan/(?P<test_id>\d+)/?$')
+
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+
+
+def read_frame(frame_bytes, test, timings=None):
+    """SheetResult của một khung hình, hoặc None nếu không thấy trang giấy (hoặc mã đề)"""
+    from exam.views.omr_processing import grade_sheet
+
+    with timed(timings, 'decode'):
+        image = load_image(frame_bytes, long_side=settings.OMR_SCAN_LONG_SIDE, gray=True)
+    try:
+        return grade_sheet(image, test, timings=timings)
+    except ImageRejected:
+        return None
+
+
+def _closing_connections(func):
+    """
+    Dọn kết nối DB trước và sau khi chạy trong thread (như database_sync_to_async
+    của Channels): kết nối WebSocket không đi qua request_finished của Django nên
+    kết nối của thread sẽ không bao giờ được đóng.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+def database_sync_to_async(func):
+    return sync_to_async(_closing_connections(func))
+
+
+@_closing_connections
+def _scan_frame(frame_bytes, test_id):
+    """(bài kiểm tra tải lại từ DB, SheetResult của khung); chạy trong asyncio.to_thread"""
+    test = PaperTest.objects.get(id=test_id)
+    return test, read_frame(frame_bytes, test)
+
+
+class ScanTracker:
+    """Theo dõi kết quả các khung liên tiếp, báo khi một tờ mới đã ổn định"""
+
+    def __init__(self, stable_frames):
+        self.stable_frames = stable_frames
+        self.history = deque(maxlen=stable_frames)
+        self.last_pushed = None
+
+    def update(self, result):
+        """Ghi nhận một khung; trả về True nếu cần gửi kết quả của khung này"""
+        signature = None if result is None else (result.selected.tobytes(), result.student_code)
+        self.history.append(signature)
+        if all(s is None for s in self.history):
+            # Trang đã rời khỏi khung hình: tờ sau giống hệt vẫn được gửi
+            self.last_pushed = None
+            return False
+        if (signature is None or signature == self.last_pushed or len(self.history) < self.stable_frames
+                or any(s != signature for s in self.history)):
+            return False
+        self.last_pushed = signature
+        return True
+
+    @property
+    def stable_count(self):
+        """Số khung cuối liên tiếp đọc ra cùng kết quả"""
+        count = 0
+        for signature in reversed(self.history):
+            if signature is None or signature != self.history[-1]:
+                break
+            count += 1
+        return count
+
+
+def _token_from_scope(scope):
+    token = parse_qs(scope.get('query_string', b'').decode()).get('token', [''])[0]
+    if token:
+        return token
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            cookie = SimpleCookie()
+            cookie.load(value.decode('latin-1'))
+            if 'access_token' in cookie:
+                return cookie['access_token'].value
+    return ''
+
+
+@database_sync_to_async
+def _authenticate(scope):
+    token = _token_from_scope(scope)
+    if not token:
+        return None
+    auth = JWTAuthentication()
+    try:
+        return auth.get_user(auth.get_validated_token(token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+@database_sync_to_async
+def _load_test(test_id, user):
+    test = PaperTest.objects.filter(id=test_id, created_by=user).first()
+    if test is None:
+        return None
+    # Biên dịch sẵn đáp án (mọi mã đề) trước khung hình đầu tiên
+    get_answer_keys(test)
+    return test
+
+
+@database_sync_to_async
+def _result_message(test, result, ms):
+    student = None
+    student_pk = match_student(test, result.student_code)
+    if student_pk is not None:
+        student = Student.objects.filter(pk=student_pk).values('id', 'name', 'student_id').first()
+    return {
+        'type': 'result',
+        'answers': [mask_to_letters(mask) for mask in result.selected],
+        'flags': result.flags.tolist(),
+        'correct': [bool(c) for c in result.is_correct],
+        'score': round(result.total_score, 2),
+        'student_code': result.student_code,
+        'student': student,
+        'variant_code': result.variant_code,
+        'ms': ms,
+    }
+
+
+@database_sync_to_async
+def _save_frame(test, user, frame_bytes, student_code):
+    from exam.views.omr_processing import queue_submission_upload
+    from exam.views.omr_views import find_duplicate_submission
+
+    image_sha256 = hashlib.sha256(frame_bytes).hexdigest()
+    existing = find_duplicate_submission(test, user, image_sha256)
+    if existing is not None:
+        return {'type': 'saved', 'submission_id': existing.id, 'duplicate': True}
+
+    submission = PaperSubmission.objects.create(
+        test=test, user=user, source_name='camera-scan.jpg', image_sha256=image_sha256,
+        student_id=match_student(test, student_code),
+    )
+    try:
+        queue_submission_upload(submission.id, frame_bytes)
+    except OMRQueueFull:
+        submission.delete()
+        raise
+    return {'type': 'saved', 'submission_id': submission.id, 'duplicate': False}
+
+
+async def _send_json(send, data):
+    await send({'type': 'websocket.send', 'text': json.dumps(data)})
+
+
+async def scan_websocket(scope, receive, send, test_id):
+    """ASGI app của một kết nối quét phiếu"""
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+
+    # Chấp nhận trước rồi mới đóng, để client nhận được mã lỗi thay vì HTTP 403
+    await send({'type': 'websocket.accept'})
+    user = await _authenticate(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+    test = await _load_test(test_id, user)
+    if test is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+
+    tracker = ScanTracker(settings.OMR_SCAN_STABLE_FRAMES)
+    state = {'frame': None, 'closed': False, 'pushed_frame': None}
+    wake = asyncio.Event()
+
+    async def handle_command(text):
+        try:
+            command = json.loads(text)
+        except ValueError:
+            command = {}
+        if command.get('type') == 'save':
+            if state['pushed_frame'] is None:
+                await _send_json(send, {'type': 'error', 'error': "No stable sheet to save yet"})
+                return
+            frame_bytes, student_code = state['pushed_frame']
+            state['pushed_frame'] = None
+            try:
+                await _send_json(send, await _save_frame(test, user, frame_bytes, student_code))
+            except Exception as e:
+                await _send_json(send, {'type': 'error', 'error': f"Could not save the sheet: {e}"})
+        else:
+            await _send_json(send, {'type': 'error', 'error': "Unknown command"})
+
+    async def reader():
+        # Chỉ giữ khung mới nhất, khung cũ chưa đọc bị bỏ
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message.get('bytes'):
+                    state['frame'] = message['bytes']
+                    wake.set()
+                elif message.get('text'):
+                    await handle_command(message['text'])
+        finally:
+            state['closed'] = True
+            wake.set()
+
+    reader_task = asyncio.create_task(reader())
+    try:
+        while True:
+            await wake.wait()
+            wake.clear()
+            if state['closed']:
+                break
+            frame_bytes, state['frame'] = state['frame'], None
+            if frame_bytes is None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                test, result = await asyncio.to_thread(_scan_frame, frame_bytes, test.id)
+            except PaperTest.DoesNotExist:
+                await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+                break
+            except ImageRejected as e:
+                await _send_json(send, {'type': 'error', 'error': str(e)})
+                continue
+            except Exception as e:
+                # Một khung lỗi không được làm rớt cả phiên quét
+                print(f"Error reading scan frame for test {test.id}: {e!r}")
+                await _send_json(send, {'type': 'error', 'error': "Could not read the frame"})
+                continue
+            ms = round((time.perf_counter() - start) * 1000, 1)
+
+            if tracker.update(result):
+                state['pushed_frame'] = (frame_bytes, result.student_code)
+                await _send_json(send, await _result_message(test, result, ms))
+            else:
+                await _send_json(send, {
+                    'type': 'frame',
+                    'found': result is not None,
+                    'stable': tracker.stable_count,
+                    'ms': ms,
+                })
+    finally:
+        reader_task.cancel()
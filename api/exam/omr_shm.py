@@ -0,0 +1,74 @@
+"""
+Chuyển ảnh đã giải mã sang process chấm qua shared memory, không pickle pixel.
+
+Gửi một mảng NumPy vài MB qua ProcessPoolExecutor nghĩa là pickle, ghi vào
+pipe rồi unpickle ở process con. Thay vào đó ảnh được chép một lần vào một
+segment multiprocessing.shared_memory và chỉ descriptor (SharedImage: tên
+segment, shape, dtype) được gửi đi; worker map segment và đọc thẳng trên đó.
+
+Quy ước sở hữu:
+
+- Process tạo segment (share_image) là chủ sở hữu: nó đóng mapping của mình
+  ngay sau khi chép ảnh và gọi release() (unlink) khi job kết thúc, kể cả khi
+  job lỗi hoặc không được đưa vào pool. OMRWorkerPool.submit_page làm việc này
+  trong done callback của future.
+- Worker chỉ attach (attach_image), dùng ảnh read-only và đóng mapping trước
+  khi trả kết quả. Kết quả không được giữ view nào trỏ vào ảnh.
+- Nếu process chủ chết giữa chừng, resource tracker của multiprocessing unlink
+  các segment còn sót khi thoát.
+
+Upload vẫn gửi bytes JPEG vào pool (nhỏ hơn ảnh đã giải mã nhiều lần); đường
+này dùng khi ảnh đã được giải mã sẵn ở process gửi (benchmark, batch từ ảnh
+đã decode).
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+SharedImage = namedtuple('SharedImage', ['name', 'shape', 'dtype'])
+
+
+def share_image(image):
+    """
+    Chép `image` vào một segment shared memory mới.
+    Trả về (SharedMemory, SharedImage); người gọi phải release() segment.
+    """
+    image = np.ascontiguousarray(image)
+    shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+    try:
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[...] = image
+    except BaseException:
+        release(shm)
+        raise
+    # Process gửi không cần đọc lại ảnh: bỏ mapping, chỉ giữ tên để unlink
+    shm.close()
+    return shm, SharedImage(shm.name, tuple(image.shape), image.dtype.str)
+
+
+def release(shm):
+    """Giải phóng segment do share_image tạo. Gọi nhiều lần cũng không sao."""
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def attach_image(descriptor):
+    """Ảnh (read-only, không copy) trong segment của `descriptor`, chỉ dùng trong khối with"""
+    shm = shared_memory.SharedMemory(name=descriptor.name)
+    image = np.ndarray(descriptor.shape, dtype=np.dtype(descriptor.dtype), buffer=shm.buf)
+    image.flags.writeable = False
+    try:
+        yield image
+    finally:
+        del image
+        try:
+            shm.close()
+        except BufferError:
+            # Còn view trỏ vào segment (ví dụ traceback của job lỗi giữ ảnh):
+            # mapping được giải phóng khi view cuối cùng bị thu hồi
+            pass
@@ -0,0 +1,140 @@
+"""
+Sinh ảnh chụp phiếu trả lời giả lập để đo tốc độ và độ chính xác của OMR.
+
+Phiếu được vẽ từ cùng layout với preview_test_pdf (build_sheet_layout), tô
+sẵn các ô đã biết, rồi "chụp" lại: đặt lên nền, xoay, méo phối cảnh, đổ
+bóng, làm mờ, thêm nhiễu và nén JPEG. Không cần mạng hay DB, xem lệnh
+`manage.py omr_benchmark`.
+"""
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from exam.grading import indices_to_masks
+
+SyntheticSheet = namedtuple('SyntheticSheet', ['image_bytes', 'answers'])
+
+
+def _pencil_mark(page, bx, by, bw, bh, rng):
+    # Vết bút chì: đậm vừa phải, không phủ kín ô
+    inset = int(bw * rng.uniform(0.0, 0.15))
+    shade = int(rng.integers(20, 80))
+    cv2.ellipse(page, (bx + bw // 2, by + bh // 2), (bw // 2 - inset, bh // 2 - inset),
+                0, 0, 360, (shade, shade, shade), -1)
+
+
+def render_sheet(layout, answers, dpi=200, rng=None, student_code='', variant_code=0):
+    """
+    Vẽ trang phiếu (BGR, nền trắng) theo layout với `dpi`.
+    `answers[q]` là bitmask các lựa chọn được tô của câu q (exam.grading), 0 là bỏ trống.
+    `student_code` được tô vào lưới mã học sinh nếu layout có lưới, `variant_code`
+    (1..N) vào hàng ô mã đề.
+    """
+    rng = rng or np.random.default_rng()
+    scale = dpi / 72.0
+    page_w, page_h = layout['page_size']
+    page = np.full((int(round(page_h * scale)), int(round(page_w * scale)), 3), 255, dtype=np.uint8)
+
+    def px(*values):
+        return [int(round(v * scale)) for v in values]
+
+    for x, y, w, h in layout.get('markers', []):
+        x, y, w, h = px(x, y, w, h)
+        cv2.rectangle(page, (x, y), (x + w, y + h), (0, 0, 0), -1)
+
+    font_scale = scale * 0.3
+    line = max(int(round(scale * 1.5)), 1)
+    x, y = px(layout['margin'], layout['margin'])
+    cv2.putText(page, "SYNTHETIC SHEET", (page.shape[1] // 3, y), cv2.FONT_HERSHEY_SIMPLEX,
+                font_scale * 1.4, (0, 0, 0), line)
+
+    for question, answer in zip(layout['questions'], answers):
+        qx, qy = px(question['x'], question['y'])
+        cv2.putText(page, str(question['number']), (qx, qy + line * 2), cv2.FONT_HERSHEY_SIMPLEX,
+                    font_scale, (0, 0, 0), line)
+        for j, (bx, by, bw, bh) in enumerate(question['choices']):
+            bx, by, bw, bh = px(bx, by, bw, bh)
+            if layout['shape'] == 'square':
+                cv2.rectangle(page, (bx, by), (bx + bw, by + bh), (0, 0, 0), line)
+            else:
+                cv2.circle(page, (bx + bw // 2, by + bh // 2), bw // 2, (0, 0, 0), line)
+            if int(answer) >> j & 1:
+                _pencil_mark(page, bx, by, bw, bh, rng)
+
+    for c, column in enumerate(layout.get('student_id', {}).get('columns', [])):
+        for d, box in enumerate(column):
+            bx, by, bw, bh = px(*box)
+            cv2.circle(page, (bx + bw // 2, by + bh // 2), bw // 2, (0, 0, 0), line)
+            if c < len(student_code) and student_code[c] == str(d):
+                _pencil_mark(page, bx, by, bw, bh, rng)
+
+    for code, box in enumerate(layout.get('variant_code', {}).get('choices', []), start=1):
+        bx, by, bw, bh = px(*box)
+        cv2.circle(page, (bx + bw // 2, by + bh // 2), bw // 2, (0, 0, 0), line)
+        if code == variant_code:
+            _pencil_mark(page, bx, by, bw, bh, rng)
+    return page
+
+
+def _background(shape, rng):
+    # Mặt bàn: nhiễu tần số thấp, có ám màu
+    low = rng.integers(40, 170, (8, 8, 3)).astype(np.uint8)
+    return cv2.resize(low, (shape[1], shape[0]), interpolation=cv2.INTER_CUBIC)
+
+
+def photograph(page, rng, severity=1.0, long_side=3000):
+    """
+    Giả lập ảnh chụp điện thoại của `page`, trả về bytes JPEG.
+    `severity` (0-1) điều chỉnh độ mạnh của các biến dạng.
+    """
+    page_h, page_w = page.shape[:2]
+    photo_h = long_side
+    photo_w = int(long_side * 0.75)
+    photo = _background((photo_h, photo_w), rng)
+
+    # Tờ giấy chiếm 70-90% khung hình, xoay và méo phối cảnh
+    fit = rng.uniform(0.7, 0.9) * min(photo_w / page_w, photo_h / page_h)
+    angle = np.deg2rad(rng.uniform(-8, 8) * severity)
+    half = np.array([[-page_w, -page_h], [page_w, -page_h], [page_w, page_h], [-page_w, page_h]]) * fit / 2
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    dst = half @ rotation.T + [photo_w / 2, photo_h / 2]
+    dst += rng.uniform(-1, 1, (4, 2)) * 0.05 * severity * page_w * fit
+    src = np.float32([[0, 0], [page_w, 0], [page_w, page_h], [0, page_h]])
+    matrix = cv2.getPerspectiveTransform(src, dst.astype(np.float32))
+    cv2.warpPerspective(page, matrix, (photo_w, photo_h), dst=photo,
+                        flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_TRANSPARENT)
+
+    # Bóng đổ: độ sáng giảm dần theo một hướng ngẫu nhiên
+    # (tính trên lưới nhỏ rồi phóng to cho nhanh)
+    direction = rng.uniform(-1, 1, 2)
+    ys, xs = np.mgrid[0:1:32j, 0:1:24j].astype(np.float32)
+    ramp = xs * direction[0] + ys * direction[1]
+    ramp = (ramp - ramp.min()) / max(float(ramp.max() - ramp.min()), 1e-6)
+    shade = 255 * (1.0 - rng.uniform(0, 0.5) * severity * ramp)
+    shade = cv2.resize(shade.astype(np.uint8), (photo_w, photo_h), interpolation=cv2.INTER_LINEAR)
+    photo = cv2.multiply(photo, cv2.cvtColor(shade, cv2.COLOR_GRAY2BGR), scale=1 / 255)
+
+    sigma = rng.uniform(0, 2.0) * severity
+    if sigma > 0.3:
+        photo = cv2.GaussianBlur(photo, (0, 0), sigma)
+    noise = (rng.standard_normal(photo.shape, dtype=np.float32) * 4 * severity).astype(np.int16)
+    photo = cv2.add(photo, noise, dtype=cv2.CV_8U)
+
+    quality = int(rng.integers(int(95 - 55 * severity), 96))
+    return cv2.imencode('.jpg', photo, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def generate_sheet(layout, rng, severity=1.0, dpi=200, long_side=3000, blank_rate=0.0, multi_rate=0.0):
+    """
+    Một phiếu ngẫu nhiên: SyntheticSheet(bytes JPEG, bitmask đã tô của mỗi câu).
+    `multi_rate` là tỷ lệ câu được tô thêm một ô thứ hai.
+    """
+    num_questions, num_choices = len(layout['questions']), layout['num_choices']
+    answers = indices_to_masks(rng.integers(0, num_choices, num_questions))
+    answers[rng.random(num_questions) < blank_rate] = 0
+    if multi_rate:
+        multi = rng.random(num_questions) < multi_rate
+        answers[multi] |= indices_to_masks(rng.integers(0, num_choices, num_questions))[multi]
+    page = render_sheet(layout, answers, dpi=dpi, rng=rng)
+    return SyntheticSheet(photograph(page, rng, severity, long_side), answers)
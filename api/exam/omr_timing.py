@@ -0,0 +1,52 @@
+"""
+Đo thời gian từng bước của pipeline chấm OMR.
+
+Các hàm chấm nhận tham số `timings` (dict hoặc None, giống tham số `debug`).
+Mỗi bước được đo bằng đồng hồ monotonic (time.perf_counter) và cộng dồn vào
+dict theo mili giây. Kết quả lưu ở PaperSubmission.stage_timings, thống kê
+p50/p95 qua StatisticViewSet.omr_timings.
+"""
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Thứ tự các bước trong pipeline, dùng để sắp xếp kết quả thống kê
+STAGES = [
+    'decode', 'detect', 'warp', 'threshold', 'locate', 'sample',
+    'score', 'save', 'upload', 'total',
+]
+
+
+@contextmanager
+def timed(timings, stage):
+    """Cộng thời gian chạy của khối lệnh vào timings[stage] (ms). Không làm gì nếu timings là None."""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round(timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000, 3)
+
+
+def stage_percentiles(rows, percentiles=(50, 95)):
+    """
+    Thống kê các dict stage_timings: {stage: {'count', 'p50', 'p95', ...}}.
+    Mỗi bước chỉ tính trên các bài có đo bước đó.
+    """
+    values = {}
+    for row in rows:
+        for stage, ms in (row or {}).items():
+            values.setdefault(stage, []).append(ms)
+
+    order = {stage: i for i, stage in enumerate(STAGES)}
+    result = {}
+    for stage in sorted(values, key=lambda s: (order.get(s, len(STAGES)), s)):
+        samples = np.array(values[stage], dtype=np.float64)
+        stats = {'count': int(samples.size)}
+        for p, value in zip(percentiles, np.percentile(samples, percentiles)):
+            stats[f'p{p}'] = round(float(value), 2)
+        result[stage] = stats
+    return result
@@ -0,0 +1,111 @@
+"""
+Mã đề: các phiên bản xáo trộn của một bài kiểm tra giấy.
+
+Mỗi mã đề (PaperTestVariant) chỉ lưu thứ tự câu hỏi và một seed; hoán vị
+lựa chọn của từng câu được sinh lại từ seed (choice_permutations), nên không
+có câu hỏi nào bị sao chép. `order[j]` của một câu là lựa chọn gốc được in ở
+vị trí j trên đề.
+
+Khi biên dịch đáp án (exam.grading.get_answer_keys) mỗi mã đề có một
+CompiledAnswerKey riêng theo thứ tự in của đề đó: question_ids là id câu gốc,
+correct đã được đổi sang vị trí lựa chọn trên đề. Chấm một tờ chỉ là tra dict
+theo mã đề đọc được từ hàng ô mã đề trên phiếu rồi so sánh như đề gốc; câu
+trả lời được đổi về lựa chọn gốc (to_original_masks) trước khi lưu.
+"""
+import secrets
+
+import numpy as np
+from django.db import transaction
+
+from exam.models import PaperTestVariant
+from exam.omr_roster import STUDENT_ID_FILL_THRESHOLD, STUDENT_ID_AMBIGUOUS_RATIO
+
+
+def choice_permutations(seed, num_questions, num_choices, shuffle=True):
+    """Mảng (câu, lựa chọn) uint8: lựa chọn gốc in ở từng vị trí của mỗi câu"""
+    if not shuffle:
+        return np.tile(np.arange(num_choices, dtype=np.uint8), (num_questions, 1))
+    rng = np.random.default_rng(seed)
+    return np.argsort(rng.random((num_questions, num_choices)), axis=1).astype(np.uint8)
+
+
+def variant_question_order(variant, question_ids):
+    """
+    Id câu hỏi theo thứ tự in của mã đề. Câu đã bị xóa được bỏ qua, câu thêm
+    sau khi sinh mã đề được in cuối đề theo thứ tự gốc.
+    """
+    existing = set(int(qid) for qid in question_ids)
+    order = [qid for qid in variant.question_order if qid in existing]
+    placed = set(order)
+    return order + [int(qid) for qid in question_ids if int(qid) not in placed]
+
+
+def to_sheet_masks(masks, order):
+    """Bitmask theo lựa chọn gốc -> theo vị trí in trên đề (order: hoán vị từng câu)"""
+    masks = np.asarray(masks)
+    sheet = np.zeros_like(masks)
+    for j in range(order.shape[-1]):
+        sheet |= ((masks >> order[..., j].astype(masks.dtype)) & 1) << masks.dtype.type(j)
+    return sheet
+
+
+def to_original_masks(masks, order):
+    """Bitmask theo vị trí in trên đề -> theo lựa chọn gốc"""
+    masks = np.asarray(masks)
+    original = np.zeros_like(masks)
+    for j in range(order.shape[-1]):
+        original |= ((masks >> masks.dtype.type(j)) & 1) << order[..., j].astype(masks.dtype)
+    return original
+
+
+def decode_variant_code(fill):
+    """
+    Mã đề (1..N) từ độ tô của hàng ô mã đề (uint8), 0 nếu không đọc được:
+    không ô nào được tô, hoặc tô hai ô gần như nhau.
+    """
+    if fill.size == 0:
+        return 0
+    fill = fill.astype(np.int32)
+    order = np.sort(fill)
+    best = int(order[-1])
+    second = int(order[-2]) if fill.size > 1 else 0
+    if best < STUDENT_ID_FILL_THRESHOLD or second >= best * STUDENT_ID_AMBIGUOUS_RATIO:
+        return 0
+    return int(fill.argmax()) + 1
+
+
+def create_variants(test, count, shuffle_choices=True, seed=None):
+    """
+    Thay các mã đề của `test` bằng `count` mã đề mới (0: bỏ mã đề) và cập nhật
+    num_variants. Người gọi cần dựng lại layout và invalidate_answer_key.
+    """
+    question_ids = list(test.questions.order_by('id').values_list('id', flat=True))
+    master = np.random.default_rng(seed if seed is not None else secrets.randbits(32))
+    variants = []
+    for code in range(1, count + 1):
+        variant_seed = int(master.integers(0, 2 ** 31))
+        order = np.random.default_rng(variant_seed).permutation(question_ids).tolist() if question_ids else []
+        variants.append(PaperTestVariant(
+            test=test, code=code, seed=variant_seed,
+            question_order=[int(qid) for qid in order], shuffle_choices=shuffle_choices,
+        ))
+    with transaction.atomic():
+        test.variants.all().delete()
+        PaperTestVariant.objects.bulk_create(variants)
+        test.num_variants = count
+        test.save(update_fields=['num_variants'])
+    return variants
+
+
+def describe_variant(variant, question_ids, num_choices):
+    """Thứ tự câu hỏi và lựa chọn của một mã đề, để in đề"""
+    order = variant_question_order(variant, question_ids)
+    choices = choice_permutations(variant.seed, len(order), num_choices, variant.shuffle_choices)
+    return {
+        'code': variant.code,
+        'seed': variant.seed,
+        'questions': [
+            {'number': number, 'question_id': qid, 'choices': [chr(65 + int(c)) for c in choices[number - 1]]}
+            for number, qid in enumerate(order, start=1)
+        ],
+    }
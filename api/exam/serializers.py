@@ -1,6 +1,10 @@
 from rest_framework import serializers
 from .models import Classroom, PaperTest, PaperTestQuestion, PaperSubmission, PaperAnswerDetected, PaperUserAnswer
 from django.contrib.auth import get_user_model
+from .omr_layout import layout_for_test
+from .grading import invalidate_answer_key
+from .omr_variants import create_variants
+from .omr_render import annotated_url
 
 User = get_user_model()
 
@@ -25,7 +29,10 @@ class TestSerializer(serializers.ModelSerializer):
     class Meta:
         model = PaperTest
         fields = ['id', 'title', 'description', 'num_questions', 'num_choices', 
-                 'allow_multiple_answers', 'created_by', 'classroom', 'created_at', 'questions']
+                 'allow_multiple_answers', 'omr_debug', 'student_id_digits', 'num_variants', 'created_by', 'classroom',
+                 'created_at', 'questions']
+        # Mã đề được sinh qua TestViewSet.generate_variants
+        read_only_fields = ['num_variants']
 
 class TestCreateSerializer(serializers.ModelSerializer):
     questions = QuestionCreateSerializer(many=True, required=False)
@@ -34,25 +41,72 @@ class TestCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = PaperTest
         fields = ['title', 'description', 'num_questions', 'num_choices', 
-                 'allow_multiple_answers', 'classroom', 'questions']
+                 'allow_multiple_answers', 'omr_debug', 'student_id_digits', 'classroom', 'questions']
+
+    def validate_num_choices(self, value):
+        # Ma trận độ tô đã lưu có số cột bằng số lựa chọn lúc chấm: đổi số lựa chọn
+        # thì không chấm lại được các bài đó
+        if (self.instance is not None and value != self.instance.num_choices
+                and self.instance.submissions.filter(fill_matrix__isnull=False).exists()):
+            raise serializers.ValidationError(
+                "Cannot change the number of choices after submissions have been graded"
+            )
+        return value
+
+    def validate_questions(self, value):
+        # Thay câu hỏi thì phải xáo lại mã đề: bài đã chấm theo mã đề cũ không còn
+        # đáp án để chấm lại (như TestViewSet.generate_variants khi không có force)
+        if self.instance is not None and self.instance.submissions.filter(variant_code__gt=0).exists():
+            raise serializers.ValidationError(
+                "Cannot replace the questions of a test whose variants have graded submissions"
+            )
+        return value
+
+    def _build_layout(self, test):
+        try:
+            return layout_for_test(test)
+        except ValueError as e:
+            raise serializers.ValidationError({'num_questions': str(e)})
 
     def create(self, validated_data):
         questions_data = validated_data.pop('questions', [])
-        test = PaperTest.objects.create(**validated_data)
+        test = PaperTest(**validated_data)
+        test.layout = self._build_layout(test)
+        test.save()
         for question_data in questions_data:
             PaperTestQuestion.objects.create(test=test, **question_data)
         return test
 
     def update(self, instance, validated_data):
         questions_data = validated_data.pop('questions', None)
+        layout_fields = ('num_questions', 'num_choices', 'allow_multiple_answers', 'student_id_digits')
+        layout_changed = any(
+            attr in validated_data and validated_data[attr] != getattr(instance, attr)
+            for attr in layout_fields
+        )
+        # Đáp án biên dịch phụ thuộc số lựa chọn và chế độ nhiều đáp án
+        key_changed = any(
+            attr in validated_data and validated_data[attr] != getattr(instance, attr)
+            for attr in ('num_choices', 'allow_multiple_answers')
+        )
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
+        # Bài cũ (layout=None) đã in theo mẫu cũ và được chấm bằng dò contour: không tự
+        # gắn layout mới, layout chỉ được tạo khi in lại phiếu (preview_test_pdf)
+        if layout_changed and instance.layout:
+            instance.layout = self._build_layout(instance)
         instance.save()
 
         if questions_data is not None:
             instance.questions.all().delete()
             for question_data in questions_data:
                 PaperTestQuestion.objects.create(test=instance, **question_data)
+            if instance.num_variants:
+                # Các mã đề cũ trỏ tới câu hỏi đã bị xóa: xáo lại với bộ câu hỏi mới
+                first = instance.variants.order_by('code').first()
+                create_variants(instance, instance.num_variants, first.shuffle_choices if first else True)
+        if questions_data is not None or key_changed:
+            invalidate_answer_key(instance)
 
         return instance
 
@@ -70,7 +124,7 @@ class UserAnswerSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = PaperUserAnswer
-        fields = ['id', 'submission', 'question', 'selected_option']
+        fields = ['id', 'submission', 'question', 'selected_option', 'flag']
 
 # class SubmissionSerializer(serializers.ModelSerializer):
 #     user = serializers.PrimaryKeyRelatedField(read_only=True)
@@ -86,10 +140,19 @@ class UserAnswerSerializer(serializers.ModelSerializer):
 
 class SubmissionSerializer(serializers.ModelSerializer):
     submission_image = serializers.SerializerMethodField()
+    annotated_url = serializers.SerializerMethodField()
     
     class Meta:
         model = PaperSubmission
-        fields = '__all__'
+        # Không trả về các cột nội bộ của OMR (fill_matrix, detection, image_sha256,
+        # idempotency_key, debug_artifacts, stage_timings)
+        fields = ['id', 'test', 'user', 'student', 'batch', 'submission_image', 'source_name',
+                  'submitted_at', 'updated_at', 'total_score', 'status', 'status_reason',
+                  'student_code', 'variant_code', 'annotated_url']
+
+    def get_annotated_url(self, obj):
+        # submission_image là ảnh gốc; ảnh đã chấm được vẽ khi mở URL này
+        return annotated_url(obj, self.context.get('request'))
     
     def get_submission_image(self, obj):
         """
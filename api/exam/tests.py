@@ -1,3 +1,213 @@
-from django.test import TestCase
+import hashlib
+from datetime import timedelta
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from exam import grading
+from exam.grading import (
+    CompiledAnswerKey, MASK_DTYPE, FLAG_BLANK, FLAG_MULTIPLE,
+    answer_masks, answer_flags, encode_fill_matrix, fill_threshold, get_answer_key, invalidate_answer_key,
+    letters_to_mask, mask_to_letters, regrade_test, score_answers
+)
+from exam.models import PaperSubmission, PaperAnswerDetected, PaperUserAnswer
+from exam.serializers import TestCreateSerializer
+from exam.views.omr_processing import SheetResult, save_results
+from exam.omr_variants import choice_permutations, to_sheet_masks, to_original_masks
+from users.models import User
+
+
+class AnswerMaskTests(SimpleTestCase):
+    def test_letters_round_trip(self):
+        self.assertEqual(letters_to_mask('AC'), 0b101)
+        self.assertEqual(mask_to_letters(0b101), 'AC')
+        self.assertEqual(mask_to_letters(0), '')
+        # Chữ cái ngoài số lựa chọn bị bỏ qua
+        self.assertEqual(letters_to_mask('AE', num_choices=4), 0b1)
+
+    def test_answer_masks_from_fill_matrix(self):
+        fill = np.array([
+            [220, 20, 15, 10],   # A
+            [10, 15, 12, 8],     # bỏ trống
+            [200, 30, 190, 10],  # A và C
+            [90, 210, 20, 15],   # B, ô A nhạt hơn nhiều so với ô đậm nhất hàng
+        ], dtype=np.uint8)
+        self.assertTrue(60 <= fill_threshold(fill) <= 160)
+        np.testing.assert_array_equal(answer_masks(fill), [0b1, 0, 0b101, 0b10])
+
+    def test_empty_fill_matrix(self):
+        self.assertEqual(answer_masks(np.zeros((0, 4), dtype=np.uint8)).shape, (0,))
+
+    def test_blank_and_multiple_flags(self):
+        masks = np.array([0, 0b1, 0b101], dtype=MASK_DTYPE)
+        self.assertEqual(list(answer_flags(masks, allow_multiple=False)), [FLAG_BLANK, '', FLAG_MULTIPLE])
+        self.assertEqual(list(answer_flags(masks, allow_multiple=True)), [FLAG_BLANK, '', ''])
+
+    def test_score_against_key(self):
+        key = CompiledAnswerKey(
+            question_ids=np.arange(1, 6),
+            correct=np.array([0b1, 0b10, 0b101, 0b10, 0], dtype=MASK_DTYPE),
+            scores=np.ones(5),
+        )
+        # Câu 2 tô thêm ô (sai), câu 5 chưa có đáp án (không bao giờ đúng)
+        selected = np.array([0b1, 0b11, 0b101, 0b10, 0], dtype=MASK_DTYPE)
+        is_correct, question_scores, total = score_answers(selected, key)
+        np.testing.assert_array_equal(is_correct, [True, False, True, True, False])
+        np.testing.assert_array_equal(question_scores, [1, 0, 1, 1, 0])
+        self.assertEqual(float(total), 6.0)
+
+
+class VariantMaskTests(SimpleTestCase):
+    def test_sheet_masks_follow_printed_order(self):
+        # Lựa chọn gốc C, A, B được in ở vị trí A, B, C
+        order = np.array([[2, 0, 1]], dtype=np.uint8)
+        masks = np.array([0b001], dtype=MASK_DTYPE)  # đáp án gốc A
+        np.testing.assert_array_equal(to_sheet_masks(masks, order), [0b010])
+        np.testing.assert_array_equal(to_original_masks(np.array([0b010], dtype=MASK_DTYPE), order), [0b001])
+
+    def test_round_trip_through_permutation(self):
+        rng = np.random.default_rng(0)
+        order = choice_permutations(1234, 50, 5)
+        masks = rng.integers(0, 1 << 5, 50).astype(MASK_DTYPE)
+        sheet = to_sheet_masks(masks, order)
+        np.testing.assert_array_equal(to_original_masks(sheet, order), masks)
+        # Hoán vị không thêm / bớt ô tô
+        np.testing.assert_array_equal(
+            [bin(int(m)).count('1') for m in sheet], [bin(int(m)).count('1') for m in masks]
+        )
+
+    def test_same_seed_same_permutation(self):
+        np.testing.assert_array_equal(choice_permutations(7, 10, 4), choice_permutations(7, 10, 4))
+        np.testing.assert_array_equal(
+            choice_permutations(7, 3, 4, shuffle=False), np.tile(np.arange(4), (3, 1))
+        )
+
+
+def marked_fill(choices, num_choices=4):
+    """Ma trận độ tô với ô `choices[q]` được tô đậm (-1: bỏ trống)"""
+    fill = np.full((len(choices), num_choices), 15, dtype=np.uint8)
+    for q, j in enumerate(choices):
+        if j >= 0:
+            fill[q, j] = 220
+    return fill
+
+
+class GradingDBTestCase(TestCase):
+    def setUp(self):
+        # Đáp án được cache theo (id bài, phiên bản), id có thể lặp lại giữa các test
+        grading._key_cache.clear()
+        cache.clear()
+        self.user = User.objects.create(username='teacher', email='teacher@example.com')
+        serializer = TestCreateSerializer(data={
+            'title': 'Test', 'num_questions': 4, 'num_choices': 4, 'allow_multiple_answers': False,
+            'questions': [{'text': f'Q{i}', 'correct_answer': 'ABCD'[i]} for i in range(4)],
+        })
+        serializer.is_valid(raise_exception=True)
+        self.test = serializer.save(created_by=self.user)
+        self.questions = list(self.test.questions.order_by('id'))
+
+    def grade(self, submission, choices):
+        key = get_answer_key(self.test)
+        fill = marked_fill(choices)
+        selected = answer_masks(fill)
+        is_correct, question_scores, total = score_answers(selected, key)
+        result = SheetResult(None, fill, key, selected, is_correct, question_scores, float(total), {}, '',
+                             answer_flags(selected, False), 0)
+        save_results(submission, result, status=PaperSubmission.Status.GRADED)
+
+
+class SaveResultsTests(GradingDBTestCase):
+    def test_regrading_a_sheet_overwrites_its_answers(self):
+        submission = PaperSubmission.objects.create(test=self.test, user=self.user)
+        self.grade(submission, [0, 1, 2, 3])
+        self.assertEqual(submission.total_score, 10.0)
+
+        self.grade(submission, [0, 1, -1, 0])
+        answers = PaperUserAnswer.objects.filter(submission=submission).order_by('question_id')
+        self.assertEqual(answers.count(), 4)
+        self.assertEqual([a.selected_option for a in answers], ['A', 'B', '', 'A'])
+        self.assertEqual([a.flag for a in answers], ['', '', FLAG_BLANK, ''])
+        detected = PaperAnswerDetected.objects.filter(submission=submission).order_by('question_id')
+        self.assertEqual([d.is_correct for d in detected], [True, True, False, False])
+        submission.refresh_from_db()
+        self.assertEqual(submission.total_score, 5.0)
+
+
+class RegradeTests(GradingDBTestCase):
+    def test_regrade_after_key_change(self):
+        submission = PaperSubmission.objects.create(test=self.test, user=self.user)
+        self.grade(submission, [0, 1, 2, 0])  # câu 4 sai (đáp án D)
+        self.assertEqual(submission.total_score, 7.5)
+
+        last = self.questions[3]
+        last.correct_answer = 'A'
+        last.save()
+        invalidate_answer_key(self.test)
+        self.assertEqual(regrade_test(self.test, [last.id]), {'regraded': 1, 'changed_questions': 1})
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.total_score, 10.0)
+        self.assertTrue(PaperAnswerDetected.objects.get(submission=submission, question=last).is_correct)
+
+    def test_regrade_reads_stored_fill_matrix(self):
+        submission = PaperSubmission.objects.create(
+            test=self.test, user=self.user, fill_matrix=encode_fill_matrix(marked_fill([3, 2, 1, 0]))
+        )
+        for question in self.questions:
+            PaperAnswerDetected.objects.create(submission=submission, question=question)
+        regrade_test(self.test)
+        submission.refresh_from_db()
+        self.assertEqual(submission.total_score, 0.0)
+
+
+class UploadDedupeTests(GradingDBTestCase):
+    # Việc kiểm tra trùng chạy trước khi đọc ảnh, nên bytes bất kỳ là đủ
+    IMAGE = b'not really a jpeg'
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, **headers):
+        return self.client.post('/api/submissions/upload_submission/', {
+            'test_id': self.test.id,
+            'submission_image': SimpleUploadedFile('sheet.jpg', self.IMAGE, content_type='image/jpeg'),
+        }, format='multipart', **headers)
+
+    def existing(self, status, **fields):
+        return PaperSubmission.objects.create(
+            test=self.test, user=self.user, status=status, total_score=7.5, **fields
+        )
+
+    def test_same_image_returns_graded_submission(self):
+        submission = self.existing(PaperSubmission.Status.GRADED,
+                                   image_sha256=hashlib.sha256(self.IMAGE).hexdigest())
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['submission_id'], submission.id)
+        self.assertTrue(response.data['duplicate'])
+        self.assertEqual(response.data['score'], 7.5)
+
+    def test_idempotency_key_matches_in_flight_submission(self):
+        submission = self.existing(PaperSubmission.Status.PROCESSING, image_sha256='0' * 64,
+                                   idempotency_key='retry-1')
+        response = self.upload(HTTP_IDEMPOTENCY_KEY='retry-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['submission_id'], submission.id)
+        self.assertIsNone(response.data['score'])
+
+    def test_failed_or_stale_submission_is_not_a_duplicate(self):
+        sha = hashlib.sha256(self.IMAGE).hexdigest()
+        self.existing(PaperSubmission.Status.FAILED, image_sha256=sha)
+        stale = self.existing(PaperSubmission.Status.QUEUED, image_sha256=sha)
+        PaperSubmission.objects.filter(id=stale.id).update(updated_at=timezone.now() - timedelta(hours=1))
+        # Không trùng nên ảnh được kiểm tra thật và bị từ chối
+        response = self.upload()
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('duplicate', response.data)
+        self.assertEqual(PaperSubmission.objects.filter(test=self.test).count(), 2)
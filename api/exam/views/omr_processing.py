@@ -1,197 +1,359 @@
-from exam.models import PaperSubmission, PaperAnswerDetected
-import os
-from django.db import transaction
+from exam.models import PaperSubmission, PaperAnswerDetected, PaperUserAnswer
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from django.db import connection, transaction
+from django.utils import timezone
+import time
 import cv2
+import numpy as np
 import cloudinary
 import cloudinary.uploader
-import tempfile
+from exam.omr_layout import bubble_rects, student_id_rects, variant_code_rects
+from exam.omr_align import downscale, find_fiducials, layout_transform, page_transform, warp_page
+from exam.omr_image import load_image, ImageRejected
+from exam.omr_roster import decode_student_id, match_student
+from exam.omr_variants import decode_variant_code, to_original_masks
+from exam.omr_timing import timed
+from exam.grading import (
+    fill_to_uint8, encode_fill_matrix, answer_masks, answer_flags, mask_to_letters,
+    get_answer_key, get_answer_keys, pad_answers, score_answers
+)
 
-def process_submission(submission_id):
-    submission = PaperSubmission.objects.get(id=submission_id)
-    test = submission.test
-    image_path = submission.submission_image.path
-    
-    # Process the OMR sheet
-    answers_with_positions, paper, question_contours = process_omr_sheet(image_path, test)
-    
-    correct_answers = 0
-    total_questions = test.questions.count()
-    
-    # Define the answer key (mapping question index to correct answer index: 0=A, 1=B, 2=C, 3=D)
-    question_ids = list(test.questions.values_list('id', flat=True))
-    ANSWER_KEY = {i: {'A': 0, 'B': 1, 'C': 2, 'D': 3}[test.questions.all()[i].correct_answer] 
-                  for i in range(total_questions)}
-    
-    for question_id, (user_answer, user_position, contours) in answers_with_positions.items():
-        if not user_answer or user_answer.strip() == "":
-            is_correct = False
-        else:
-            # Convert user_answer to index (e.g., 'A' -> 0, 'B' -> 1, etc.)
-            choice_letters = ['A', 'B', 'C', 'D'][:test.num_choices]
-            try:
-                user_answer_idx = choice_letters.index(user_answer[0])  # Take first letter
-                question_index = question_ids.index(question_id)
-                correct_answer_idx = ANSWER_KEY[question_index]
-                is_correct = user_answer_idx == correct_answer_idx
-            except (ValueError, KeyError, IndexError):
-                is_correct = False
-        
-        # Count correct answers
-        if is_correct:
-            correct_answers += 1
-        
-        # Save answer detection result
-        PaperAnswerDetected.objects.create(
+# Tỷ lệ thu nhỏ mỗi ô khi lấy mẫu theo layout, để viền in sẵn không bị tính là tô
+LAYOUT_SAMPLE_INSET = 0.2
+# Phần trang (theo chiều cao) có ô trả lời khi dò bằng contour: bỏ tiêu đề và mép dưới
+DETECT_PAGE_RANGE = (0.14, 0.93)
+
+# Upload ảnh lên Cloudinary chạy nền, không nằm trên đường chấm bài
+_storage_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='omr-storage')
+
+SheetResult = namedtuple('SheetResult', [
+    'paper', 'fill', 'key', 'selected', 'is_correct', 'question_scores', 'total_score', 'detection',
+    'student_code', 'flags', 'variant_code'
+])
+
+def grade_sheet(image, test, debug=None, timings=None, key=None):
+    """
+    Đọc tờ bài và chấm theo đáp án đã biên dịch (không query từng câu hỏi).
+    Nếu truyền dict `timings`, thời gian từng bước (ms) được ghi vào đó.
+    `key` mặc định là đáp án của mã đề tô trên phiếu (get_answer_keys).
+    """
+    keys = {0: key} if key is not None else get_answer_keys(test)
+    paper, fill, detection, student_code, variant_code = process_omr_sheet(
+        image, test, debug, timings, keys[0]
+    )
+    if getattr(test, 'num_variants', 0):
+        # Tra đáp án theo mã đề đọc được, O(1)
+        key = keys.get(variant_code) if variant_code else None
+        if key is None:
+            raise ImageRejected("The version code (mã đề) is not marked clearly, please check the sheet and retake it")
+    else:
+        key, variant_code = keys[0], 0
+
+    with timed(timings, 'score'):
+        # Bitmask lựa chọn của mỗi câu, chấm bằng so sánh số nguyên với đáp án
+        selected = pad_answers(answer_masks(fill), len(key.question_ids))
+        flags = answer_flags(selected, test.allow_multiple_answers)
+        is_correct, question_scores, total_score = score_answers(selected, key)
+        total_score = float(total_score)
+
+    # Ảnh đã chấm không được vẽ ở đây nữa: chỉ lưu `detection`, vẽ khi cần
+    return SheetResult(paper, fill, key, selected, is_correct, question_scores, total_score, detection,
+                       student_code, flags, variant_code)
+
+def save_results(submission, result, **fields):
+    """
+    Lưu kết quả của cả tờ bài trong một transaction: PaperAnswerDetected và
+    PaperUserAnswer bằng bulk upsert, cùng điểm tổng và các field khác của
+    submission. Chấm lại cùng một tờ sẽ ghi đè kết quả cũ.
+    """
+    num_rows = len(result.fill)
+    question_ids = [int(qid) for qid in result.key.question_ids[:num_rows]]
+    # Câu trả lời được lưu theo lựa chọn gốc, kể cả khi tờ làm theo một mã đề
+    selected = result.selected
+    if result.key.choice_order is not None:
+        selected = to_original_masks(selected, result.key.choice_order)
+    detected = [
+        PaperAnswerDetected(
             submission=submission,
-            question=test.questions.get(id=question_id),
-            is_correct=is_correct,
-            score=1 if is_correct else 0,
+            question_id=question_id,
+            is_correct=bool(result.is_correct[q]),
+            score=float(result.question_scores[q]),
             confidence=0.9
         )
-        
-        # Draw on image using cv2.drawContours (similar to the provided example)
-        if user_answer and user_answer.strip() != "":
-            # Default color is red (incorrect)
-            color = (0, 0, 255)
-            k = ANSWER_KEY[question_index]  # Correct answer index
-            if k == user_answer_idx:  # If the bubbled answer is correct
-                color = (0, 255, 0)  # Green for correct
-            # Draw the contour of the correct answer
-            cv2.drawContours(paper, [contours[k]], -1, color, 3)
-
-    # Calculate score
-    total_score = (correct_answers / total_questions) * 10 if total_questions > 0 else 0
-    total_score = round(total_score, 2)
-    
-    # Display total score on the image using OpenCV
-    score_text = f"TOTAL SCORE: {total_score}/10"
-    cv2.putText(paper, score_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-    
-    # Save the image using OpenCV
-    cv2.imwrite(image_path, paper)
-    
-    # Update the submission
+        for q, question_id in enumerate(question_ids)
+    ]
+    user_answers = [
+        PaperUserAnswer(
+            submission=submission,
+            question_id=question_id,
+            selected_option=mask_to_letters(selected[q]),
+            flag=result.flags[q]
+        )
+        for q, question_id in enumerate(question_ids)
+    ]
+
+    with transaction.atomic():
+        # Bỏ kết quả cũ của các câu không còn đọc được
+        PaperAnswerDetected.objects.filter(submission=submission).exclude(question_id__in=question_ids).delete()
+        PaperUserAnswer.objects.filter(submission=submission).exclude(question_id__in=question_ids).delete()
+
+        PaperAnswerDetected.objects.bulk_create(
+            detected,
+            update_conflicts=True,
+            unique_fields=['submission', 'question'],
+            update_fields=['is_correct', 'score', 'confidence']
+        )
+        PaperUserAnswer.objects.bulk_create(
+            user_answers,
+            update_conflicts=True,
+            unique_fields=['submission', 'question'],
+            update_fields=['selected_option', 'flag']
+        )
+
+        submission.total_score = result.total_score
+        submission.fill_matrix = encode_fill_matrix(result.fill)
+        submission.detection = result.detection
+        submission.student_code = result.student_code
+        submission.variant_code = result.variant_code
+        for attr, value in fields.items():
+            setattr(submission, attr, value)
+        submission.save()
+
+def _set_status(submission, status_value):
+    submission.status = status_value
+    submission.save(update_fields=['status', 'updated_at'])
+
+def _mark_unreadable(submission, status_value, reason):
     with transaction.atomic():
-        submission.total_score = total_score
+        submission.total_score = 0
+        submission.status = status_value
+        submission.status_reason = str(reason)[:255]
         submission.save()
-        
-def process_submission_cloudinary(submission_id, image_url):
+
+def _upload_image(image_bytes, test_id, public_id):
+    upload_result = cloudinary.uploader.upload(
+        BytesIO(image_bytes),
+        folder=f"testgen/submissions/test_{test_id}",
+        public_id=public_id,
+        resource_type="image",
+        overwrite=True
+    )
+    return upload_result['secure_url']
+
+def _store_images(submission_id, test_id, original_bytes, timings=None):
     """
-    Process submission với image từ Cloudinary
+    Upload ảnh gốc lên Cloudinary (chạy nền trong _storage_executor).
+    Ảnh đã chấm không được upload, xem SubmissionViewSet.annotated.
+    Thời gian upload được cộng vào `timings` rồi lưu cùng vào stage_timings.
     """
-    import requests
-    
-    submission = PaperSubmission.objects.get(id=submission_id)
-    test = submission.test
-    
-    # Download image từ Cloudinary về temporary file
+    fields = {}
     try:
-        response = requests.get(image_url)
-        response.raise_for_status()
-        
-        # Tạo temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-            tmp_file.write(response.content)
-            tmp_image_path = tmp_file.name
-        
-        # Process OMR sheet
-        answers_with_positions, paper, question_contours = process_omr_sheet(tmp_image_path, test)
-        
-        correct_answers = 0
-        total_questions = test.questions.count()
-        
-        # Define answer key
-        question_ids = list(test.questions.values_list('id', flat=True))
-        ANSWER_KEY = {
-            i: {'A': 0, 'B': 1, 'C': 2, 'D': 3}[test.questions.all()[i].correct_answer] 
-            for i in range(total_questions)
-        }
-        
-        # Process answers
-        for question_id, (user_answer, user_position, contours) in answers_with_positions.items():
-            if not user_answer or user_answer.strip() == "":
-                is_correct = False
-            else:
-                choice_letters = ['A', 'B', 'C', 'D'][:test.num_choices]
-                try:
-                    user_answer_idx = choice_letters.index(user_answer[0])
-                    question_index = question_ids.index(question_id)
-                    correct_answer_idx = ANSWER_KEY[question_index]
-                    is_correct = user_answer_idx == correct_answer_idx
-                except (ValueError, KeyError, IndexError):
-                    is_correct = False
-            
-            if is_correct:
-                correct_answers += 1
-            
-            PaperAnswerDetected.objects.create(
-                submission=submission,
-                question=test.questions.get(id=question_id),
-                is_correct=is_correct,
-                score=1 if is_correct else 0,
-                confidence=0.9
-            )
-            
-            # Draw on image
-            if user_answer and user_answer.strip() != "":
-                color = (0, 0, 255)
-                k = ANSWER_KEY[question_index]
-                if k == user_answer_idx:
-                    color = (0, 255, 0)
-                cv2.drawContours(paper, [contours[k]], -1, color, 3)
-        
-        # Calculate score
-        total_score = (correct_answers / total_questions) * 10 if total_questions > 0 else 0
-        total_score = round(total_score, 2)
-        
-        # Add score text
-        score_text = f"TOTAL SCORE: {total_score}/10"
-        cv2.putText(paper, score_text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-        
-        # Save processed image
-        cv2.imwrite(tmp_image_path, paper)
-        
-        # Upload processed image back to Cloudinary
-        processed_upload = cloudinary.uploader.upload(
-            tmp_image_path,
-            folder=f"testgen/submissions/test_{test.id}",
-            public_id=f"processed_submission_{submission.id}",
-            resource_type="image",
-            overwrite=True
-        )
-        
-        # Update submission with processed image URL and score
-        with transaction.atomic():
-            submission.submission_image = processed_upload['secure_url']
-            submission.total_score = total_score
-            submission.save()
-        
-        # Clean up temporary file
-        os.unlink(tmp_image_path)
-        
+        with timed(timings, 'upload'):
+            if original_bytes is not None:
+                fields['submission_image'] = _upload_image(original_bytes, test_id, f"submission_{submission_id}")
+    except Exception as e:
+        print(f"Error uploading submission images: {e}")
+
+    try:
+        if timings is not None:
+            fields['stage_timings'] = timings
+        if fields:
+            PaperSubmission.objects.filter(id=submission_id).update(**fields)
+    finally:
+        connection.close()
+
+def _store_debug_artifacts(submission_id, test_id, artifacts):
+    """
+    Encode và upload các ảnh debug, lưu URL vào submission.debug_artifacts
+    """
+    try:
+        urls = {}
+        for name, image in artifacts.items():
+            encoded = cv2.imencode('.jpg', image)[1].tobytes()
+            urls[name] = _upload_image(encoded, test_id, f"debug/submission_{submission_id}_{name}")
+        PaperSubmission.objects.filter(id=submission_id).update(debug_artifacts=urls)
+    except Exception as e:
+        print(f"Error uploading debug artifacts: {e}")
+    finally:
+        connection.close()
+
+def _grade_image(submission, image_bytes, debug=False, timings=None):
+    """
+    Chấm ảnh ngay trên bộ nhớ, lưu kết quả rồi đẩy việc upload ảnh ra nền.
+    Thời gian từng bước được ghi vào `timings` và lưu vào submission.stage_timings.
+    """
+    started = time.perf_counter()
+    timings = {} if timings is None else timings
+    artifacts = {} if debug else None
+    try:
+        with timed(timings, 'decode'):
+            image = load_image(image_bytes)
+        result = grade_sheet(image, submission.test, artifacts, timings)
+        with timed(timings, 'save'):
+            fields = {}
+            # Học sinh giáo viên đã chọn khi upload được giữ nguyên
+            if submission.student_id is None:
+                student_pk = match_student(submission.test, result.student_code)
+                if student_pk is not None:
+                    fields['student_id'] = student_pk
+            save_results(submission, result, status=PaperSubmission.Status.GRADED, status_reason='', **fields)
+    except ImageRejected as e:
+        # Ảnh không đọc được tờ bài: báo giáo viên chụp lại thay vì cho 0 điểm
+        print(f"Submission {submission.id} rejected: {e}")
+        _mark_unreadable(submission, PaperSubmission.Status.REJECTED, e)
     except Exception as e:
         print(f"Error processing submission: {e}")
-        # Có thể log error hoặc update submission status
-        with transaction.atomic():
-            submission.total_score = 0
-            submission.save()
-
-def process_omr_sheet(image_path, test):
-    import cv2
-    import numpy as np
-    from imutils import contours
-    import imutils
-    from imutils.perspective import four_point_transform
+        _mark_unreadable(submission, PaperSubmission.Status.FAILED, e)
+
+    # Tổng thời gian chấm, không tính upload chạy nền
+    timings['total'] = round((time.perf_counter() - started) * 1000, 3)
+
+    # Ảnh gốc luôn được lưu để giáo viên kiểm tra lại và để vẽ ảnh đã chấm
+    _storage_executor.submit(_store_images, submission.id, submission.test_id, image_bytes, timings)
+    # Ảnh debug chỉ được encode khi bật chế độ debug (kể cả khi chấm lỗi)
+    if artifacts:
+        _storage_executor.submit(_store_debug_artifacts, submission.id, submission.test_id, artifacts)
+
+def process_submission_upload(submission_id, image_bytes, debug=False):
+    """
+    Process submission từ bytes ảnh trong request: chấm trực tiếp trên bộ nhớ,
+    upload ảnh gốc chạy nền sau khi đã có điểm
+    """
+    submission = PaperSubmission.objects.get(id=submission_id)
+    _set_status(submission, PaperSubmission.Status.PROCESSING)
+    _grade_image(submission, image_bytes, debug=debug)
+
+def _fail_crashed_submission(submission_id, future):
+    """
+    Done callback: job không trả về được (worker chết, pool hỏng, job bị hủy)
+    thì bài vẫn ở QUEUED / PROCESSING; đánh dấu FAILED để có thể upload lại
+    """
+    error = 'cancelled' if future.cancelled() else future.exception()
+    if error is None:
+        return
+    print(f"Grading job for submission {submission_id} crashed: {error!r}")
+    # Callback chạy trong thread quản lý của executor, giữ connection lâu dài
+    connection.close_if_unusable_or_obsolete()
+    PaperSubmission.objects.filter(
+        id=submission_id,
+        status__in=[PaperSubmission.Status.QUEUED, PaperSubmission.Status.PROCESSING]
+    ).update(
+        status=PaperSubmission.Status.FAILED,
+        status_reason=f"Grading worker crashed: {error!r}"[:255],
+        updated_at=timezone.now()
+    )
+
+def queue_submission_upload(submission_id, image_bytes, debug=False, block=False, timeout=None):
+    """Đưa process_submission_upload vào OMR worker pool, raise OMRQueueFull nếu đầy"""
+    from exam.omr_pool import get_omr_pool
+
+    future = get_omr_pool().submit(
+        process_submission_upload, submission_id, image_bytes, debug, block=block, timeout=timeout
+    )
+    future.add_done_callback(partial(_fail_crashed_submission, submission_id))
+    return future
+
+def to_gray(image):
+    """Ảnh xám của ảnh BGR; ảnh đã xám (giải mã với gray=True) được dùng luôn"""
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def process_omr_sheet(image, test, debug=None, timings=None, key=None):
+    """
+    Đọc tờ bài từ ảnh BGR (hoặc ảnh xám) đã giải mã.
+    Nếu truyền dict `debug`, các ảnh trung gian được lưu vào đó (không ghi file).
+    Nếu truyền dict `timings`, thời gian từng bước (ms) được cộng vào đó.
+    `key` là đáp án đã biên dịch, mặc định get_answer_key(test).
+    Trả về (paper, fill, detection, student_code, variant_code); chấm điểm ở grade_sheet.
+    """
+    with timed(timings, 'detect'):
+        # Dò marker / mép giấy trên ảnh thu nhỏ (~1/4-1/8 ảnh chụp điện thoại),
+        # chỉ bước warp và đọc ô mới dùng ảnh full resolution
+        small, scale = downscale(image)
+        small_gray = to_gray(small)
+
+        # Phiếu có marker: căn chỉnh bằng homography, không cần dò mép giấy
+        corners = None
+        if test.layout and test.layout.get('markers'):
+            corners = find_fiducials(small_gray)
+        use_markers = corners is not None
+        if not use_markers:
+            corners = find_paper(small_gray, debug)
+        corners = corners / scale
+
+    with timed(timings, 'warp'):
+        if use_markers:
+            matrix, page_size = layout_transform(corners, test.layout)
+        else:
+            matrix, page_size = page_transform(corners)
+        paper = warp_page(image, matrix, page_size)
+        warped = to_gray(paper)
+    if debug is not None:
+        # Vẽ 4 góc tờ giấy lên ảnh gốc (màu xanh lá cây, độ dày 2 pixel)
+        output = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+        cv2.polylines(output, [corners.astype(np.int32)], True, (0, 255, 0), 2)
+        debug['detected_paper'] = output
+
+    with timed(timings, 'threshold'):
+        thresh = cv2.threshold(warped, 0, 255,
+            cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    if debug is not None:
+        debug['thresh'] = thresh
+    
+    # Số hàng cần đọc: số câu hỏi của đáp án
+    num_questions = len((key if key is not None else get_answer_key(test)).question_ids)
+
+    with timed(timings, 'locate'):
+        if test.layout:
+            # Đọc độ tô tại tọa độ đã biết từ layout, không cần dò contour
+            rows, rects = layout_bubble_rows(test.layout, thresh.shape, num_questions)
+            # Lưới mã học sinh và hàng mã đề được lấy mẫu cùng lượt với các câu hỏi
+            id_rects = student_id_rects(test.layout, thresh.shape, inset=LAYOUT_SAMPLE_INSET)
+            code_rects = variant_code_rects(test.layout, thresh.shape, inset=LAYOUT_SAMPLE_INSET)
+        else:
+            rows, rects = detect_bubble_rows(thresh, test.num_choices, num_questions, debug)
+            id_rects = np.zeros((0, 10, 4), dtype=np.int64)
+            code_rects = np.zeros((0, 4), dtype=np.int64)
+    if test.layout and debug is not None:
+        output = cv2.cvtColor(thresh, cv2.COLOR_GRAY2BGR)
+        for x, y, w, h in rects:
+            cv2.rectangle(output, (int(x), int(y)), (int(x + w), int(y + h)), (0, 0, 255), 1)
+        debug['detected_bubbles'] = output
+
+    # Hình học của lần đọc: đủ để vẽ lại ảnh đã chấm khi cần (exam.omr_render)
+    detection = {
+        'image_size': [image.shape[1], image.shape[0]],
+        'corners': np.round(corners, 2).tolist(),
+        'matrix': matrix.tolist(),
+        'page_size': list(page_size),
+        'bubbles': [[list(cv2.boundingRect(c)) for c in cnts] for cnts in rows],
+    }
 
-    # Load image
-    image = cv2.imread(image_path)
-    if image is None:
-        raise Exception(f"Không thể đọc ảnh từ đường dẫn: {image_path}")
+    with timed(timings, 'sample'):
+        # Ma trận tỷ lệ tô (câu hỏi x lựa chọn), các ô vượt ngưỡng của tờ là lựa chọn
+        all_fill = fill_to_uint8(bubble_fill_matrix(
+            thresh, np.concatenate([rects, id_rects.reshape(-1, 4), code_rects])
+        ))
+        fill = all_fill[:len(rects)].reshape(len(rows), -1) if rows else np.zeros((0, test.num_choices), dtype=np.uint8)
+        id_end = len(rects) + id_rects.shape[0] * 10
+        student_code = decode_student_id(all_fill[len(rects):id_end].reshape(-1, 10))
+        variant_code = decode_variant_code(all_fill[id_end:])
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (7, 7), 0)
+    return paper, fill, detection, student_code, variant_code
+
+def find_paper(small_gray, debug=None):
+    """
+    Tìm tờ giấy là contour 4 điểm lớn nhất (cho phiếu không có marker).
+    Dò trên ảnh xám đã thu nhỏ, trả về 4 góc theo tọa độ của ảnh đó.
+    """
+    import imutils
+
+    blurred = cv2.GaussianBlur(small_gray, (5, 5), 0)
     edged = cv2.Canny(blurred, 75, 200)
-    cv2.imwrite("debug_edged.jpg", edged)
+    if debug is not None:
+        debug['edged'] = edged
     
     cnts = cv2.findContours(edged.copy(), cv2.RETR_EXTERNAL,
         cv2.CHAIN_APPROX_SIMPLE)    
@@ -207,82 +369,99 @@ def process_omr_sheet(image_path, test):
             # approximate the contour
             peri = cv2.arcLength(c, True)
             approx = cv2.approxPolyDP(c, 0.02 * peri, True)
-            print(f"Đã phát hiện contour với {len(approx)} điểm")
             # if our approximated contour has four points,
             # then we can assume we have found the paper
             if len(approx) == 4:
                 docCnt = approx
-                print("Found document contour")
                 break
 
     if docCnt is None:
-        raise Exception("Không tìm thấy contour có 4 điểm (tờ giấy)")
-
-    # Vẽ contour lên ảnh gốc (màu xanh lá cây, độ dày 2 pixel)
-    output = image.copy()
-    cv2.drawContours(output, [docCnt], -1, (0, 255, 0), 2)
-    # Lưu ảnh để debug
-    cv2.imwrite("debug_detected_paper.jpg", output)
-    print("Ảnh đã được lưu dưới tên debug_detected_paper.jpg")
-
-    paper = four_point_transform(image, docCnt.reshape(4, 2))
-    warped = four_point_transform(gray, docCnt.reshape(4, 2))
-    thresh = cv2.threshold(warped, 0, 255,
-        cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-    cv2.imwrite("debug_thresh.jpg", thresh)
-    
+        raise ImageRejected("Không tìm thấy contour có 4 điểm (tờ giấy)")
+
+    return docCnt.reshape(4, 2).astype(np.float32)
+
+def layout_bubble_rows(layout, image_shape, max_rows):
+    """
+    Contour (để vẽ) và ô lấy mẫu (bỏ viền) của từng câu theo layout của bài
+    """
+    outline = bubble_rects(layout, image_shape)[:max_rows]
+    inner = bubble_rects(layout, image_shape, inset=LAYOUT_SAMPLE_INSET)[:max_rows]
+    rows = [[rect_contour(r) for r in row] for row in outline]
+    return rows, inner.reshape(-1, 4)
+
+def rect_contour(rect):
+    x, y, w, h = (int(v) for v in rect)
+    return np.array([[[x, y]], [[x + w, y]], [[x + w, y + h]], [[x, y + h]]], dtype=np.int32)
+
+def detect_bubble_rows(thresh, num_choices, max_rows, debug=None):
+    """
+    Dò các ô bằng contour (cho bài kiểm tra chưa có layout).
+    Các ô được gom thành dòng theo tâm y, mỗi dòng chia thành các nhóm
+    num_choices ô liên tiếp từ trái sang phải (mỗi nhóm là một câu của một cột).
+    Câu hỏi được đánh số hết cột trái rồi sang cột phải. Chi phí O(n log n) theo số ô.
+    """
+    import imutils
+
     # Find question contours
     cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     cnts = imutils.grab_contours(cnts)
     questionCnts = []
-    y_min = 110  # Giới hạn trên (bỏ qua phần tiêu đề)
-    y_max = 800  # Giới hạn dưới (tùy theo chiều dài bài thi của bạn)
+    boxes = []
+    # Bỏ qua phần tiêu đề và mép dưới trang
+    y_min, y_max = (int(thresh.shape[0] * f) for f in DETECT_PAGE_RANGE)
     for c in cnts:
         (x, y, w, h) = cv2.boundingRect(c)
         ar = w / float(h)
         if w >= 8 and h >= 8 and ar >= 0.4 and ar <= 1.6:
             if y_min <= y <= y_max:
                 questionCnts.append(c)
+                boxes.append((x, y, w, h))
+
+    if boxes:
+        # Bỏ chữ số thứ tự câu và nét chữ: ô thật có kích thước gần với trung vị
+        boxes = np.array(boxes, dtype=np.int64)
+        size = np.median(boxes[:, 2:], axis=0)
+        keep = np.all((boxes[:, 2:] >= size * 0.7) & (boxes[:, 2:] <= size * 1.4), axis=1)
+        questionCnts = [c for c, k in zip(questionCnts, keep) if k]
+        boxes = boxes[keep]
 
+    if debug is not None:
         # Debug: Vẽ tất cả các ô đã phát hiện
-    output = warped.copy()  # Tạo bản sao từ ảnh scan xám
-    output = cv2.cvtColor(output, cv2.COLOR_GRAY2BGR)  # Chuyển sang ảnh màu để vẽ màu
-
-    for c in questionCnts:
-        cv2.drawContours(output, [c], -1, (0, 0, 255), 2)  # Vẽ contour màu đỏ
-
-    # Lưu ảnh debug
-    cv2.imwrite("debug_detected_bubbles.jpg", output)
-    print(f"Đã lưu ảnh debug_detected_bubbles.jpg với {len(questionCnts)} ô được phát hiện!")
-
-    # Sort contours and detect answers
-    questionCnts = contours.sort_contours(questionCnts, method="top-to-bottom")[0]
-    answers = {}
-    question_contours = {}  # To store contours for each question
-
-    # Get the list of question IDs in order
-    question_ids = list(test.questions.values_list('id', flat=True))
-
-    for (q, i) in enumerate(np.arange(0, len(questionCnts), test.num_choices)):
-        if q >= test.questions.count():
-            break
-        cnts = contours.sort_contours(questionCnts[i:i + test.num_choices])[0]
-        bubbled = None
-        for (j, c) in enumerate(cnts):
-            mask = np.zeros(thresh.shape, dtype="uint8")
-            cv2.drawContours(mask, [c], -1, 255, -1)
-            mask = cv2.bitwise_and(thresh, thresh, mask=mask)
-            total = cv2.countNonZero(mask)
-            if bubbled is None or total > bubbled[0]:
-                bubbled = (total, j)
-        
-        if bubbled:
-            choice_letters = ['A', 'B', 'C', 'D'][:test.num_choices]
-            user_answer = choice_letters[bubbled[1]] if bubbled[1] < len(choice_letters) else ""
-            (x, y, w, h) = cv2.boundingRect(cnts[bubbled[1]])
-            rect = (x, y, x + w, y + h)
-            current_question_id = question_ids[q]
-            answers[current_question_id] = (user_answer, rect, cnts)  # Include contours
-            question_contours[current_question_id] = cnts
-
-    return answers, paper, question_contours
+        output = cv2.cvtColor(thresh, cv2.COLOR_GRAY2BGR)  # Chuyển sang ảnh màu để vẽ màu
+        cv2.drawContours(output, questionCnts, -1, (0, 0, 255), 2)  # Vẽ contour màu đỏ
+        debug['detected_bubbles'] = output
+
+    if not questionCnts:
+        return [], np.zeros((0, 4), dtype=np.int64)
+
+    centers_y = boxes[:, 1] + boxes[:, 3] / 2
+    order = np.argsort(centers_y, kind='stable')
+    # Sang dòng mới khi tâm y cách ô liền trước hơn nửa chiều cao ô
+    breaks = np.flatnonzero(np.diff(centers_y[order]) > np.median(boxes[:, 3]) / 2) + 1
+
+    groups = []  # (cột, dòng, chỉ số các ô từ trái sang phải)
+    for line, members in enumerate(np.split(order, breaks)):
+        members = members[np.argsort(boxes[members, 0], kind='stable')]
+        for column, start in enumerate(range(0, len(members) - num_choices + 1, num_choices)):
+            groups.append((column, line, members[start:start + num_choices]))
+    groups.sort(key=lambda group: group[:2])
+    groups = groups[:max_rows]
+    if not groups:
+        return [], np.zeros((0, 4), dtype=np.int64)
+
+    rows = [[questionCnts[i] for i in members] for _, _, members in groups]
+    rects = boxes[np.concatenate([members for _, _, members in groups])]
+    return rows, rects
+
+def bubble_fill_matrix(thresh, rects):
+    """
+    Tỷ lệ pixel được tô trong từng ô (x, y, w, h) của ảnh nhị phân `thresh`.
+    Dùng integral image nên chỉ duyệt ảnh một lần cho tất cả các ô,
+    thay vì tạo một mask cỡ cả trang cho mỗi ô.
+    """
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    integral = cv2.integral((thresh > 0).astype(np.uint8))
+    x, y, w, h = rects.T
+    x2, y2 = x + w, y + h
+    filled = integral[y2, x2] - integral[y, x2] - integral[y2, x] + integral[y, x]
+    return filled / np.maximum(w * h, 1)
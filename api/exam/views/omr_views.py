@@ -9,23 +9,122 @@ from reportlab.pdfgen import canvas
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import cm
-from exam.models import PaperTest, PaperTestQuestion, PaperSubmission, PaperAnswerDetected, Classroom, Student, PaperUserAnswer
+from exam.models import PaperTest, PaperTestQuestion, PaperSubmission, PaperSubmissionBatch, PaperAnswerDetected, Classroom, Student, PaperUserAnswer
 from rest_framework.decorators import authentication_classes
 from exam.serializers import (
     TestSerializer, TestCreateSerializer, 
     QuestionSerializer, QuestionCreateSerializer,
     SubmissionSerializer
 )
-from django.db.models import Count, Avg
-from .omr_processing import process_submission_cloudinary
+from django.db.models import Count, Avg, Q
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from .omr_processing import queue_submission_upload
+from exam.omr_pool import get_omr_pool, OMRQueueFull
+from exam.omr_layout import build_sheet_layout, draw_sheet, layout_for_test, MAX_QUESTIONS, MAX_STUDENT_ID_DIGITS, MAX_VARIANTS
+from exam.omr_variants import create_variants, describe_variant
+from exam.omr_image import check_image_size, estimate_job_memory, ImageRejected
+from exam.omr_quality import check_image_quality
+from exam.omr_timing import stage_percentiles
+from exam.omr_render import annotated_url, can_render, render_submission, MissingAnswerKey
+from exam.omr_events import EventStreamRenderer, event_stream_response, parse_cursor, streams_live, submission_events
+from rest_framework.renderers import JSONRenderer
+from django.utils import timezone
+from datetime import timedelta
+from exam.grading import regrade_test, invalidate_answer_key, letters_to_mask, mask_to_letters
+from exam.grading import get_answer_keys as load_answer_keys
 import cloudinary
 import cloudinary.uploader
-import threading
+import hashlib
+import os
+import zipfile
 
 pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
 font_name = "DejaVuSans"
 
+# Số bài tối đa dùng để tính thống kê thời gian chấm
+OMR_TIMING_SAMPLE_SIZE = 5000
+
+# Kích thước (cạnh dài, px) của ảnh đã chấm vẽ theo yêu cầu
+ANNOTATED_DEFAULT_SIZE = 1600
+ANNOTATED_MIN_SIZE = 200
+ANNOTATED_MAX_SIZE = 3200
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+
+
+def omr_debug_requested(request, test):
+    """Bật chế độ debug OMR theo request (debug=true) hoặc theo cấu hình của bài"""
+    return str(request.data.get('debug', '')).lower() in ('1', 'true', 'yes') or test.omr_debug
+
+
+def read_hashed(chunks):
+    """Nối các chunk của file upload và tính sha256 trong lúc đọc: (bytes, hex digest)"""
+    digest = hashlib.sha256()
+    parts = []
+    for chunk in chunks:
+        digest.update(chunk)
+        parts.append(chunk)
+    return b''.join(parts), digest.hexdigest()
+
+
+def find_duplicate_submission(test, user, image_sha256, idempotency_key=''):
+    """
+    Bài nộp đã có của cùng người dùng cho cùng ảnh (hoặc cùng Idempotency-Key).
+    Chỉ tính bài đã chấm xong, hoặc đang chấm và mới cập nhật trong
+    OMR_INFLIGHT_TIMEOUT_SECONDS: bài chấm lỗi hoặc kẹt ở QUEUED / PROCESSING
+    (worker chết) không chặn việc upload lại.
+    """
+    in_flight_since = timezone.now() - timedelta(seconds=settings.OMR_INFLIGHT_TIMEOUT_SECONDS)
+    submissions = PaperSubmission.objects.filter(test=test, user=user).filter(
+        Q(status=PaperSubmission.Status.GRADED)
+        | Q(status__in=[PaperSubmission.Status.QUEUED, PaperSubmission.Status.PROCESSING],
+            updated_at__gte=in_flight_since)
+    )
+    if idempotency_key:
+        existing = submissions.filter(idempotency_key=idempotency_key).order_by('id').first()
+        if existing is not None:
+            return existing
+    return submissions.filter(image_sha256=image_sha256).order_by('id').first()
+
+
+def duplicate_result(submission):
+    return {
+        "submission_id": submission.id,
+        "status": submission.status,
+        "score": submission.total_score if submission.status == PaperSubmission.Status.GRADED else None,
+        "duplicate": True,
+    }
+
+
+def iter_batch_images(request):
+    """
+    Yield (filename, bytes, sha256) cho từng ảnh trong batch upload.
+    Nhận một file ZIP ('archive') hoặc nhiều file ảnh ('submission_images').
+    ZIP được giải nén lần lượt từng entry, không bung toàn bộ vào bộ nhớ.
+    """
+    max_size = settings.OMR_BATCH_MAX_FILE_SIZE
+
+    if 'archive' in request.FILES:
+        with zipfile.ZipFile(request.FILES['archive']) as archive:
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name or name.startswith('.') or '__MACOSX' in info.filename:
+                    continue
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                if info.file_size > max_size:
+                    raise ValueError(f"File '{name}' is larger than {max_size} bytes")
+                with archive.open(info) as entry:
+                    yield (name, *read_hashed(iter(lambda: entry.read(UPLOAD_CHUNK_SIZE), b'')))
+
+    for uploaded_file in request.FILES.getlist('submission_images'):
+        if uploaded_file.size > max_size:
+            raise ValueError(f"File '{uploaded_file.name}' is larger than {max_size} bytes")
+        yield (uploaded_file.name, *read_hashed(uploaded_file.chunks(UPLOAD_CHUNK_SIZE)))
+
 class TestViewSet(viewsets.ModelViewSet):
     serializer_class = TestSerializer
     permission_classes = [IsAuthenticated]
@@ -42,6 +141,7 @@ class TestViewSet(viewsets.ModelViewSet):
         test = serializer.save(created_by=self.request.user)
         for i in range(test.num_questions):
             PaperTestQuestion.objects.create(test=test, text=f"Question {i+1}", correct_answer="")
+        invalidate_answer_key(test)
         
     @action(detail=True, methods=['post'])
     def add_question(self, request, pk=None):
@@ -50,6 +150,7 @@ class TestViewSet(viewsets.ModelViewSet):
         
         if serializer.is_valid():
             serializer.save(test=test)
+            invalidate_answer_key(test)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -225,61 +326,50 @@ class TestViewSet(viewsets.ModelViewSet):
             num_choices = int(request.data.get('numChoices', 4))
             num_questions = int(request.data.get('numQuestions', 25))  # Tối đa 30 câu
             multiple_choice = request.data.get('multipleChoice', 'yes') == 'yes'
+            test_id = request.data.get('test_id')
+
+            test = None
+            if test_id:
+                if not request.user.is_authenticated:
+                    return Response({"error": "Authentication required to attach a layout to a test"}, status=401)
+                test = get_object_or_404(PaperTest, id=test_id, created_by=request.user)
+                # Phiếu của một bài kiểm tra luôn theo số câu / số lựa chọn của bài đó,
+                # không theo tham số preview, để fill_matrix khớp với đáp án khi chấm
+                test_name = request.data.get('testName', test.title)
+                num_choices = test.num_choices
+                num_questions = test.num_questions
+                multiple_choice = test.allow_multiple_answers
+            # Số chữ số của lưới tô mã học sinh, mặc định theo bài kiểm tra
+            student_id_digits = int(request.data.get('studentIdDigits', test.student_id_digits if test else 0))
+            # Hàng ô mã đề: theo số mã đề đã sinh của bài kiểm tra
+            num_variants = test.num_variants if test else int(request.data.get('numVariants', 0))
 
             if num_choices < 1 or num_choices > 26:
                 return Response({"error": "Số lựa chọn phải từ 1 đến 26"}, status=400)
-            if num_questions < 1 or num_questions > 25:
-                return Response({"error": "Số câu hỏi phải từ 1 đến 25"}, status=400)
+            if num_questions < 1 or num_questions > MAX_QUESTIONS:
+                return Response({"error": f"Số câu hỏi phải từ 1 đến {MAX_QUESTIONS}"}, status=400)
+            if student_id_digits < 0 or student_id_digits > MAX_STUDENT_ID_DIGITS:
+                return Response({"error": f"Số chữ số mã học sinh phải từ 0 đến {MAX_STUDENT_ID_DIGITS}"}, status=400)
+            if num_variants < 0 or num_variants > MAX_VARIANTS:
+                return Response({"error": f"Số mã đề phải từ 0 đến {MAX_VARIANTS}"}, status=400)
+
+            try:
+                if test is not None:
+                    test.student_id_digits = student_id_digits
+                    layout = layout_for_test(test)
+                else:
+                    layout = build_sheet_layout(num_questions, num_choices, multiple_choice, student_id_digits, num_variants)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=400)
+
+            # Lưu layout cùng bài kiểm tra để chấm theo đúng tọa độ đã in
+            if test is not None:
+                test.layout = layout
+                test.save(update_fields=['layout', 'student_id_digits'])
 
             buffer = BytesIO()
             p = canvas.Canvas(buffer, pagesize=A4)
-            width, height = A4
-
-            # Constants
-            margin = 2 * cm
-            bubble_size = 0.35 * cm
-            choice_spacing = 0.9 * cm
-            line_spacing = 0.9 * cm
-
-            # --- Tiêu đề ---
-            current_y = height - margin
-            p.setFont(font_name, 12)
-            p.drawCentredString(width / 2, current_y, test_name.upper())
-            current_y -= 1.5 * cm
-
-            # --- Họ tên và lớp ---
-            p.setFont(font_name, 10)
-            p.drawString(margin, current_y, "Họ và tên: ___________________________")
-            p.drawString(width / 2 + 3 * cm, current_y, "Lớp: ________________")
-            current_y -= 1.5 * cm
-
-            # --- Hiển thị câu hỏi 1 cột ---
-            p.setFont(font_name, 8)
-
-            # Tính x_start sao cho câu hỏi nằm chính giữa
-            question_row_width = 0.6 * cm + num_choices * (bubble_size + choice_spacing)
-            # x_start = margin + (width - 2 * margin - question_row_width) / 2
-            x_start = margin
-            y = current_y
-
-            for q_num in range(1, num_questions + 1):
-                p.setFont("Helvetica-Bold", 9)
-                p.setLineWidth(1)
-                p.setFillColorRGB(0, 0, 0)
-                p.drawString(x_start, y, f"{q_num}")
-                x_choices = x_start + 0.6 * cm
-                for i in range(num_choices):
-                    letter = chr(65 + i)
-                    if multiple_choice:
-                        p.setLineWidth(1.5)
-                        p.rect(x_choices, y - bubble_size / 2, bubble_size, bubble_size, fill=0)
-                    else:
-                        p.setLineWidth(1.5)
-                        p.circle(x_choices + bubble_size / 2, y, bubble_size / 2, fill=0)
-                    p.setFont(font_name, 8)
-                    p.drawString(x_choices + bubble_size + 0.05 * cm, y - 0.1 * cm, letter)
-                    x_choices += choice_spacing
-                y -= line_spacing
+            draw_sheet(p, layout, test_name, font_name)
 
             p.showPage()
             p.save()
@@ -317,6 +407,7 @@ class TestViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        changed_question_ids = []
         for question_number, answer in answer_keys.items():
             try:
                 # Convert question_number to integer
@@ -332,15 +423,25 @@ class TestViewSet(viewsets.ModelViewSet):
 
                 # Validate the answer (assuming answers are A, B, C, etc.)
                 valid_answers = [chr(65 + i) for i in range(test.num_choices)]  # e.g., ['A', 'B', 'C', 'D']
-                if answer not in valid_answers:
+                if test.allow_multiple_answers and isinstance(answer, str) and len(answer) > 1:
+                    # Bài nhiều đáp án: "CA" được lưu thành "AC"
+                    if not all(letter in valid_answers for letter in answer):
+                        return Response(
+                            {"error": f"Invalid answer '{answer}' for question {q_num}. Letters must be in {valid_answers}"},
+                            status=status.HTTP_400_BAD_REQUEST
+                        )
+                    answer = mask_to_letters(letters_to_mask(answer, test.num_choices))
+                elif answer not in valid_answers:
                     return Response(
                         {"error": f"Invalid answer '{answer}' for question {q_num}. Must be one of {valid_answers}"},
                         status=status.HTTP_400_BAD_REQUEST
                     )
 
                 # Save the correct answer
-                question.correct_answer = answer
-                question.save()
+                if question.correct_answer != answer:
+                    question.correct_answer = answer
+                    question.save()
+                    changed_question_ids.append(question.id)
 
             except ValueError:
                 return Response(
@@ -348,7 +449,69 @@ class TestViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-        return Response({"message": "Answer keys saved successfully"}, status=status.HTTP_200_OK)
+        # Chấm lại các bài đã nộp theo đáp án mới, chỉ các câu bị thay đổi
+        regrade = None
+        if changed_question_ids:
+            invalidate_answer_key(test)
+            regrade = regrade_test(test, changed_question_ids)
+
+        return Response({"message": "Answer keys saved successfully", "regrade": regrade}, status=status.HTTP_200_OK)
+    
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def regrade(self, request, pk=None):
+        test = self.get_object()
+        result = regrade_test(test)
+        return Response(result, status=status.HTTP_200_OK)
+    
+    def _variants_data(self, test):
+        # Thứ tự câu hỏi / lựa chọn của từng mã đề và đáp án theo thứ tự in, để in đề
+        keys = load_answer_keys(test)
+        question_ids = keys[0].question_ids
+        variants = []
+        for variant in test.variants.filter(code__lte=test.num_variants).order_by('code'):
+            data = describe_variant(variant, question_ids, test.num_choices)
+            key = keys.get(variant.code)
+            if key is not None:
+                data['answer_keys'] = {str(i): mask_to_letters(mask) for i, mask in enumerate(key.correct, start=1)}
+            variants.append(data)
+        return {"test_id": test.id, "num_variants": test.num_variants, "variants": variants}
+    
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
+    def variants(self, request, pk=None):
+        test = self.get_object()
+        return Response(self._variants_data(test), status=status.HTTP_200_OK)
+    
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def generate_variants(self, request, pk=None):
+        test = self.get_object()
+        try:
+            count = int(request.data.get('count', 4))
+            seed = request.data.get('seed')
+            seed = int(seed) if seed is not None else None
+        except (TypeError, ValueError):
+            return Response({"error": "count and seed must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+        shuffle_choices = str(request.data.get('shuffle_choices', True)).lower() not in ('false', '0', 'no')
+        force = str(request.data.get('force', False)).lower() in ('true', '1', 'yes')
+        if count != 0 and not 2 <= count <= MAX_VARIANTS:
+            return Response({"error": f"Số mã đề phải từ 2 đến {MAX_VARIANTS} (0 để bỏ mã đề)"}, status=status.HTTP_400_BAD_REQUEST)
+        # Bài đã chấm theo mã đề cũ sẽ không còn đáp án để chấm lại
+        if test.submissions.filter(variant_code__gt=0).exists() and not force:
+            return Response(
+                {"error": "Submissions were already graded with the current variants, pass force=true to replace them"},
+                status=status.HTTP_409_CONFLICT
+            )
+        
+        test.num_variants = count
+        try:
+            layout = layout_for_test(test)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        create_variants(test, count, shuffle_choices, seed)
+        # Phiếu có thêm hàng ô mã đề: phải in lại phiếu
+        test.layout = layout
+        test.save(update_fields=['layout'])
+        invalidate_answer_key(test)
+        return Response(self._variants_data(test), status=status.HTTP_201_CREATED)
     
 class StatisticViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
@@ -410,6 +573,34 @@ class StatisticViewSet(viewsets.ViewSet):
             'all_tests': all_tests_data
         }, status=status.HTTP_200_OK)
         
+    @action(detail=False, methods=['get'], url_path='omr-timings')
+    def get_omr_timings(self, request):
+        # p50/p95 thời gian từng bước chấm OMR, lọc theo test_id và khoảng thời gian (ISO 8601)
+        submissions = PaperSubmission.objects.filter(
+            test__created_by=request.user, stage_timings__isnull=False
+        )
+
+        test_id = request.query_params.get('test_id')
+        if test_id:
+            submissions = submissions.filter(test_id=test_id)
+        for param, lookup in (('since', 'submitted_at__gte'), ('until', 'submitted_at__lt')):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            parsed = parse_datetime(value)
+            if parsed is None:
+                return Response({"error": f"Invalid '{param}' datetime"}, status=status.HTTP_400_BAD_REQUEST)
+            submissions = submissions.filter(**{lookup: parsed})
+
+        # Chỉ lấy các bài gần nhất để giới hạn thời gian tính
+        rows = list(submissions.order_by('-submitted_at').values_list('stage_timings', flat=True)[:OMR_TIMING_SAMPLE_SIZE])
+
+        return Response({
+            'test_id': int(test_id) if test_id else None,
+            'submissions': len(rows),
+            'stages': stage_percentiles(rows),
+        }, status=status.HTTP_200_OK)
+
     # Thêm vào lớp StatisticViewSet
     @action(detail=True, methods=['get'], url_path='test-question-stats')
     def get_test_question_stats(self, request, pk=None):
@@ -585,48 +776,227 @@ class SubmissionViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
         
-        # Upload image to Cloudinary
         uploaded_file = request.FILES['submission_image']
+        idempotency_key = (request.headers.get('Idempotency-Key') or request.data.get('idempotency_key') or '')[:255]
         
+        # Chấm trực tiếp trên bytes của request, upload Cloudinary chạy nền sau khi chấm
+        image_bytes, image_sha256 = read_hashed(uploaded_file.chunks(UPLOAD_CHUNK_SIZE))
+        
+        # Client gửi lại cùng ảnh (hoặc cùng Idempotency-Key): trả về bài đã có, không chấm lại
+        existing = find_duplicate_submission(test, request.user, image_sha256, idempotency_key)
+        if existing is not None:
+            return Response({
+                **duplicate_result(existing),
+                "message": "This image was already uploaded for this test"
+            }, status=status.HTTP_200_OK)
+        
+        # Chỉ đọc header: từ chối ảnh quá lớn trước khi xếp hàng chấm
+        try:
+            check_image_size(image_bytes)
+        except ImageRejected as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Ảnh mờ / tối / không thấy trang giấy bị từ chối ngay, không chiếm worker
+        try:
+            check_image_quality(image_bytes, test.layout)
+        except ImageRejected as e:
+            return Response({
+                "error": str(e),
+                "status": PaperSubmission.Status.REJECTED,
+                "retake": True
+            }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        submission = PaperSubmission.objects.create(
+            test=test,
+            user=request.user,
+            student=student,
+            source_name=uploaded_file.name[:255],
+            image_sha256=image_sha256,
+            idempotency_key=idempotency_key
+        )
+        
+        # Đưa vào OMR worker pool để chấm
         try:
-            # Upload với tên file tùy chỉnh
-            upload_result = cloudinary.uploader.upload(
-                uploaded_file,
-                folder=f"testgen/submissions/test_{test_id}",
-                public_id=f"submission_{student.student_id if student else request.user.username}_{test_id}",
-                resource_type="image",
-                overwrite=True,
-                transformation=[
-                    {'quality': 'auto'},
-                    {'fetch_format': 'auto'}
-                ]
+            queue_submission_upload(submission.id, image_bytes, omr_debug_requested(request, test))
+        except OMRQueueFull as e:
+            submission.delete()
+            return Response(
+                {"error": f"Grading queue is busy, please retry later. {e}"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
             )
-            
-            # Tạo submission với Cloudinary URL
-            submission = PaperSubmission.objects.create(
-                test=test,
-                user=request.user,
-                student=student,
-                submission_image=upload_result['secure_url']  # Lưu URL từ Cloudinary
+        
+        return Response({
+            "submission_id": submission.id,
+            "message": "Submission uploaded successfully and is being processed"
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    @action(detail=False, methods=['post'])
+    def upload_batch(self, request):
+        test_id = request.data.get('test_id')
+        if not test_id:
+            return Response(
+                {"error": "Test ID is required"}, 
+                status=status.HTTP_400_BAD_REQUEST
             )
-            
-            # Process submission trong background thread
-            threading.Thread(
-                target=process_submission_cloudinary, 
-                args=(submission.id, upload_result['secure_url'])
-            ).start()
-            
-            return Response({
-                "submission_id": submission.id,
-                "image_url": upload_result['secure_url'],
-                "message": "Submission uploaded successfully and is being processed"
-            }, status=status.HTTP_202_ACCEPTED)
-            
-        except Exception as e:
+        
+        test = get_object_or_404(PaperTest, id=test_id)
+        
+        if 'archive' not in request.FILES and not request.FILES.getlist('submission_images'):
+            return Response(
+                {"error": "A ZIP archive or submission images are required"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        batch = PaperSubmissionBatch.objects.create(test=test, user=request.user)
+        debug = omr_debug_requested(request, test)
+        sheets = []
+        duplicates = []
+        
+        try:
+            for filename, image_bytes, image_sha256 in iter_batch_images(request):
+                if len(sheets) + len(duplicates) >= settings.OMR_BATCH_MAX_FILES:
+                    raise ValueError(f"A batch can contain at most {settings.OMR_BATCH_MAX_FILES} sheets")
+                
+                # Ảnh đã upload trước đó (kể cả trong cùng batch): trả về bài đã có
+                existing = find_duplicate_submission(test, request.user, image_sha256)
+                if existing is not None:
+                    duplicates.append({**duplicate_result(existing), "filename": filename})
+                    continue
+                
+                try:
+                    check_image_size(image_bytes)
+                except ImageRejected as e:
+                    raise ValueError(f"File '{filename}': {e}")
+                
+                submission = PaperSubmission(
+                    test=test,
+                    user=request.user,
+                    batch=batch,
+                    source_name=filename[:255],
+                    image_sha256=image_sha256
+                )
+                # Tờ chụp hỏng được ghi nhận là bị từ chối (kèm lý do) và không đưa vào hàng đợi
+                try:
+                    check_image_quality(image_bytes, test.layout)
+                except ImageRejected as e:
+                    submission.status = PaperSubmission.Status.REJECTED
+                    submission.status_reason = str(e)[:255]
+                    submission.save()
+                    sheets.append({
+                        "submission_id": submission.id,
+                        "filename": filename,
+                        "status": submission.status,
+                        "reason": submission.status_reason
+                    })
+                    continue
+                submission.save()
+                # Hàng đợi đầy: dừng batch thay vì giữ request chờ. Upload lại cả batch sau đó,
+                # các tờ đã xếp hàng / đã chấm được bỏ qua nhờ sha256
+                try:
+                    queue_submission_upload(submission.id, image_bytes, debug)
+                except OMRQueueFull as e:
+                    submission.delete()
+                    if not sheets:
+                        batch.delete()
+                        return Response(
+                            {"error": f"Grading queue is busy, please retry later. {e}", "duplicates": duplicates},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE
+                        )
+                    return self._batch_response(
+                        batch, sheets, duplicates, retry=True,
+                        error=f"Grading queue is busy, upload the batch again later to queue the remaining sheets. {e}"
+                    )
+                sheets.append({"submission_id": submission.id, "filename": filename})
+        except (zipfile.BadZipFile, ValueError) as e:
+            if not sheets and not duplicates:
+                batch.delete()
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            # Các tờ đã đưa vào hàng đợi vẫn được chấm tiếp
+            return self._batch_response(batch, sheets, duplicates, error=str(e))
+        
+        if not sheets and not duplicates:
+            batch.delete()
             return Response(
-                {"error": f"Failed to upload image: {str(e)}"}, 
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"error": "No image files found in the upload"}, 
+                status=status.HTTP_400_BAD_REQUEST
             )
+        
+        return self._batch_response(batch, sheets, duplicates,
+                                    message="Batch uploaded successfully and is being processed")
+    
+    def _batch_response(self, batch, sheets, duplicates, **extra):
+        # Batch chỉ gồm các tờ mới; tờ trùng trỏ về bài nộp đã có
+        if not sheets:
+            batch.delete()
+        else:
+            batch.total_sheets = len(sheets)
+            batch.save(update_fields=['total_sheets'])
+        return Response({
+            "batch_id": str(batch.id) if sheets else None,
+            "total_sheets": len(sheets),
+            "sheets": sheets,
+            "duplicates": duplicates,
+            **extra
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    @action(detail=False, methods=['get'], url_path=r'batch/(?P<batch_id>[0-9a-f-]+)')
+    def batch_status(self, request, batch_id=None):
+        batch = get_object_or_404(PaperSubmissionBatch, id=batch_id, user=request.user)
+        submissions = batch.submissions.order_by('id').values(
+            'id', 'source_name', 'status', 'status_reason', 'total_score', 'student_id', 'student_code'
+        )
+        
+        counts = {choice: 0 for choice in PaperSubmission.Status.values}
+        sheets = []
+        for submission in submissions:
+            counts[submission['status']] += 1
+            sheets.append({
+                'submission_id': submission['id'],
+                'filename': submission['source_name'],
+                'status': submission['status'],
+                'score': submission['total_score'] if submission['status'] == PaperSubmission.Status.GRADED else None,
+                'reason': submission['status_reason'],
+                'student': submission['student_id'],
+                'student_code': submission['student_code'],
+            })
+        
+        done = (counts[PaperSubmission.Status.GRADED] + counts[PaperSubmission.Status.FAILED]
+                + counts[PaperSubmission.Status.REJECTED])
+        return Response({
+            'batch_id': str(batch.id),
+            'test_id': batch.test_id,
+            'total_sheets': batch.total_sheets,
+            'completed': done,
+            'counts': counts,
+            'sheets': sheets,
+        }, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'], url_path=r'batch/(?P<batch_id>[0-9a-f-]+)/events',
+            renderer_classes=[JSONRenderer, EventStreamRenderer])
+    def batch_events(self, request, batch_id=None):
+        # SSE: trạng thái hiện tại của mọi tờ trong batch, rồi từng thay đổi đến khi chấm xong
+        batch = get_object_or_404(PaperSubmissionBatch, id=batch_id, user=request.user)
+        cursor = parse_cursor(request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id'))
+        return event_stream_response(
+            submission_events(batch.submissions.all(), cursor, batch=batch, live=streams_live(request))
+        )
+    
+    @action(detail=False, methods=['get'], renderer_classes=[JSONRenderer, EventStreamRenderer])
+    def events(self, request):
+        # SSE: các bài nộp của một bài kiểm tra đổi trạng thái / điểm, từ lúc kết nối (hoặc Last-Event-ID)
+        test_id = request.query_params.get('test_id')
+        if not test_id:
+            return Response({"error": "Test ID is required"}, status=status.HTTP_400_BAD_REQUEST)
+        test = get_object_or_404(PaperTest, id=test_id, created_by=request.user)
+        cursor = parse_cursor(request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id'))
+        return event_stream_response(
+            submission_events(test.submissions.all(), cursor or timezone.now(), live=streams_live(request))
+        )
+    
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def queue_status(self, request):
+        stats = get_omr_pool().stats()
+        # Bộ nhớ đỉnh ước lượng mỗi job, dùng để chọn OMR_WORKERS
+        stats['job_memory_mb'] = round(estimate_job_memory() / (1024 * 1024), 1)
+        return Response(stats, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
     def submission_summary(self, request):
@@ -639,6 +1009,8 @@ class SubmissionViewSet(viewsets.ModelViewSet):
                 'participant_name': submission.user.username,
                 'score': submission.total_score if submission.total_score is not None else 0,
                 'submission_image': submission.submission_image.url if submission.submission_image else None,
+                # Ảnh đã chấm (đánh dấu đúng / sai) được vẽ khi mở URL này
+                'annotated_url': annotated_url(submission, request),
                 'test_id': submission.test.id,
                 'student_name': submission.student.name if submission.student else "N/A",
                 'created_at': submission.submitted_at, 
@@ -650,6 +1022,37 @@ class SubmissionViewSet(viewsets.ModelViewSet):
     
     
     
+    @action(detail=True, methods=['get'])
+    def annotated(self, request, pk=None):
+        # Vẽ ảnh đã chấm từ ảnh gốc và hình học đã lưu, ?size= là cạnh dài (px)
+        submission = self.get_object()
+        if not can_render(submission):
+            return Response(
+                {"error": "No annotated image available for this submission"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        try:
+            size = int(request.query_params.get('size', ANNOTATED_DEFAULT_SIZE))
+        except ValueError:
+            return Response({"error": "size must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        size = min(max(size, ANNOTATED_MIN_SIZE), ANNOTATED_MAX_SIZE)
+
+        try:
+            jpeg = render_submission(submission, size)
+        except MissingAnswerKey as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        except Exception as e:
+            print(f"Error rendering submission {submission.id}: {e}")
+            return Response(
+                {"error": "Could not render the annotated image"},
+                status=status.HTTP_502_BAD_GATEWAY
+            )
+
+        response = HttpResponse(jpeg, content_type='image/jpeg')
+        response['Cache-Control'] = 'private, max-age=300'
+        return response
+
     @action(detail=True, methods=['get'])
     def results(self, request, pk=None):
         submission = self.get_object()
@@ -681,6 +1084,7 @@ class SubmissionViewSet(viewsets.ModelViewSet):
                 'class_name': submission.student.classroom.name if submission.student and submission.student.classroom else "N/A",
                 'score': submission.total_score if submission.total_score is not None else 0,
                 'submission_image': submission.submission_image.url if submission.submission_image else None,
+                'annotated_url': annotated_url(submission, request),
             }
             for submission in queryset
         ]
@@ -230,7 +230,7 @@ export default function ClassroomDetail({ params }) {
 
       await uploadSubmission(formData);
 
-      alert("Submission uploaded successfully!");
+      alert("Submission uploaded and queued for grading!");
       setIsAddSubmissionModalOpen(false);
 
       // FIX: Reset về giá trị mặc định rõ ràng
@@ -61,6 +61,7 @@ export default function SubmissionSummary() {
     getSubmissionSummary,
     deleteSubmission,
     uploadSubmission,
+    waitForSubmission,
     uploadProgress,
   } = useSubmission();
   const { getTestQuestionStats } = useStatistics();
@@ -102,13 +103,6 @@ export default function SubmissionSummary() {
     fetchSubmissions();
   }, [test_id, student_id]);
 
-  useEffect(() => {
-    if (localStorage.getItem("newSubmissionAdded") === "true") {
-      fetchSubmissions();
-      localStorage.removeItem("newSubmissionAdded");
-    }
-  }, []);
-
   const fetchTestData = async () => {
     try {
       if (!test_id) return;
@@ -199,16 +193,33 @@ export default function SubmissionSummary() {
       formData.append("participant_name", participantName);
       formData.append("submission_image", submissionImage);
 
-      await uploadSubmission(formData);
+      const uploaded = await uploadSubmission(formData);
 
       setIsAddSubmissionModalOpen(false);
       setSubmissionImage(null);
 
-      localStorage.setItem("newSubmissionAdded", "true");
-      alert(
-        "Submission uploaded successfully! Page will reload to show updated scores."
-      );
-      window.location.reload();
+      // Ảnh được chấm trong hàng đợi: chờ kết quả rồi tải lại danh sách
+      const result = uploaded.duplicate
+        ? uploaded
+        : await waitForSubmission(uploaded.submission_id);
+      if (result.status === "graded") {
+        alert(
+          uploaded.duplicate
+            ? "This image was already graded."
+            : "Submission graded successfully!"
+        );
+      } else if (result.status === "rejected" || result.status === "failed") {
+        alert(
+          `The sheet could not be graded: ${
+            result.status_reason || result.status
+          }. Please retake the photo and upload again.`
+        );
+      } else {
+        alert(
+          "Submission uploaded and is still being graded. The score will appear when grading finishes."
+        );
+      }
+      fetchSubmissions();
     } catch (err) {
       console.error("Error uploading submission:", err);
       setUploadError(err.message);
@@ -258,7 +269,8 @@ export default function SubmissionSummary() {
   };
 
   const handleSubmissionClick = (submission) => {
-    router.push(`${submission.submission_image}`);
+    // Ảnh đã chấm (ô đúng / sai), ảnh gốc nếu bài chưa chấm xong
+    router.push(`${submission.annotated_url || submission.submission_image}`);
   };
 
   const getChoiceLetters = () => {
@@ -395,18 +407,20 @@ export default function SubmissionSummary() {
                           {new Date(submission.created_at).toLocaleString()}
                         </TableCell>
                         <TableCell>
-                          {submission.submission_image ? (
+                          {submission.annotated_url ? (
                             <a
-                              href={`${submission.submission_image}`}
+                              href={`${submission.annotated_url}`}
                               target="_blank"
                               rel="noopener noreferrer"
                               onClick={(e) => e.stopPropagation()}
                             >
+                              {/* Ảnh đã chấm do API vẽ khi cần (cần cookie đăng nhập), không qua image optimizer */}
                               <Image
-                                src={`${submission.submission_image}`}
-                                alt="Submission"
+                                src={`${submission.annotated_url}?size=300`}
+                                alt="Graded submission"
                                 width={100}
                                 height={100}
+                                unoptimized
                                 className="object-cover rounded-md"
                               />
                             </a>
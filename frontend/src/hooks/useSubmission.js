@@ -34,7 +34,9 @@ export function useSubmission() {
         return response.data;
       } catch (err) {
         const errorMsg =
-          err.response?.data?.detail || "Failed to upload submission";
+          err.response?.data?.error ||
+          err.response?.data?.detail ||
+          "Failed to upload submission";
         setError(errorMsg);
         throw new Error(errorMsg);
       } finally {
@@ -72,6 +74,26 @@ export function useSubmission() {
     [apiUrl]
   );
 
+  // Bài nộp được chấm trong hàng đợi (upload trả về 202): hỏi lại trạng thái
+  // đến khi chấm xong, bị từ chối hoặc lỗi
+  const waitForSubmission = useCallback(
+    async (submissionId, { intervalMs = 1000, timeoutMs = 60000 } = {}) => {
+      const deadline = Date.now() + timeoutMs;
+      while (true) {
+        const response = await axios.get(
+          `${apiUrl}api/submissions/${submissionId}/`,
+          { withCredentials: true }
+        );
+        const { status } = response.data;
+        if (!["queued", "processing"].includes(status) || Date.now() >= deadline) {
+          return response.data;
+        }
+        await new Promise((resolve) => setTimeout(resolve, intervalMs));
+      }
+    },
+    [apiUrl]
+  );
+
   const getSubmissionDetails = useCallback(
     async (submissionId) => {
       try {
@@ -149,6 +171,7 @@ export function useSubmission() {
     error,
     uploadSubmission,
     getSubmissionSummary,
+    waitForSubmission,
     getSubmissionDetails,
     deleteSubmission,
     getStudentDetails,